@@ -0,0 +1,53 @@
+# Copyright 2018-2021 Nick Anthony, Backman Biophotonics Lab, Northwestern University
+#
+# This file is part of PWSpy.
+#
+# PWSpy is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PWSpy is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with PWSpy.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+This script compares the time taken to save analysis results using each of the `AbstractHDFAnalysisResults.WriteStrategy` options.
+Synthetic analysis results the size of a typical acquisition are saved to `OutputPath` several times with each strategy. Set
+`OutputPath` to a folder on the drive you normally save to (e.g. a network share) since the difference between the strategies
+depends heavily on the file system.
+"""
+import os
+import tempfile
+import time
+
+import numpy as np
+import pwspy.dataTypes as pwsdt
+from pwspy.analysis.pws import PWSAnalysisResults, PWSAnalysisSettings
+
+### User Variables ###
+OutputPath = tempfile.gettempdir()  # Set this to the folder to save the test files to.
+ImageShape = (1024, 1024)  # The (y, x) size of the synthetic data.
+NumWavenumbers = 200  # The number of wavenumbers of the synthetic reflectance cube.
+Repeats = 3  # The number of times to save with each strategy.
+######################
+
+rng = np.random.default_rng()
+settings = PWSAnalysisSettings.loadDefaultSettings("Recommended")
+im = lambda: rng.random(ImageShape, dtype=np.float32)
+results = PWSAnalysisResults.create(settings, pwsdt.KCube(rng.random(ImageShape + (NumWavenumbers,), dtype=np.float32), tuple(np.linspace(8.9, 12.6, NumWavenumbers))),
+                                    im(), im(), im(), im(), im(), im(), 'imCubeIdTag', 'referenceIdTag', None)
+
+for strategy in PWSAnalysisResults.WriteStrategy:
+    times = []
+    for i in range(Repeats):
+        t0 = time.time()
+        results.toHDF(OutputPath, 'writeBenchmark', overwrite=True, writeStrategy=strategy)
+        times.append(time.time() - t0)
+    size = os.path.getsize(os.path.join(OutputPath, PWSAnalysisResults.name2FileName('writeBenchmark'))) / 1e6
+    print(f"{strategy.name}: {np.mean(times):.2f} s (min {np.min(times):.2f} s) for {size:.0f} MB")
+os.remove(os.path.join(OutputPath, PWSAnalysisResults.name2FileName('writeBenchmark')))
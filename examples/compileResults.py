@@ -34,24 +34,24 @@ compiler = PWSRoiCompiler(PWSCompilerSettings(reflectance=True, rms=True))
 
 listOfAcquisitions = [pwsdt.Acquisition(i) for i in PWSExperimentPath.glob("Cell[0-9]")]
 for acquisition in listOfAcquisitions:
+    roiFiles = [acquisition.loadRoi(*roiSpec) for roiSpec in acquisition.getRois()]
     for analysisName in acquisition.pws.getAnalyses():
         analysisResults = acquisition.pws.loadAnalysis(analysisName)
-        for roiSpec in acquisition.getRois():
-            roiFile = acquisition.loadRoi(*roiSpec)
-            results, warnings = compiler.run(analysisResults, roiFile.getRoi())
-
-            if len(warnings) > 0:
-                print(warnings)
-
-            tmpList.append(dict(
-                acquisition=acquisition,
-                cellNumber=acquisition.getNumber(),
-                analysisResults=analysisResults,
-                rms=results.rms,
-                reflectance=results.reflectance,
-                roiNum=roiFile.number,
-                roiName=roiFile.name
-            ))
-
-dataFrame = pandas.DataFrame(tmpList)
+        results, warnings = compiler.runMany(analysisResults, [roiFile.getRoi() for roiFile in roiFiles])  # Compile all ROIs at once.
+
+        for roiWarnings in warnings:
+            if len(roiWarnings) > 0:
+                print(roiWarnings)
+
+        tmpList.append(pandas.DataFrame(dict(
+            acquisition=[acquisition] * len(roiFiles),
+            cellNumber=acquisition.getNumber(),
+            analysisResults=[analysisResults] * len(roiFiles),
+            rms=results['rms'],
+            reflectance=results['reflectance'],
+            roiNum=[roiFile.number for roiFile in roiFiles],
+            roiName=[roiFile.name for roiFile in roiFiles]
+        )))
+
+dataFrame = pandas.concat(tmpList, ignore_index=True)
 print(dataFrame)
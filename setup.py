@@ -35,7 +35,7 @@ setup(name='pwspy',
       author='Nick Anthony',
       author_email='nicholas.anthony@northwestern.edu',
       url='https://github.com/BackmanLab/PWSpy',
-      python_requires='>=3.7',
+      python_requires='>=3.8',
       install_requires=['numpy',
                         'scipy',
                         'matplotlib',
@@ -17,21 +17,27 @@
 
 from __future__ import annotations
 
+import copy
+import enum
 import logging
 from abc import ABC, abstractmethod
 import json
+import os
 import os.path as osp
+import shutil
+import tempfile
 import h5py
 import numpy as np
+import psutil
 import typing as t_
 import pandas as pd
 
 from pwspy import __version__ as pwspyversion
 from pwspy.analysis.warnings import AnalysisWarning
 from pwspy.utility.fileIO import processParallel
-from pwspy.utility.misc import cached_property
+from pwspy.utility.misc import cached_property, LRUCache
 if t_.TYPE_CHECKING:
-    from pwspy.dataTypes import ICBase, MetaDataBase
+    from pwspy.dataTypes import ICBase, MetaDataBase, Roi
 
 
 class AbstractAnalysisSettings(ABC):
@@ -191,6 +197,107 @@ def _getFromDict(func):
     return newFunc
 
 
+def _fieldSize(value: t_.Any) -> int:
+    """Estimate the memory used by the value of a results field."""
+    from pwspy.dataTypes import ICBase
+    if isinstance(value, ICBase):
+        return value.data.nbytes
+    elif isinstance(value, np.ndarray):
+        return value.nbytes
+    elif isinstance(value, tuple):
+        return sum(_fieldSize(i) for i in value)
+    else:
+        return 1000  # Strings, settings, etc. are small.
+
+
+def _setReadOnly(value: t_.Any):
+    """Make the arrays of a results field read-only so the value in `fieldCache` can't be modified."""
+    from pwspy.dataTypes import ICBase
+    if isinstance(value, ICBase):
+        value.data.setflags(write=False)
+    elif isinstance(value, np.ndarray):
+        value.setflags(write=False)
+    elif isinstance(value, tuple):
+        for i in value:
+            _setReadOnly(i)
+
+
+fieldCache = LRUCache(maxBytes=psutil.virtual_memory().total // 4, sizeOf=_fieldSize)
+"""The cache shared by all `AbstractHDFAnalysisResults` fields loaded from file. The `maxBytes` attribute can be changed to adjust the
+memory used, `hits` and `misses` count how often a field is found in the cache."""
+
+
+class _CachedField:
+    """A descriptor implementing the behaviour of `AbstractHDFAnalysisResults.FieldDecorator`. Values loaded from file are stored in
+    `fieldCache` keyed by the file path, group name, modification time, and field name. Since cached values are shared the arrays are
+    read-only, copy them before modifying. If a value has been evicted from the cache it is loaded from file again. Deleting the attribute
+    removes it from the cache."""
+    def __init__(self, func):
+        self.func = _clearError(_getFromDict(func))
+        self.__doc__ = func.__doc__
+        self.__name__ = func.__name__
+
+    def _key(self, obj: AbstractHDFAnalysisResults) -> t_.Tuple:
+        return obj.file.file.filename, obj.file.name, obj._fileMtime, self.__name__
+
+    def __get__(self, obj: AbstractHDFAnalysisResults, cls):
+        if obj is None:
+            return self
+        if obj.file is None:  # Values provided in a dictionary are already in memory.
+            return self.func(obj)
+        key = self._key(obj)
+        value = fieldCache.get(key, _missing)
+        if value is _missing:
+            value = self.func(obj)
+            _setReadOnly(value)
+            fieldCache.put(key, value)
+        return value
+
+    def __delete__(self, obj: AbstractHDFAnalysisResults):
+        if obj.file is not None:
+            fieldCache.pop(self._key(obj))
+
+
+_missing = object()  # Used to detect cache misses since `None` is a valid field value.
+
+
+def _cropField(value: t_.Any, slc: t_.Tuple[slice, slice]) -> t_.Any:
+    """Select a (y, x) region from a field that is already in memory."""
+    from pwspy.dataTypes import ICBase
+    if isinstance(value, ICBase):
+        new = copy.copy(value)
+        new.data = value.data[slc]
+        return new
+    elif isinstance(value, np.ndarray):
+        return value[slc]
+    else:
+        return value
+
+
+class _CubeView:
+    """Indexing this object with (y, x) slices loads only that region of a data cube field from the HDF file. e.g.
+    `results.reflectanceView[100:200, 50:150]`"""
+    def __init__(self, results: AbstractHDFAnalysisResults, name: str):
+        self._results = results
+        self._name = name
+
+    @property
+    def shape(self) -> t_.Tuple[int, ...]:
+        """The shape of the full data cube."""
+        if self._results.file is None:
+            return getattr(self._results, self._name).data.shape
+        return self._results.file[self._name].shape
+
+    def __getitem__(self, slc: t_.Tuple[slice, slice]) -> ICBase:
+        if not isinstance(slc, tuple):
+            slc = (slc,)
+        if len(slc) != 2 or not all(isinstance(i, slice) for i in slc):
+            raise IndexError("Data cube views must be indexed by a slice for each of the y and x axes.")
+        if self._results.file is None:
+            return _cropField(getattr(self._results, self._name), slc)
+        return self._results._cubeFields()[self._name].fromHdfDataset(self._results.file[self._name], slc=slc)
+
+
 class AbstractHDFAnalysisResults(AbstractAnalysisResults):
     """
     This abstract class implements methods of `AbstractAnalysisResults` for an object that can be saved and loaded to/from an HDF file.
@@ -198,17 +305,25 @@ class AbstractHDFAnalysisResults(AbstractAnalysisResults):
     The constructor should not be run directly, it should only be used by the `create` and `load` class methods.
 
     Args:
-        file: To load from file provide the `h5py.File`.
+        file: To load from file provide the `h5py.File`, or the `h5py.Group` that the results were saved to.
         variablesDict: To create a new object from variables, provide a dictionary keyed by all the field names.
         analysisName: Optionally store the name of the analysis.
     """
+    class WriteStrategy(enum.Enum):
+        """The methods that `toHDF` can use to write the file."""
+        FileObject = enum.auto()  # Write through a Python file object using h5py's `fileobj` driver. Slow since every write goes through Python, but avoids errors writing from Windows to a Samba share.
+        LocalTemp = enum.auto()  # Write with the native HDF5 driver to a local temporary file, then copy it to the destination in one sequential write and rename it into place. Faster for network drives, but the file is written twice and the temporary folder must have room for it.
+
+    writeStrategy: WriteStrategy = WriteStrategy.FileObject  # The strategy used by `toHDF` when none is specified. Set to `LocalTemp` to opt in to writing through a temporary file.
+
     @staticmethod
     def FieldDecorator(func):
         """Decorate functions in subclasses that access their fields from the HDF file with this decorator. It will:
-        1: Make it so the data is load from disk on the first access and stored in memory for every further access.
+        1: Make it so the data is load from disk on the first access and kept in the process-wide `fieldCache` for further access.
+            The least recently used fields are discarded from the cache when it is full and are loaded from disk again if needed.
         2: Report an understandable error if the field isn't found in the HDF file.
         3: Make the accessors work even if the the object isn't associated with an HDF file."""
-        return cached_property(_clearError(_getFromDict(func)))
+        return _CachedField(func)
 
     #TODO this holds onto the reference to the h5py.File meaning that the file can't be deleted until the object has been deleted. Maybe that's good. but it causes some problems.
     def __init__(self, file: t_.Optional[h5py.File] = None, variablesDict: t_.Optional[dict] = None, analysisName: t_.Optional[str] = None):
@@ -217,6 +332,7 @@ class AbstractHDFAnalysisResults(AbstractAnalysisResults):
         elif variablesDict is not None:
             assert file is None
         self.file = file
+        self._fileMtime = os.stat(file.file.filename).st_mtime_ns if file is not None else None  # Part of the cache key so that cached fields of an overwritten file aren't used.
         self.dict = variablesDict
         self.analysisName = analysisName
 
@@ -225,6 +341,38 @@ class AbstractHDFAnalysisResults(AbstractAnalysisResults):
         """The version of PWSpy code that this file was saved with."""
         return bytes(np.array(self.file['pwspy_version'])).decode()
 
+    @staticmethod
+    def _cubeFields() -> t_.Dict[str, t_.Type[ICBase]]:
+        """Subclasses should override this to return the class used to load each field that is saved as a data cube. Used by `getField`."""
+        return {}
+
+    def getField(self, name: str, roi: t_.Optional[t_.Union[Roi, t_.Tuple[slice, slice]]] = None) -> t_.Any:
+        """
+        Access a field, optionally loading only the region of the image that contains an ROI. Only that region is read from
+        file so the cost is proportional to the area of the ROI rather than the full image.
+
+        Args:
+            name: The name of the field. See `fields`.
+            roi: If provided then only the region of the image given by `roi.boundingBox` is returned. Use `roi.croppedMask`
+                to select the pixels of the ROI from the returned value. A tuple of (y, x) slices can also be used to select the region.
+
+        Returns:
+            The value of the field. Either the full value or only the bounding box of `roi`.
+        """
+        if roi is None:
+            return getattr(self, name)
+        slc = roi if isinstance(roi, tuple) else roi.boundingBox
+        if self.file is None or (self.file.file.filename, self.file.name, self._fileMtime, name) in fieldCache:  # The full field is already in memory.
+            return _cropField(getattr(self, name), slc)
+        try:
+            dset = self.file[name]
+        except KeyError:
+            raise KeyError(f"The analysis file does not contain a {name} item.")
+        if name in self._cubeFields():
+            return self._cubeFields()[name].fromHdfDataset(dset, slc=slc)
+        else:
+            return dset[slc]
+
     @staticmethod
     @abstractmethod
     def fields() -> t_.Tuple[str, ...]:
@@ -260,7 +408,7 @@ class AbstractHDFAnalysisResults(AbstractAnalysisResults):
         """
         pass
 
-    def toHDF(self, directory: str, name: str, overwrite: bool = False, compression: str = None):
+    def toHDF(self, directory: str, name: str, overwrite: bool = False, compression: str = None, writeStrategy: t_.Optional[WriteStrategy] = None):
         """
         Save the AnalysisResults object to an HDF file in `directory`. The name of the file will be determined by `name`. If you want to know what the full file name
         will be you can use this class's `name2FileName` method.
@@ -270,33 +418,69 @@ class AbstractHDFAnalysisResults(AbstractAnalysisResults):
             name: The name of the analysis. This determines the file name.
             overwrite: If `True` then any existing file of the same name will be replaced.
             compression: The value of this argument will be passed to h5py.create_dataset for numpy arrays. See h5py documentation for available options.
+            writeStrategy: How the file should be written. If `None` then the class attribute `writeStrategy` is used. If writing
+                with `LocalTemp` fails then `FileObject` is used instead.
         """
-        from pwspy.dataTypes import ICBase  # Need this for instance checking
         fileName = osp.join(directory, self.name2FileName(name))
         if (not overwrite) and osp.exists(fileName):
             raise OSError(f'{fileName} already exists.')
+        writeStrategy = writeStrategy if writeStrategy is not None else self.writeStrategy
+        if writeStrategy is self.WriteStrategy.LocalTemp:
+            try:
+                self._writeLocalTemp(fileName, compression)
+                return
+            except OSError as e:
+                logging.getLogger(__name__).warning(f"Failed to save {fileName} through a temporary file, falling back to `FileObject`. {e}")
         with open(fileName, 'wb') as pythonFile:
             with h5py.File(pythonFile, 'w', driver='fileobj') as hf:  # Using the default driver causes write errors when writing from windows to a Samba shared server. Using a reference to a python `File Object` solves this issue.
-                # Save version
-                hf.create_dataset('pwspy_version', data=np.string_(self._currentmoduleversion))
-                # Save fields defined by implementing subclass
-                for field in self.fields():
-                    k = field
-                    v = getattr(self, field)
-                    if isinstance(v, AbstractAnalysisSettings):
-                        v = v.toJsonString() # Convert to string, then string case will then handle saving the string.
-                    elif isinstance(v, dict):  # Save as json. The str case will handle the actual saving.
-                        v = json.dumps(v)
-                    if isinstance(v, str):
-                        hf.create_dataset(k, data=np.string_(v))  # h5py recommends encoding strings this way for compatability.
-                    elif isinstance(v, ICBase):
-                        hf = v.toHdfDataset(hf, k, fixedPointCompression=True)
-                    elif isinstance(v, np.ndarray):
-                        hf.create_dataset(k, data=v, compression=compression)
-                    elif v is None:
-                        pass
-                    else:
-                        raise TypeError(f"Analysis results type {k}, {type(v)} not supported or expected")
+                self.toHdfGroup(hf, compression=compression)
+
+    def _writeLocalTemp(self, fileName: str, compression: str):
+        """Write the file with the native driver to the local temporary folder. The finished file is then copied next to `fileName`
+        with a single sequential write and renamed, so a partially written file never appears at `fileName`."""
+        fd, tempPath = tempfile.mkstemp(suffix='.h5')
+        os.close(fd)
+        partPath = fileName + '.part'
+        try:
+            with h5py.File(tempPath, 'w') as hf:
+                self.toHdfGroup(hf, compression=compression)
+            shutil.copyfile(tempPath, partPath)
+            os.replace(partPath, fileName)
+        finally:
+            for path in (tempPath, partPath):
+                if osp.exists(path):
+                    os.remove(path)
+
+    def toHdfGroup(self, g: h5py.Group, compression: str = None):
+        """
+        Save the fields of the AnalysisResults object into an HDF group. This is used by `toHDF` to save to a file of its own and
+        by `pwspy.dataTypes.AnalysisStore` to save to a group of a shared file.
+
+        Args:
+            g: The empty group to save into.
+            compression: The value of this argument will be passed to h5py.create_dataset for numpy arrays. See h5py documentation for available options.
+        """
+        from pwspy.dataTypes import ICBase  # Need this for instance checking
+        # Save version
+        g.create_dataset('pwspy_version', data=np.string_(self._currentmoduleversion))
+        # Save fields defined by implementing subclass
+        for field in self.fields():
+            k = field
+            v = getattr(self, field)
+            if isinstance(v, AbstractAnalysisSettings):
+                v = v.toJsonString() # Convert to string, then string case will then handle saving the string.
+            elif isinstance(v, dict):  # Save as json. The str case will handle the actual saving.
+                v = json.dumps(v)
+            if isinstance(v, str):
+                g.create_dataset(k, data=np.string_(v))  # h5py recommends encoding strings this way for compatability.
+            elif isinstance(v, ICBase):
+                g = v.toHdfDataset(g, k, fixedPointCompression=True)
+            elif isinstance(v, np.ndarray):
+                g.create_dataset(k, data=v, compression=compression)
+            elif v is None:
+                pass
+            else:
+                raise TypeError(f"Analysis results type {k}, {type(v)} not supported or expected")
 
     @classmethod
     def load(cls, directory: str, name: str) -> AbstractHDFAnalysisResults:
@@ -315,7 +499,7 @@ class AbstractHDFAnalysisResults(AbstractAnalysisResults):
         return cls(file, None, name)
 
     def __del__(self):
-        if self.file is not None:  # Make sure to release the file if it's still open.
+        if isinstance(self.file, h5py.File):  # Make sure to release the file if it's still open. Groups of an `AnalysisStore` file are left open for the store to close.
             try:
                 self.file.close()
             except:  # Sometimes when python is shutting down this causes an error. Doesn't matter though.
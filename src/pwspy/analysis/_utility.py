@@ -1,8 +1,13 @@
 from __future__ import annotations
+import copy
+import queue
+import threading as th
 import typing as t_
-import pandas as pd
-from pwspy.dataTypes import ICRawBase, MetaDataBase
-from pwspy.utility.fileIO import processParallel
+import numpy as np
+from pwspy.dataTypes import ICBase, ICRawBase, MetaDataBase
+from pwspy.utility.executors import Executor, LocalExecutor
+from pwspy.utility.fileIO import _estimateTaskBytes, _scheduleParallel
+from pwspy.utility.misc import toSharedMemory
 import logging
 if t_.TYPE_CHECKING:
     from pwspy.analysis import AbstractAnalysis, AbstractAnalysisResults
@@ -11,44 +16,235 @@ if t_.TYPE_CHECKING:
 
 class ParallelRunner:
     """
-    A utility class for Running an analysis on multiple images in parallel on multiple cores
+    A utility class for Running an analysis on multiple images in parallel on multiple cores. The pool of worker processes is
+    started the first time it is needed and is then kept alive so that repeated calls to `run` or `runAsCompleted` don't pay the
+    cost of starting new processes and sending the analysis (including the reference data) to them again. Call `close` (or use
+    the runner as a context manager) to shut down the processes once you are done.
+
+    The memory needed for each image is estimated from its dimensions. The largest images are started first and new images are only
+    started while the estimated memory of the images in progress fits within a fraction of the available RAM.
+
+    By default the images are processed on this machine. To spread the work across several machines provide a
+    `pwspy.utility.executors.SocketExecutor`. The analysis is sent once to each remote worker and, since the results can't be
+    returned through shared memory, remote workers only return the results if `saveName` is `None`. Otherwise the results are
+    saved to the `analyses` folder of each acquisition and the returned results are loaded from there.
 
     Args:
-        The analysis object to run.
+        analysis: The analysis object to run.
+        numProcesses: The number of worker processes to use. By default one less than the number of physical cores is used.
+        mpContext: The name of the `multiprocessing` start method to use ('fork', 'spawn', or 'forkserver'). If `None` then
+            the default of the platform is used.
+        memoryFraction: The fraction of the available RAM that the images being processed at the same time may use. Only used
+            if the executor runs on this machine.
+        executor: The backend used to run the analysis. If provided then `numProcesses` and `mpContext` are ignored.
+        writeBehind: If `True` then the worker processes don't save their results. Instead the results are queued to be saved by a
+            background thread of this process so that the workers can move on to the next image without waiting for the disk.
+            Each call to `run` or `runAsCompleted` waits for all of its results to be saved before finishing. Errors that occur
+            while saving are logged and stored in `writeErrors`. Only used if the executor runs on this machine.
+        maxQueuedWrites: The number of results that can wait to be saved when `writeBehind` is used. If the queue is full then
+            collecting more results waits for a result to be saved, limiting the memory used by results waiting to be saved.
+
+    Attributes:
+        writeErrors: A list of tuples of the metadata and the exception for each image whose results could not be saved by the
+            background writer during the most recent call to `run` or `runAsCompleted`.
     """
-    def __init__(self, analysis: AbstractAnalysis):
+    def __init__(self, analysis: AbstractAnalysis, numProcesses: t_.Optional[int] = None, mpContext: t_.Optional[str] = None,
+                 memoryFraction: float = 0.8, executor: t_.Optional[Executor] = None, writeBehind: bool = False, maxQueuedWrites: int = 4):
         self._analysis = analysis
-        analysis.copySharedDataToSharedMemory()
+        self._executor = executor if executor is not None else LocalExecutor(numProcesses, mpContext)
+        if self._executor.sharesMemory:
+            analysis.copySharedDataToSharedMemory()
+        self._memoryFraction = memoryFraction if self._executor.sharesMemory else None
+        self._started = False
+        self._writeBehind = writeBehind and self._executor.sharesMemory
+        self._maxQueuedWrites = maxQueuedWrites
+        self._writer: t_.Optional[_ResultWriter] = None
+        self.writeErrors: t_.List[t_.Tuple[MetaDataBase, Exception]] = []
 
-    def run(self, cubes: t_.List[t_.Union[MetaDataBase, ICRawBase]],
-                  saveName: t_.Optional[str] = None) -> t_.List[t_.Tuple[t_.List[AnalysisWarning, AbstractAnalysisResults, MetaDataBase]]]:
+    def _getExecutor(self) -> Executor:
+        if not self._started:
+            self._executor.start(self._initializer, (self._analysis, self._executor.sharesMemory))
+            self._started = True
+        return self._executor
+
+    def run(self, cubes: t_.Sequence[t_.Union[MetaDataBase, ICRawBase]],
+                  saveName: t_.Optional[str] = None) -> t_.List[t_.Tuple[t_.List[AnalysisWarning], AbstractAnalysisResults, MetaDataBase]]:
         """
         Run an analysis on several images in parallel.
 
         Args:
-            cubes: A list of either data objects or the associated metadata object.s
+            cubes: A list of either data objects or the associated metadata objects.
+            saveName: If this name is supplied then the analysis results will be saved under this name for each image.
+
+        Returns:
+            A list of tuples of (warnings, results, metadata) in the same order as `cubes`.
+        """
+        results = [None] * len(cubes)
+        try:
+            for i, ret in self._schedule(cubes, saveName):
+                results[i] = self._handleResult(ret, saveName)
+        finally:
+            self._flushWrites()
+        return results
+
+    def runAsCompleted(self, cubes: t_.Iterable[t_.Union[MetaDataBase, ICRawBase]],
+                       saveName: t_.Optional[str] = None) -> t_.Iterator[t_.Tuple[t_.List[AnalysisWarning], AbstractAnalysisResults, MetaDataBase]]:
+        """
+        Run an analysis on several images in parallel, yielding the results of each image as soon as it is finished.
+
+        Args:
+            cubes: An iterable of either data objects or the associated metadata objects.
             saveName: If this name is supplied then the analysis results will be saved under this name for each image.
+
+        Returns:
+            An iterator of tuples of (warnings, results, metadata) in the order that they were completed. The metadata can be
+            used to identify which image the results belong to.
         """
-        out = processParallel(pd.DataFrame({'cube': cubes}), processorFunc=self._process, initializer=self._initializer, initArgs=(self._analysis, saveName))
-        return out
+        try:
+            for i, ret in self._schedule(list(cubes), saveName):
+                yield self._handleResult(ret, saveName)
+        finally:
+            self._flushWrites()
+
+    def close(self):
+        """Shut down the worker processes and the background writer. If the runner is used again afterwards the executor is started again."""
+        if self._started:
+            self._executor.close()
+            self._started = False
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+    def __enter__(self) -> ParallelRunner:
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _schedule(self, cubes: t_.Sequence[t_.Union[MetaDataBase, ICRawBase]], saveName: t_.Optional[str]) -> t_.Iterator[t_.Tuple[int, t_.Any]]:
+        for cube in cubes:
+            if not isinstance(cube, (ICRawBase, MetaDataBase)):
+                raise TypeError(f"Cubes must be either a data object or a metadata object. Got {type(cube)}.")
+        costs = [_estimateTaskBytes(cube) for cube in cubes]
+        executor = self._getExecutor()
+        workerSaveName = None if self._writeBehind else saveName  # With write-behind the results are saved by this process instead.
+        self.writeErrors = []
+        return _scheduleParallel(executor, self._process, cubes, costs, self._memoryFraction,
+                                 prepare=lambda cube: (self._prepareTask(cube, workerSaveName, executor.sharesMemory),))
+
+    def _handleResult(self, ret: t_.Tuple[t_.List[AnalysisWarning], t_.Optional[AbstractAnalysisResults], MetaDataBase], saveName: t_.Optional[str]):
+        if self._writeBehind and saveName is not None:
+            if self._writer is None:
+                self._writer = _ResultWriter(self._maxQueuedWrites)
+            warnings, results, md = ret
+            self._writer.put(md, results, saveName)
+            return ret
+        return self._loadIfSaved(ret, saveName)
+
+    def _flushWrites(self):
+        """Wait for the background writer to save all queued results."""
+        if self._writer is not None:
+            self.writeErrors += self._writer.flush()
 
     @staticmethod
-    def _initializer(analysis: AbstractAnalysis, saveName: t_.Optional[str]):
+    def _prepareTask(cube: t_.Union[MetaDataBase, ICRawBase], saveName: t_.Optional[str], sharesMemory: bool):
+        if sharesMemory and isinstance(cube, ICRawBase):  # Send the data through shared memory rather than pickling it through a pipe.
+            cube = copy.copy(cube)  # Don't modify the object that was passed in.
+            cube.data = toSharedMemory(cube.data, transferOwnership=True)
+        return cube, saveName
+
+    @staticmethod
+    def _loadIfSaved(ret: t_.Tuple[t_.List[AnalysisWarning], t_.Optional[AbstractAnalysisResults], MetaDataBase], saveName: t_.Optional[str]):
+        warnings, results, md = ret
+        if results is None:  # A remote worker saved the results rather than sending them back.
+            results = md.loadAnalysis(saveName)
+        return warnings, results, md
+
+    @staticmethod
+    def _initializer(analysis: AbstractAnalysis, sharesMemory: bool):
         """This method is run once for each process that is spawned. it initialized _resources that are shared between each iteration of _process."""
         global pwspyAnalysisParallelGlobals
-        pwspyAnalysisParallelGlobals = {'analysis': analysis, 'saveName': saveName}
+        pwspyAnalysisParallelGlobals = {'analysis': analysis, 'sharesMemory': sharesMemory}
 
     @staticmethod
-    def _process(rowIndex: int, row: pd.Series):
+    def _process(task: t_.Tuple[t_.Union[MetaDataBase, ICRawBase], t_.Optional[str]]):
         """This method is run in parallel. once for each acquisition data that we want to analyze.
         Returns a list of AnalysisWarnings objects with the associated metadat object"""
         global pwspyAnalysisParallelGlobals
         analysis = pwspyAnalysisParallelGlobals['analysis']
-        saveName = pwspyAnalysisParallelGlobals['saveName']
-        im = row['cube']
+        im, saveName = task
         if isinstance(im, MetaDataBase):
             im = im.toDataClass(lock=None)
         results, warnings = analysis.run(im)
         if saveName is not None:
             im.metadata.saveAnalysis(results, saveName, overwrite=True)
-        return warnings, results, im.metadata
\ No newline at end of file
+        if pwspyAnalysisParallelGlobals['sharesMemory']:
+            _moveResultsToSharedMemory(results)
+        elif saveName is not None:
+            results = None  # Don't send the results over the network, they can be loaded from the file.
+        return warnings, results, im.metadata
+
+
+class _ResultWriter:
+    """Saves analysis results on a background thread. `put` blocks while `maxQueued` results are already waiting to be saved.
+
+    Args:
+        maxQueued: The maximum number of results waiting to be saved.
+    """
+    def __init__(self, maxQueued: int):
+        self._queue = queue.Queue(maxsize=maxQueued)
+        self._errors: t_.List[t_.Tuple[MetaDataBase, Exception]] = []
+        self._thread = th.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def put(self, md: MetaDataBase, results: AbstractAnalysisResults, saveName: str):
+        """Queue `results` to be saved as `saveName` for the acquisition of `md`."""
+        self._queue.put((md, results, saveName))
+
+    def flush(self) -> t_.List[t_.Tuple[MetaDataBase, Exception]]:
+        """Wait for all queued results to be saved.
+
+        Returns:
+            The metadata and the exception for each result that failed to save since the last flush.
+        """
+        self._queue.join()
+        errors, self._errors = self._errors, []
+        return errors
+
+    def close(self):
+        """Save any queued results and then stop the thread."""
+        self._queue.put(None)
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                md, results, saveName = item
+                try:
+                    md.saveAnalysis(results, saveName, overwrite=True)
+                except Exception as e:
+                    logging.getLogger(__name__).error(f"Failed to save the {saveName} analysis of {md.filePath}: {e}")
+                    self._errors.append((md, e))
+            finally:
+                self._queue.task_done()
+
+
+def _moveResultsToSharedMemory(results: AbstractAnalysisResults):
+    """Move the arrays of a newly created results object into shared memory. When the results are returned from a worker process
+    only the names of the memory blocks are pickled and the parent process takes ownership of the memory, avoiding the cost of
+    serializing the data and sending it through a pipe."""
+    from pwspy.analysis import AbstractHDFAnalysisResults
+    if not isinstance(results, AbstractHDFAnalysisResults) or results.dict is None:
+        return  # Only results created from variables are supported.
+    for k, v in results.dict.items():
+        if isinstance(v, ICBase):
+            v = copy.copy(v)  # Don't modify an object that may be referenced elsewhere.
+            v.data = toSharedMemory(v.data, transferOwnership=True)
+        elif isinstance(v, np.ndarray) and not v.dtype.hasobject:
+            v = toSharedMemory(v, transferOwnership=True)
+        else:
+            continue
+        results.dict[k] = v
@@ -46,14 +46,22 @@ Generic
     GenericRoiCompilationResults
     GenericRoiCompiler
 
+Experiment
+------------
+.. autosummary::
+    :toctree: generated/
+
+    compileExperiment
+
 """
 
 __all__ = ['DynamicsRoiCompiler', 'DynamicsRoiCompilationResults', 'DynamicsCompilerSettings',
            'PWSRoiCompiler', 'PWSRoiCompilationResults', 'PWSCompilerSettings', 'GenericRoiCompiler',
            'GenericRoiCompilationResults', 'GenericCompilerSettings', 'AbstractRoiCompilationResults',
-           'AbstractRoiCompiler', 'AbstractCompilerSettings']
+           'AbstractRoiCompiler', 'AbstractCompilerSettings', 'compileExperiment']
 
 from ._dynamics import DynamicsCompilerSettings, DynamicsRoiCompilationResults, DynamicsRoiCompiler
 from ._pws import PWSCompilerSettings, PWSRoiCompilationResults, PWSRoiCompiler
 from ._generic import GenericCompilerSettings, GenericRoiCompilationResults, GenericRoiCompiler
 from ._abstract import AbstractCompilerSettings, AbstractRoiCompilationResults, AbstractRoiCompiler
+from ._experiment import compileExperiment
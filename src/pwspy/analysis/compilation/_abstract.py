@@ -16,9 +16,13 @@
 # along with PWSpy.  If not, see <https://www.gnu.org/licenses/>.
 
 from __future__ import annotations
+import dataclasses
 from abc import ABC, abstractmethod
 from dataclasses import dataclass
-from typing import Tuple, List
+from typing import Tuple, List, Dict, Sequence, Optional
+
+import numpy as np
+from scipy import sparse
 
 from .. import AbstractAnalysisResults, warnings
 from ...dataTypes._other import Roi
@@ -43,6 +47,28 @@ class AbstractRoiCompiler(ABC):
         """
         pass
 
+    def runMany(self, results: AbstractAnalysisResults, rois: Sequence[Roi]) -> Tuple[Dict[str, list], List[List[warnings.AnalysisWarning]]]:
+        """Compile the results for several ROIs at once. Implementations override this to process all of the ROIs together, by default
+        `run` is called for each ROI.
+
+        Args:
+            results: The analysis results to compile.
+            rois: The ROIs to be used to segment out sections of the results.
+
+        Returns:
+            A dictionary with an entry for each field of the compilation results, each entry contains a sequence with the value for each
+                ROI. This can be passed directly to `pandas.DataFrame`. And a list of the warnings for each ROI.
+        """
+        columns, warns = None, []
+        for roi in rois:
+            result, roiWarns = self.run(results, roi)
+            if columns is None:
+                columns = {field.name: [] for field in dataclasses.fields(result)}
+            for k, v in columns.items():
+                v.append(getattr(result, k))
+            warns.append(roiWarns)
+        return columns if columns is not None else {}, warns
+
 
 class AbstractRoiCompilationResults(ABC):
     """The results produced by the compilation."""
@@ -55,4 +81,61 @@ class AbstractCompilerSettings(ABC):
     pass
 
 
+class _RoiIndex:
+    """Membership of the pixels of several ROIs, used to calculate the average of a field over every ROI at once. Only the region
+    of the image containing all of the ROIs is used. ROIs may overlap.
+
+    Args:
+        rois: The ROIs.
+
+    Attributes:
+        window: A tuple of (y, x) slices containing all of the ROIs. Fields should be loaded for this region only.
+        pixels: The flattened indices, within `window`, of the pixels that belong to at least one ROI.
+        membership: A sparse (number of ROIs x number of `pixels`) matrix with a 1 for each pixel that is part of each ROI.
+    """
+    def __init__(self, rois: Sequence[Roi]):
+        boxes = [roi.boundingBox for roi in rois if roi.croppedMask.size > 0]
+        if len(boxes) == 0:
+            self.window = (slice(0, 0), slice(0, 0))
+        else:
+            self.window = (slice(min(b[0].start for b in boxes), max(b[0].stop for b in boxes)),
+                           slice(min(b[1].start for b in boxes), max(b[1].stop for b in boxes)))
+        windowWidth = self.window[1].stop - self.window[1].start
+        roiPixels = []
+        for roi in rois:  # Convert the pixel coordinates within each bounding box to flat indices within the window.
+            y, x = np.nonzero(roi.croppedMask)
+            box = roi.boundingBox
+            roiPixels.append((y + box[0].start - self.window[0].start) * windowWidth + (x + box[1].start - self.window[1].start))
+        allPixels = np.concatenate(roiPixels + [np.zeros(0, dtype=np.intp)])
+        self.pixels = np.unique(allPixels)
+        rows = np.repeat(np.arange(len(rois)), [len(p) for p in roiPixels])
+        cols = np.searchsorted(self.pixels, allPixels)
+        self.membership = sparse.csr_matrix((np.ones(len(rows)), (rows, cols)), shape=(len(rois), len(self.pixels)))
+
+    def values(self, arr: np.ndarray) -> np.ndarray:
+        """Select the values of `pixels` from an array covering `window`. The first two axes of `arr` are flattened."""
+        return arr.reshape((-1,) + arr.shape[2:])[self.pixels]
+
+    def mean(self, arr: np.ndarray, condition: Optional[np.ndarray] = None) -> np.ndarray:
+        """The average of `arr` (covering `window`) over each ROI. If condition is provided then only values of arr where the condition
+        is satisfied are included. Additional axes of `arr` beyond the first two are kept."""
+        return self.meanOfValues(self.values(arr), None if condition is None else self.values(condition))
+
+    def meanOfValues(self, vals: np.ndarray, condition: Optional[np.ndarray] = None) -> np.ndarray:
+        """The same as `mean` but for values that have already been selected with `values`."""
+        vals = vals.astype(np.float64)
+        weights = np.ones(len(self.pixels)) if condition is None else condition.astype(np.float64)
+        if condition is not None:
+            vals[weights == 0] = 0  # Excluded values may be NaN, which would otherwise propagate through the sum.
+        weightedVals = vals * weights.reshape((-1,) + (1,) * (vals.ndim - 1))
+        sums = self.membership @ weightedVals
+        counts = self.membership @ weights
+        with np.errstate(divide='ignore', invalid='ignore'):  # Empty ROIs give NaN, like `np.mean` of an empty array.
+            return sums / counts.reshape((-1,) + (1,) * (sums.ndim - 1))
+
+    def roiValues(self, arr: np.ndarray, i: int) -> np.ndarray:
+        """The values of `arr` (covering `window`) within ROI number `i`."""
+        return self.values(arr)[self.membership[i].indices]
+
+
 __all__ = []
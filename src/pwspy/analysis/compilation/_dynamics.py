@@ -16,12 +16,13 @@
 # along with PWSpy.  If not, see <https://www.gnu.org/licenses/>.
 
 from __future__ import annotations
+import dataclasses
 from dataclasses import dataclass
-from typing import Tuple, List
+from typing import Tuple, List, Dict, Sequence
 
 import numpy as np
 
-from ._abstract import AbstractCompilerSettings, AbstractRoiCompilationResults, AbstractRoiCompiler
+from ._abstract import AbstractCompilerSettings, AbstractRoiCompilationResults, AbstractRoiCompiler, _RoiIndex
 from .. import warnings
 from ..dynamics import DynamicsAnalysisResults
 from ...dataTypes import Roi
@@ -50,9 +51,14 @@ class DynamicsRoiCompiler(AbstractRoiCompiler):
         super().__init__(settings)
 
     def run(self, results: DynamicsAnalysisResults, roi: Roi) -> Tuple[DynamicsRoiCompilationResults, List[warnings.AnalysisWarning]]:
-        reflectance = self._avgOverRoi(roi, results.meanReflectance) if self.settings.meanReflectance else None
-        rms_t_squared = self._avgOverRoi(roi, results.rms_t_squared) if self.settings.rms_t_squared else None  # Unlike with diffusion we should not have any nan values for rms_t. If we get nan then something is wrong with the analysis.
-        diffusion = self._avgOverRoi(roi, results.diffusion, np.logical_not(np.isnan(results.diffusion))) if self.settings.diffusion else None  # Don't include nan values in the average. Diffusion is expected to have many Nans due to low SNR.
+        mask = roi.croppedMask  # Only the bounding box of the ROI is loaded from each field.
+        reflectance = self._avgOverRoi(mask, results.getField('meanReflectance', roi)) if self.settings.meanReflectance else None
+        rms_t_squared = self._avgOverRoi(mask, results.getField('rms_t_squared', roi)) if self.settings.rms_t_squared else None  # Unlike with diffusion we should not have any nan values for rms_t. If we get nan then something is wrong with the analysis.
+        if self.settings.diffusion:
+            diffusionArr = results.getField('diffusion', roi)
+            diffusion = self._avgOverRoi(mask, diffusionArr, np.logical_not(np.isnan(diffusionArr)))  # Don't include nan values in the average. Diffusion is expected to have many Nans due to low SNR.
+        else:
+            diffusion = None
 
         results = DynamicsRoiCompilationResults(
                     cellIdTag=results.imCubeIdTag,
@@ -63,13 +69,37 @@ class DynamicsRoiCompiler(AbstractRoiCompiler):
         warns = []  # Strip None from warns list
         return results, warns
 
+    def runMany(self, results: DynamicsAnalysisResults, rois: Sequence[Roi]) -> Tuple[Dict[str, Sequence], List[List[warnings.AnalysisWarning]]]:
+        """Compile the results for several ROIs at once. Each field is loaded once for the region containing all of the ROIs and
+        the averages for every ROI are calculated together.
+
+        Args:
+            results: The analysis results to compile.
+            rois: The ROIs to be used to segment out sections of the results.
+
+        Returns:
+            A dictionary keyed by the fields of `DynamicsRoiCompilationResults`, each entry contains a sequence with the value for each
+                ROI. This can be passed directly to `pandas.DataFrame`. And a list of the warnings for each ROI.
+        """
+        index = _RoiIndex(rois)
+        n = len(rois)
+        columns = {'cellIdTag': [results.imCubeIdTag] * n, 'analysisName': [results.analysisName] * n}
+        columns['reflectance'] = index.mean(results.getField('meanReflectance', index.window)) if self.settings.meanReflectance else [None] * n
+        columns['rms_t_squared'] = index.mean(results.getField('rms_t_squared', index.window)) if self.settings.rms_t_squared else [None] * n
+        if self.settings.diffusion:
+            diffusion = results.getField('diffusion', index.window)
+            columns['diffusion'] = index.mean(diffusion, np.logical_not(np.isnan(diffusion)))  # Don't include nan values in the average.
+        else:
+            columns['diffusion'] = [None] * n
+        return {field.name: columns[field.name] for field in dataclasses.fields(DynamicsRoiCompilationResults)}, [[] for i in range(n)]
+
     @staticmethod
-    def _avgOverRoi(roi: Roi, arr: np.ndarray, condition: np.ndarray = None) -> float:
-        """Returns the average of arr over the ROI.
+    def _avgOverRoi(mask: np.ndarray, arr: np.ndarray, condition: np.ndarray = None) -> float:
+        """Returns the average of arr over the boolean mask of an ROI.
         if condition is provided then only value of arr where the condition is satisfied are included."""
         assert len(arr.shape) == 2
         if condition is not None:
-            return arr[np.logical_and(roi.mask, condition)].mean()
+            return arr[np.logical_and(mask, condition)].mean()
         else:
-            return arr[roi.mask].mean()
+            return arr[mask].mean()
 
@@ -0,0 +1,308 @@
+# Copyright 2018-2020 Nick Anthony, Backman Biophotonics Lab, Northwestern University
+#
+# This file is part of PWSpy.
+#
+# PWSpy is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PWSpy is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with PWSpy.  If not, see <https://www.gnu.org/licenses/>.
+
+from __future__ import annotations
+import dataclasses
+import hashlib
+import json
+import logging
+import os
+import time
+import typing as t_
+
+import h5py
+import numpy as np
+import pandas as pd
+
+from ._abstract import AbstractCompilerSettings, AbstractRoiCompiler
+from ._dynamics import DynamicsCompilerSettings, DynamicsRoiCompiler
+from ._pws import PWSCompilerSettings, PWSRoiCompiler
+from ...dataTypes import Acquisition, AnalysisStore
+from ...dataTypes._other import RoiFile
+from ...utility.fileIO import processParallel
+from ...utility.misc import _fileFingerprint
+
+if t_.TYPE_CHECKING:
+    from .._abstract import AbstractHDFAnalysisResults
+
+
+def _getCompilerType(settings: AbstractCompilerSettings) -> t_.Tuple[str, t_.Type[AbstractHDFAnalysisResults], t_.Type[AbstractRoiCompiler]]:
+    """Return the name of the acquisition subfolder, the results class, and the compiler class associated with `settings`."""
+    from ..pws import PWSAnalysisResults
+    from ..dynamics import DynamicsAnalysisResults
+    if isinstance(settings, PWSCompilerSettings):
+        return 'PWS', PWSAnalysisResults, PWSRoiCompiler
+    elif isinstance(settings, DynamicsCompilerSettings):
+        return 'Dynamics', DynamicsAnalysisResults, DynamicsRoiCompiler
+    else:
+        raise TypeError(f"Compilation of {type(settings)} is not supported.")
+
+
+def _findAnalyses(root: str, resultsClass: t_.Type[AbstractHDFAnalysisResults], analysisName: str, subFolder: str,
+                  store: t_.Optional[AnalysisStore] = None) -> pd.DataFrame:
+    """Walk `root` once to find every acquisition with an analysis named `analysisName`. The names of the files in each
+    acquisition folder are kept so that ROIs can be found without listing the folder again. If `store` is provided then acquisitions
+    whose analysis is saved in the store are found as well, the store takes precedence over the `analyses` folder in the same way
+    as it does for `AnalysisManager.loadAnalysis`. These rows have the path of the store file in the `storePath` column."""
+    analysisFileName = resultsClass.name2FileName(analysisName)
+    fileNamesByDir = {}
+    found = []
+    inStore = set()  # Metadata folders whose analysis was found in the store.
+    for dirPath, dirNames, fileNames in os.walk(root):
+        dirNames.sort()  # Walk in a consistent order.
+        fileNamesByDir[dirPath] = fileNames
+        if store is not None and dirPath != store.root and store.hasAnalysis(dirPath, resultsClass, analysisName):
+            inStore.add(dirPath)
+            found.append((_acquisitionDir(dirPath, subFolder), os.path.join(dirPath, 'analyses'), store.filePath))
+        elif os.path.basename(dirPath) == 'analyses' and analysisFileName in fileNames and os.path.dirname(dirPath) not in inStore:
+            found.append((_acquisitionDir(os.path.dirname(dirPath), subFolder), dirPath, None))
+    return pd.DataFrame({'acquisitionPath': [i[0] for i in found],
+                         'analysesPath': [i[1] for i in found],
+                         'storePath': pd.Series([i[2] for i in found], dtype=object),
+                         'fileNames': [fileNamesByDir.get(i[0], []) for i in found]})  # Parent folders are always walked before their children.
+
+
+def _acquisitionDir(metadataDir: str, subFolder: str) -> str:
+    """The acquisition folder of the metadata folder that analyses are saved for."""
+    # Analyses are normally saved in the `PWS` or `Dynamics` folder of an acquisition. Some old data was saved directly in the acquisition folder.
+    return os.path.dirname(metadataDir) if os.path.basename(metadataDir) == subFolder else metadataDir
+
+
+def _settingsHash(settings: AbstractCompilerSettings) -> str:
+    """A hash of the compiler settings. Rows compiled with different settings must be recompiled."""
+    s = json.dumps({'type': type(settings).__name__, **dataclasses.asdict(settings)}, sort_keys=True)
+    return hashlib.sha1(s.encode()).hexdigest()
+
+
+def _roiFilePath(directory: str, name: str, number: int, fformat: RoiFile.FileFormats) -> str:
+    """The path to the file that an ROI found by `RoiFile.getValidRoisInPath` is stored in."""
+    if fformat is RoiFile.FileFormats.MAT:
+        return os.path.join(directory, f"BW{number}_{name}.mat")
+    else:
+        return os.path.join(directory, f"ROI_{name}.h5")
+
+
+def _compileAcquisition(index: int, row: pd.Series, analysisName: str, roiNames: t_.Optional[t_.Sequence[str]], settings: AbstractCompilerSettings,
+                        settingsHash: str) -> pd.DataFrame:
+    """Compile all of the ROIs of a single acquisition. This is run in parallel, once for each acquisition. ROIs that have a row in
+    `row['previous']` with matching fingerprints are not compiled again, the previous row is used instead. If the acquisition
+    can't be compiled then the rows of `row['previous']` are returned unchanged.
+
+    Analyses saved in an `AnalysisStore` can only be loaded by the process that opened the store, these rows must not be run in
+    parallel. Any change to the store file causes its rows to be compiled again since the analyses of the store share one fingerprint."""
+    subFolder, resultsClass, compilerClass = _getCompilerType(settings)
+    previous = {(prev['roiName'], prev['roiNumber']): prev for prev in row['previous']}
+    try:
+        startTime = time.time()
+        acq = Acquisition(row['acquisitionPath'])
+        if row['storePath'] is None:
+            analysisFingerprint = _fileFingerprint(os.path.join(row['analysesPath'], resultsClass.name2FileName(analysisName)))
+        else:
+            analysisFingerprint = _fileFingerprint(row['storePath'])
+        roiSpecs = [spec for spec in RoiFile.getValidRoisInPath(acq.filePath, row['fileNames']) if roiNames is None or spec[0] in roiNames]
+        records = []  # A record for each ROI, `None` for ROIs that need to be compiled.
+        toCompile = []  # Tuples of the index in `records`, the ROI spec, and the fingerprint of the ROI file.
+        for spec in roiSpecs:
+            roiFingerprint = _fileFingerprint(_roiFilePath(acq.filePath, *spec))
+            prev = previous.get((spec[0], spec[1]))
+            if prev is not None and (prev['analysisFingerprint'], prev['roiFingerprint'], prev['settingsHash']) == (analysisFingerprint, roiFingerprint, settingsHash):
+                records.append(prev)
+            else:
+                toCompile.append((len(records), spec, roiFingerprint))
+                records.append(None)
+        if len(toCompile) > 0:
+            if row['storePath'] is None:
+                results = resultsClass.load(row['analysesPath'], analysisName)
+            else:
+                metadataDir = os.path.dirname(row['analysesPath'])
+                results = AnalysisStore.find(metadataDir).loadAnalysis(metadataDir, resultsClass, analysisName)
+            loaded = RoiFile.loadAllFromPath(acq.filePath, names={spec[0] for _, spec, _ in toCompile}, fileNames=row['fileNames'], acquisition=acq)
+            loaded = {(roiFile.name, roiFile.number, roiFile.fformat): roiFile for roiFile in loaded}
+            roiFiles = [loaded[spec] for _, spec, _ in toCompile]
+            loadTime = time.time()
+            columns, warns = compilerClass(settings).runMany(results, [roiFile.getRoi() for roiFile in roiFiles])
+            compileTime = time.time()
+    except Exception as e:
+        logging.getLogger(__name__).warning(f"Failed to compile {row['acquisitionPath']}, previously compiled rows are kept: {e}")
+        return pd.DataFrame.from_records(row['previous'])
+    if len(toCompile) > 0:
+        try:
+            cellNumber = acq.getNumber()
+        except ValueError:  # The folder name doesn't follow the `Cell{x}` convention.
+            cellNumber = None
+        df = pd.DataFrame({
+            'acquisitionPath': acq.filePath,
+            'cellNumber': cellNumber,
+            'roiName': [roiFile.name for roiFile in roiFiles],
+            'roiNumber': [roiFile.number for roiFile in roiFiles],
+            **columns,
+            'warnings': ['; '.join(w.shortMsg for w in roiWarns) for roiWarns in warns],
+            'loadSeconds': loadTime - startTime,  # The time taken to load the analysis results and ROIs of the acquisition
+            'compileSeconds': compileTime - loadTime,  # The time taken to compile the ROIs of the acquisition
+            'analysisFingerprint': analysisFingerprint,
+            'roiFingerprint': [fingerprint for _, _, fingerprint in toCompile],
+            'settingsHash': settingsHash
+        }, index=range(len(roiFiles)))
+        for (i, _, _), record in zip(toCompile, df.to_dict('records')):
+            records[i] = record
+    return pd.DataFrame.from_records(records)
+
+
+def _readTable(path: str) -> pd.DataFrame:
+    """Load a table saved by `_writeTable`."""
+    ext = os.path.splitext(path)[1].lower()
+    if ext == '.parquet':
+        return pd.read_parquet(path)
+    elif ext in ('.h5', '.hdf5'):
+        columns = {}
+        with h5py.File(path, 'r') as hf:
+            g = hf['compilation']
+            missing = g['missing'] if 'missing' in g else {}
+            for c in g.attrs.get('columns', list(g.keys())):
+                dset = g[c]
+                if dset.dtype.kind == 'O':  # Strings
+                    columns[c] = dset.asstr()[()].tolist()
+                elif dset.ndim > 1:  # Arrays
+                    columns[c] = list(dset[()])
+                else:
+                    columns[c] = dset[()]
+                if c in missing:
+                    columns[c] = pd.Series([None if isNone else v for v, isNone in zip(np.asarray(columns[c]).tolist(), missing[c][()])], dtype=object)
+        return pd.DataFrame(columns)
+    elif ext == '.csv':
+        df = pd.read_csv(path, float_precision='round_trip', keep_default_na=False, na_values=['NaN'])  # Empty fields are empty strings.
+        for c in df.columns:
+            if df[c].isnull().all():  # Columns of values that weren't compiled
+                df[c] = pd.Series([None] * len(df), index=df.index, dtype=object)
+        return df
+    else:
+        raise ValueError(f"The output file type {ext} is not supported. Use `.parquet`, `.h5`, or `.csv`.")
+
+
+def _writeTable(df: pd.DataFrame, outputPath: str):
+    """Save the compiled table. The format is chosen by the file extension."""
+    ext = os.path.splitext(outputPath)[1].lower()
+    arrayColumns = [c for c in df.columns if any(isinstance(v, np.ndarray) for v in df[c])]
+    if ext == '.parquet':
+        df.to_parquet(outputPath, index=False)  # Requires `pyarrow`
+    elif ext in ('.h5', '.hdf5'):
+        with h5py.File(outputPath, 'w') as hf:  # Each column is saved as a dataset of the `compilation` group.
+            g = hf.create_group('compilation')
+            g.attrs['columns'] = [c for c in df.columns if not (c in arrayColumns and df[c].isnull().any())]  # Preserves the column order.
+            missing = g.create_group('missing')  # A mask of the `None` values of each column that has any.
+            for c in df.columns:
+                values = df[c]
+                if c in arrayColumns:
+                    if values.isnull().any():
+                        continue  # Array values are missing for some ROIs, can't be saved as a 2D dataset.
+                    g.create_dataset(c, data=np.stack(values.to_list()))
+                elif values.dtype == object:
+                    isNone = np.array([v is None for v in values], dtype=bool)
+                    present = np.array([v for v in values if v is not None])
+                    if present.dtype.kind in 'biuf':  # Numbers, the `None` values are saved as zeros and restored from the mask.
+                        data = np.zeros(len(values), dtype=present.dtype)
+                        data[~isNone] = present
+                    else:
+                        data = np.array([str(v) if v is not None else '' for v in values], dtype=h5py.string_dtype())
+                    g.create_dataset(c, data=data)
+                    if isNone.any():
+                        missing.create_dataset(c, data=isNone)
+                else:
+                    g.create_dataset(c, data=values.to_numpy())
+    elif ext == '.csv':
+        df.drop(columns=arrayColumns).to_csv(outputPath, index=False, na_rep='NaN')  # Empty strings are saved as empty fields.
+    else:
+        raise ValueError(f"The output file type {ext} is not supported. Use `.parquet`, `.h5`, or `.csv`.")
+
+
+def compileExperiment(root: str, analysisName: str, roiNames: t_.Optional[t_.Sequence[str]], settings: AbstractCompilerSettings,
+                      outputPath: t_.Optional[str] = None, numProcesses: t_.Optional[int] = None, incremental: bool = True) -> pd.DataFrame:
+    """
+    Compile the analysis results of every acquisition in an experiment. The folder is searched once for acquisitions with the
+    analysis, then each acquisition's analysis file and ROIs are loaded once and all ROIs are compiled together using
+    `AbstractRoiCompiler.runMany`. Acquisitions are processed in parallel.
+
+    Each row records fingerprints of the analysis file and ROI file it was compiled from and a hash of the compiler settings. When
+    `incremental` is `True` and `outputPath` already exists, rows of the existing table whose fingerprints still match are reused and
+    only ROIs that are new or whose analysis, ROI file, or settings have changed are compiled again.
+
+    Analyses saved in an `AnalysisStore` are compiled as well if the store is open or is saved in `root` with the default file name.
+    These acquisitions are compiled in this process, one at a time, after the rest of the acquisitions are compiled in parallel.
+
+    Args:
+        root: The folder containing the acquisitions. Subfolders are searched as well.
+        analysisName: The name of the analysis to compile.
+        roiNames: The names of the ROIs to compile. If `None` then all ROIs are compiled.
+        settings: The settings for the compiler. `PWSCompilerSettings` or `DynamicsCompilerSettings` determines whether PWS or
+            Dynamics analysis results are compiled.
+        outputPath: If provided the table is saved to this file. The format is chosen by the file extension: `.parquet` (requires
+            `pyarrow`), `.h5` (a group of column datasets), or `.csv`. Array valued columns, such as `opd`, are not saved to csv.
+        numProcesses: The number of processes to use. By default one less than the number of physical cores.
+        incremental: If `True` then rows of the existing table at `outputPath` are reused where possible. Because csv files don't
+            include array valued columns these columns will be missing from reused rows. csv files also can't tell `None` from `NaN`,
+            `None` values of columns that also have numbers are reused as `NaN`.
+
+    Returns:
+        A table with a row for each ROI. Along with the compiled values the table includes the acquisition path, cell number, ROI
+        name and number, warnings, the time taken to load (`loadSeconds`) and compile (`compileSeconds`) each acquisition, and
+        the fingerprints (`analysisFingerprint`, `roiFingerprint`, `settingsHash`) used for incremental compilation.
+    """
+    subFolder, resultsClass, compilerClass = _getCompilerType(settings)
+    root = os.path.abspath(root)
+    store = AnalysisStore.find(os.path.join(root, AnalysisStore.defaultFileName))  # An open store whose root folder is, or contains, `root`.
+    ownsStore = store is None and os.path.exists(os.path.join(root, AnalysisStore.defaultFileName))
+    if ownsStore:
+        try:
+            store = AnalysisStore.open(root, readOnly=True)
+        except OSError as e:  # E.g. the store is open for writing by another process.
+            logging.getLogger(__name__).warning(f"Failed to open the analysis store of {root}, analyses in the store will not be compiled. {e}")
+            store, ownsStore = None, False
+    try:
+        return _compileExperiment(root, analysisName, roiNames, settings, outputPath, numProcesses, incremental, store)
+    finally:
+        if ownsStore:
+            store.close()
+
+
+def _compileExperiment(root: str, analysisName: str, roiNames: t_.Optional[t_.Sequence[str]], settings: AbstractCompilerSettings,
+                       outputPath: t_.Optional[str], numProcesses: t_.Optional[int], incremental: bool, store: t_.Optional[AnalysisStore]) -> pd.DataFrame:
+    subFolder, resultsClass, compilerClass = _getCompilerType(settings)
+    acquisitions = _findAnalyses(root, resultsClass, analysisName, subFolder, store)
+    previous = {}  # Records of the previous table keyed by acquisition path
+    if incremental and outputPath is not None and os.path.exists(outputPath):
+        try:
+            prevTable = _readTable(outputPath)
+        except Exception as e:
+            logging.getLogger(__name__).warning(f"Failed to load the previous compilation from {outputPath}, everything will be compiled. {e}")
+        else:
+            if 'settingsHash' in prevTable.columns:  # Tables from before fingerprints were added can't be reused.
+                for path, group in prevTable.groupby('acquisitionPath', sort=False):
+                    previous[path] = group.to_dict('records')
+    acquisitions['previous'] = pd.Series([previous.get(path, []) for path in acquisitions['acquisitionPath']], index=acquisitions.index, dtype=object)
+    procArgs = (analysisName, roiNames, settings, _settingsHash(settings))
+    inStore = acquisitions['storePath'].notnull()
+    frames = {}  # The compiled frame of each acquisition keyed by the index of `acquisitions`.
+    if (~inStore).any():
+        parallel = acquisitions[~inStore]
+        frames.update(zip(parallel.index, processParallel(parallel, _compileAcquisition, procArgs=procArgs, numProcesses=numProcesses)))
+    for i, row in acquisitions[inStore].iterrows():  # The store can't be used by the worker processes.
+        frames[i] = _compileAcquisition(i, row, *procArgs)
+    frames = [frames[i] for i in acquisitions.index if len(frames[i]) > 0]
+    df = pd.concat(frames, ignore_index=True) if len(frames) > 0 else pd.DataFrame()
+    if outputPath is not None:
+        _writeTable(df, outputPath)
+    return df
@@ -16,13 +16,14 @@
 # along with PWSpy.  If not, see <https://www.gnu.org/licenses/>.
 
 from __future__ import annotations
+import dataclasses
 from dataclasses import dataclass
 import typing as t_
 import numpy as np
 
-from ._abstract import AbstractCompilerSettings, AbstractRoiCompilationResults, AbstractRoiCompiler
+from ._abstract import AbstractCompilerSettings, AbstractRoiCompilationResults, AbstractRoiCompiler, _RoiIndex
 from .. import warnings
-from ...dataTypes import Roi
+from ...dataTypes import Roi, KCube
 from ...dataTypes._other import RoiFile
 
 if t_.TYPE_CHECKING:
@@ -67,11 +68,12 @@ class PWSRoiCompiler(AbstractRoiCompiler):
 
     def run(self, results: PWSAnalysisResults, roi: Roi) -> t_.Tuple[PWSRoiCompilationResults, t_.List[warnings.AnalysisWarning]]:
         warns = []
-        reflectance = self._avgOverRoi(roi, results.meanReflectance) if self.settings.reflectance else None
-        rms = self._avgOverRoi(roi, results.rms) if self.settings.rms else None
+        mask = roi.croppedMask  # Only the bounding box of the ROI is loaded from each field.
+        reflectance = self._avgOverRoi(mask, results.getField('meanReflectance', roi)) if self.settings.reflectance else None
+        rms = self._avgOverRoi(mask, results.getField('rms', roi)) if self.settings.rms else None
         if self.settings.polynomialRms:
             try:
-                polynomialRms = self._avgOverRoi(roi, results.polynomialRms)
+                polynomialRms = self._avgOverRoi(mask, results.getField('polynomialRms', roi))
             except KeyError:
                 polynomialRms = None
         else:
@@ -79,9 +81,10 @@ class PWSRoiCompiler(AbstractRoiCompiler):
 
         if self.settings.autoCorrelationSlope:
             try:
-                autoCorrelationSlope = self._avgOverRoi(roi, results.autoCorrelationSlope,
-                    condition=np.logical_and(results.rSquared > 0.9,
-                        results.autoCorrelationSlope < 0))
+                acSlope = results.getField('autoCorrelationSlope', roi)
+                autoCorrelationSlope = self._avgOverRoi(mask, acSlope,
+                    condition=np.logical_and(results.getField('rSquared', roi) > 0.9,
+                        acSlope < 0))
             except KeyError:
                 autoCorrelationSlope = None
         else:
@@ -89,8 +92,9 @@ class PWSRoiCompiler(AbstractRoiCompiler):
 
         if self.settings.rSquared:
             try:
-                warns.append(warnings.checkRSquared(results.rSquared[roi.mask]))
-                rSquared = self._avgOverRoi(roi, results.rSquared)
+                rSquaredArr = results.getField('rSquared', roi)
+                warns.append(warnings.checkRSquared(rSquaredArr[mask]))
+                rSquared = self._avgOverRoi(mask, rSquaredArr)
             except KeyError:
                 rSquared = None
         else:
@@ -98,7 +102,7 @@ class PWSRoiCompiler(AbstractRoiCompiler):
 
         if self.settings.ld:
             try:
-                ld = self._avgOverRoi(roi, results.ld)
+                ld = self._avgOverRoi(mask, results.getField('ld', roi))
             except KeyError:
                 ld = None
         else:
@@ -106,8 +110,8 @@ class PWSRoiCompiler(AbstractRoiCompiler):
 
         if self.settings.opd:
             try:
-                opd, opdIndex = results.opd
-                opd = opd[roi.mask].mean(axis=0)
+                opd, opdIndex = results.getField('opd', roi)
+                opd = opd[mask].mean(axis=0)
             except KeyError:
                 opd = opdIndex = None
         else:
@@ -115,9 +119,9 @@ class PWSRoiCompiler(AbstractRoiCompiler):
 
         if self.settings.meanSigmaRatio:
             try:
-                spectra = results.reflectance.getMeanSpectra(roi)[0]
+                spectra = results.getField('reflectance', roi).getMeanSpectra(mask)[0]
                 meanRms = spectra.std()
-                varRatio = meanRms**2 / (results.rms[roi.mask] ** 2).mean()
+                varRatio = meanRms**2 / (results.getField('rms', roi)[mask] ** 2).mean()
                 warns.append(warnings.checkMeanSpectraRatio(varRatio))
             except KeyError:
                 varRatio = None
@@ -139,12 +143,84 @@ class PWSRoiCompiler(AbstractRoiCompiler):
         warns = [w for w in warns if w is not None]  # Strip None from warns list
         return results, warns
 
+    def runMany(self, results: PWSAnalysisResults, rois: t_.Sequence[Roi]) -> t_.Tuple[t_.Dict[str, t_.Sequence], t_.List[t_.List[warnings.AnalysisWarning]]]:
+        """Compile the results for several ROIs at once. Each field is loaded once for the region containing all of the ROIs and
+        the averages for every ROI are calculated together. The saved `opd` is used if the results have one, the same as `run`,
+        otherwise `opd` is only calculated for pixels that are part of an ROI.
+
+        Args:
+            results: The analysis results to compile.
+            rois: The ROIs to be used to segment out sections of the results.
+
+        Returns:
+            A dictionary keyed by the fields of `PWSRoiCompilationResults`, each entry contains a sequence with the value for each
+                ROI. This can be passed directly to `pandas.DataFrame`. And a list of the warnings for each ROI.
+        """
+        index = _RoiIndex(rois)
+        n = len(rois)
+        warns = [[] for i in range(n)]
+        columns = {'cellIdTag': [results.imCubeIdTag] * n, 'analysisName': [results.analysisName] * n}
+
+        def average(name: str, enabled: bool, condition: t_.Callable[[np.ndarray], np.ndarray] = None):
+            """Average a field over each ROI. Returns `None` for each ROI if the field is not enabled or not in the results."""
+            if not enabled:
+                return [None] * n
+            try:
+                arr = results.getField(name, index.window)
+            except KeyError:
+                return [None] * n
+            return index.mean(arr, condition(arr) if condition is not None else None)
+
+        columns['reflectance'] = average('meanReflectance', self.settings.reflectance)
+        columns['rms'] = average('rms', self.settings.rms)
+        columns['polynomialRms'] = average('polynomialRms', self.settings.polynomialRms)
+        columns['autoCorrelationSlope'] = average('autoCorrelationSlope', self.settings.autoCorrelationSlope,
+                                                  condition=lambda arr: np.logical_and(results.getField('rSquared', index.window) > 0.9, arr < 0))
+        columns['rSquared'] = [None] * n
+        if self.settings.rSquared:
+            try:
+                rSquared = results.getField('rSquared', index.window)
+                columns['rSquared'] = index.mean(rSquared)
+                for i in range(n):
+                    warns[i].append(warnings.checkRSquared(index.roiValues(rSquared, i)))
+            except KeyError:
+                pass
+        columns['ld'] = average('ld', self.settings.ld)
+
+        columns['opd'] = columns['opdIndex'] = columns['varRatio'] = [None] * n
+        calculateOpd = self.settings.opd
+        if self.settings.opd and ('opd' in results.file if results.file is not None else results.dict.get('opd') is not None):
+            opd, opdIndex = results.getField('opd', index.window)  # Use the saved OPD rather than calculating the FFT.
+            columns['opd'] = list(index.mean(opd).astype(opd.dtype))
+            columns['opdIndex'] = [opdIndex] * n
+            calculateOpd = False
+        if calculateOpd or self.settings.meanSigmaRatio:
+            try:
+                cube = results.getField('reflectance', index.window)
+            except KeyError:
+                cube = None
+            if cube is not None:
+                spectra = index.values(cube.data)  # The spectra of only the pixels that are part of an ROI.
+                if calculateOpd:
+                    roiCube = KCube(spectra[None, :, :], cube.wavenumbers, metadata=cube.metadata)
+                    opd, opdIndex = roiCube.getOpd(useHannWindow=False, indexOpdStop=100)
+                    columns['opd'] = list(index.meanOfValues(opd[0]).astype(opd.dtype))
+                    columns['opdIndex'] = [opdIndex] * n
+                if self.settings.meanSigmaRatio:
+                    meanRms = index.meanOfValues(spectra).std(axis=1)
+                    columns['varRatio'] = meanRms ** 2 / index.mean(results.getField('rms', index.window) ** 2)
+                    for i in range(n):
+                        warns[i].append(warnings.checkMeanSpectraRatio(columns['varRatio'][i]))
+
+        warns = [[w for w in roiWarns if w is not None] for roiWarns in warns]  # Strip None from warns lists
+        return {field.name: columns[field.name] for field in dataclasses.fields(PWSRoiCompilationResults)}, warns
+
     @staticmethod
-    def _avgOverRoi(roi: Roi, arr: np.ndarray, condition: np.ndarray = None) -> float:
-        """Returns the average of arr over the ROI.
+    def _avgOverRoi(mask: np.ndarray, arr: np.ndarray, condition: np.ndarray = None) -> float:
+        """Returns the average of arr over the boolean mask of an ROI.
         if condition is provided then only value of arr where the condition is satisfied are included."""
         assert len(arr.shape) == 2
         if condition is not None:
-            return arr[np.logical_and(roi.mask, condition)].mean()
+            return arr[np.logical_and(mask, condition)].mean()
         else:
-            return arr[roi.mask].mean()
+            return arr[mask].mean()
@@ -43,12 +43,13 @@ from datetime import datetime
 import numpy as np
 import pandas as pd
 from numpy import ma
-import multiprocessing as mp
 import typing as t_
 from . import AbstractAnalysis, warnings, AbstractAnalysisSettings, AbstractHDFAnalysisResults
+from ._abstract import _CubeView
 from pwspy import dateTimeFormat
 import pwspy.dataTypes as pwsdt
 from pwspy.utility.reflection import reflectanceHelper, Material
+from pwspy.utility.misc import toSharedMemory
 
 __all__ = ['DynamicsAnalysis', 'DynamicsAnalysisSettings', 'DynamicsAnalysisResults']
 
@@ -178,21 +179,10 @@ class DynamicsAnalysis(AbstractAnalysis):
         return Slope
 
     def copySharedDataToSharedMemory(self): # Inherit docstring
-        refdata = mp.RawArray('f', self.refAc.size)
-        refdata = np.frombuffer(refdata, dtype=np.float32).reshape(self.refAc.shape)
-        np.copyto(refdata, self.refAc)
-        self.refAc = refdata
-
-        refmdata = mp.RawArray('f', self.refMean.size)
-        refmdata = np.frombuffer(refmdata, dtype=np.float32).reshape(self.refMean.shape)
-        np.copyto(refmdata, self.refMean)
-        self.refMean = refmdata
-
+        self.refAc = toSharedMemory(self.refAc)  # Only the name of the memory block is sent to each process.
+        self.refMean = toSharedMemory(self.refMean)
         if self.extraReflection is not None:
-            iedata = mp.RawArray('f', self.extraReflection.size)
-            iedata = np.frombuffer(iedata, dtype=np.float32).reshape(self.extraReflection.shape)
-            np.copyto(iedata, self.extraReflection)
-            self.extraReflection = iedata
+            self.extraReflection = toSharedMemory(self.extraReflection)
 
 
 class DynamicsAnalysisResults(AbstractHDFAnalysisResults): # Inherit docstring.
@@ -246,6 +236,15 @@ class DynamicsAnalysisResults(AbstractHDFAnalysisResults): # Inherit docstring.
         dset = self.file['reflectance']
         return pwsdt.DynCube.fromHdfDataset(dset)
 
+    @property
+    def reflectanceView(self) -> _CubeView:
+        """Index this with (y, x) slices to load only a region of `reflectance` from file. e.g. `results.reflectanceView[y0:y1, x0:x1]`"""
+        return _CubeView(self, 'reflectance')
+
+    @staticmethod
+    def _cubeFields() -> t_.Dict[str, t_.Type[pwsdt.ICBase]]:  # Inherit docstring
+        return {'reflectance': pwsdt.DynCube}
+
     @AbstractHDFAnalysisResults.FieldDecorator
     def diffusion(self) -> np.ndarray:
         """A 2D array indicating the diffusion at each position in the image."""
@@ -37,20 +37,22 @@ Inheritance
 """
 
 from __future__ import annotations
+import copy
 import dataclasses
 import os
 import typing
 from datetime import datetime
+import h5py
 import numpy as np
 import pandas as pd
 from scipy import signal as sps
-import multiprocessing as mp
 from typing import Tuple, List, Optional
-from ._abstract import AbstractHDFAnalysisResults, AbstractAnalysis, AbstractAnalysisResults, AbstractAnalysisSettings
+from ._abstract import AbstractHDFAnalysisResults, AbstractAnalysis, AbstractAnalysisResults, AbstractAnalysisSettings, _CubeView
 from . import warnings
 import pwspy.dataTypes as pwsdt
 from pwspy import dateTimeFormat
 from pwspy.utility.reflection import reflectanceHelper, Material
+from pwspy.utility.misc import toSharedMemory, LRUCache
 
 __all__ = ['PWSAnalysis', 'PWSAnalysisSettings', 'PWSAnalysisResults', "LegacyPWSAnalysisResults"]
 
@@ -93,8 +95,14 @@ class PWSAnalysis(AbstractAnalysis):
             ExtraReflectanceCube: Effectively identical to supplying an ERMataData object.
             ExtraReflectionCube: An object representing the stray reflection in units of counts/ms. It is up to the user to make sure that the data is scaled appropriately to match the data being analyzed.
         ref: The reference acquisition used for analysis.
+        compiled: If `True` then the linear spectral processing steps (lowpass filtering, wavelength cropping, conversion to
+            wavenumber, wavenumber filtering and polynomial subtraction) are composed into a single matrix when the analysis is
+            initialized. Each call to `run` then applies this matrix to every spectrum of the cube with a single matrix multiplication
+            rather than making a separate pass over the data for each step. Results differ from the standard mode only by floating
+            point rounding.
     """
-    def __init__(self, settings: PWSAnalysisSettings, extraReflectance: typing.Optional[typing.Union[pwsdt.ERMetaData, pwsdt.ExtraReflectanceCube, pwsdt.ExtraReflectionCube]], ref: pwsdt.PwsCube):
+    def __init__(self, settings: PWSAnalysisSettings, extraReflectance: typing.Optional[typing.Union[pwsdt.ERMetaData, pwsdt.ExtraReflectanceCube, pwsdt.ExtraReflectionCube]], ref: pwsdt.PwsCube,
+                 compiled: bool = False):
         from pwspy.dataTypes import ExtraReflectanceCube
         super().__init__()
         self._initWarnings = []
@@ -135,25 +143,43 @@ class PWSAnalysis(AbstractAnalysis):
             ref = ref / theoryR[None, None, :]  # now when we normalize by our reference we will get a result in units of physical reflectance rather than arbitrary units.
         self.ref = ref
         self.extraReflection = Iextra
+        self.compiled = compiled
+        if compiled:
+            self._getSpectralOperator(ref.metadata)  # Build the operator now rather than during the first call to `run`.
 
-    def run(self, cube: pwsdt.PwsCube) -> Tuple[PWSAnalysisResults, List[warnings.AnalysisWarning]]:  # Inherit docstring
+    def run(self, cube: pwsdt.PwsCube, mask: Optional[typing.Union[pwsdt.Roi, np.ndarray]] = None) -> Tuple[PWSAnalysisResults, List[warnings.AnalysisWarning]]:
+        """Given an data cube to analyze this function returns an instanse of AnalysisResults. In the PWSAnalysisApp this function is run in parallel by the AnalysisManager.
+
+        Args:
+            cube: A data cube to be analyzed using the settings provided in the constructor of this class.
+            mask: An optional Roi or 2D boolean array. If provided then only the selected pixels are analyzed, every value of the
+                results outside of the mask is NaN. When only a small part of the image is of interest this is much faster than
+                analyzing the whole image.
+        Returns:
+            A new instance of analysis results.
+        Raises:
+            ValueError: If the shape of `mask` doesn't match the shape of the image.
+        """
+        ref, extraReflection = self.ref, self.extraReflection
+        if mask is not None:  # Gather the selected pixels into a cube with a single row. Every step of the analysis treats each pixel separately.
+            fullShape = cube.data.shape[:2]
+            region = _MaskRegion(mask, fullShape)
+            cube = pwsdt.PwsCube(region.gather(cube.data), cube.metadata, processingStatus=copy.deepcopy(cube.processingStatus), dtype=cube.data.dtype)
+            ref = pwsdt.PwsCube(region.gather(ref.data), ref.metadata, processingStatus=copy.deepcopy(ref.processingStatus))
+            if extraReflection is not None:
+                extraReflection = pwsdt.ExtraReflectionCube(region.gather(extraReflection.data), extraReflection.index, extraReflection.metadata)
         if not cube.processingStatus.cameraCorrected:
             cube.correctCameraEffects(self.settings.cameraCorrection)
         if not cube.processingStatus.normalizedByExposure:
             cube.normalizeByExposure()
         warns = self._initWarnings
-        cube = self._normalizePwsCube(cube)
-        interval = (max(cube.wavelengths) - min(cube.wavelengths)) / (len(cube.wavelengths) - 1)  # Wavelength interval. We are assuming equally spaced wavelengths here
-        cube.data = self._filterSignal(cube.data, 1/interval)  # Used for denoising
-        # The rest of the analysis will be performed only on the selected wavelength range.
-        cube = cube.selIndex(self.settings.wavelengthStart, self.settings.wavelengthStop)
-        # Determine the mean-reflectance for each pixel in the cell.
-        reflectance = cube.data.mean(axis=2)
-        cube = pwsdt.KCube.fromPwsCube(cube)  # -- Convert to K-Space
-        cube.data = self._filterWavenumber(cube, self.settings.waveNumberCutoff) # This step didn't exist until after pwspy 0.2.11. Rather than denoising it is intended to filter out high opd signals.
-        cubePoly = self._fitPolynomial(cube, self.settings.polynomialOrder)
-        # Remove the polynomial fit from filtered cubeCell.
-        cube.data = cube.data - cubePoly
+        if mask is not None and self.settings.autoCorrMinSub and not self.settings.skipAdvanced:
+            warns = warns + [warnings.AnalysisWarning("Autocorrelation differs for masked analysis", "`autoCorrMinSub` subtracts the minimum of the autocorrelation of every analyzed pixel. Since only the masked pixels were analyzed the autocorrelation slope, rSquared, and ld will differ from an analysis of the full image.")]
+        cube = self._normalizePwsCube(cube, ref, extraReflection)
+        if self.compiled:
+            cube, cubePoly, reflectance = self._applySpectralOperator(cube)
+        else:
+            cube, cubePoly, reflectance = self._processSpectra(cube)
 
         # -- RMS
         # Obtain the RMS of each signal in the cube.
@@ -168,6 +194,13 @@ class PWSAnalysis(AbstractAnalysis):
             ld = self._calculateLd(rms, slope)
         else:
             rmsPoly = slope = rSquared = ld = None
+        opd = cube.getOpd(useHannWindow=False, indexOpdStop=100) if self.settings.saveOpd else None
+        if mask is not None:  # Put the results of the selected pixels back into full size images.
+            cube = pwsdt.KCube(region.scatter(cube.data, fullShape), cube.wavenumbers, metadata=cube.metadata)
+            reflectance, rms, rmsPoly, slope, rSquared, ld = [region.scatter(i, fullShape) if i is not None else None
+                                                              for i in (reflectance, rms, rmsPoly, slope, rSquared, ld)]
+            if opd is not None:
+                opd = (region.scatter(opd[0], fullShape), opd[1])
 
         results = PWSAnalysisResults.create(
             meanReflectance=reflectance,
@@ -180,14 +213,78 @@ class PWSAnalysis(AbstractAnalysis):
             settings=self.settings,
             imCubeIdTag=cube.metadata.idTag,
             referenceIdTag=self.ref.metadata.idTag,
-            extraReflectionTag=self.extraReflection.metadata.idTag if self.extraReflection is not None else None)
+            extraReflectionTag=self.extraReflection.metadata.idTag if self.extraReflection is not None else None,
+            opd=opd)
         warns = [warn for warn in warns if warn is not None]  # Filter out null values.
         return results, warns
 
-    def _normalizePwsCube(self, cube: pwsdt.PwsCube) -> pwsdt.PwsCube:
-        if self.extraReflection is not None:
-            cube.subtractExtraReflection(self.extraReflection)
-        cube.normalizeByReference(self.ref)
+    def _processSpectra(self, cube: pwsdt.PwsCube) -> Tuple[pwsdt.KCube, np.ndarray, np.ndarray]:
+        """Perform the spectral processing steps of the analysis. Every step is linear in the spectra, this allows
+        `_buildSpectralOperator` to compose them into a single matrix.
+
+        Args:
+            cube: A PwsCube that has already been normalized by the reference.
+
+        Returns:
+            A tuple containing: The KCube after subtraction of the polynomial fit, The polynomial fit that was subtracted,
+                The mean reflectance of each pixel.
+        """
+        interval = (max(cube.wavelengths) - min(cube.wavelengths)) / (len(cube.wavelengths) - 1)  # Wavelength interval. We are assuming equally spaced wavelengths here
+        cube.data = self._filterSignal(cube.data, 1/interval)  # Used for denoising
+        # The rest of the analysis will be performed only on the selected wavelength range.
+        cube = cube.selIndex(self.settings.wavelengthStart, self.settings.wavelengthStop)
+        # Determine the mean-reflectance for each pixel in the cell.
+        reflectance = cube.data.mean(axis=2)
+        cube = pwsdt.KCube.fromPwsCube(cube)  # -- Convert to K-Space
+        cube.data = self._filterWavenumber(cube, self.settings.waveNumberCutoff) # This step didn't exist until after pwspy 0.2.11. Rather than denoising it is intended to filter out high opd signals.
+        cubePoly = self._fitPolynomial(cube, self.settings.polynomialOrder)
+        # Remove the polynomial fit from filtered cubeCell.
+        cube.data = cube.data - cubePoly
+        return cube, cubePoly, reflectance
+
+    def _getSpectralOperator(self, metadata: pwsdt.PwsMetaData) -> _SpectralOperator:
+        """Return the composite operator for data with the wavelengths of `metadata`. Operators are cached by the
+        analysis settings and the wavelengths so they only need to be built once."""
+        key = (self.settings.toJsonString(), tuple(metadata.wavelengths))
+        operator = _spectralOperatorCache.get(key)
+        if operator is None:
+            operator = self._buildSpectralOperator(metadata)
+            _spectralOperatorCache.put(key, operator)
+        return operator
+
+    def _buildSpectralOperator(self, metadata: pwsdt.PwsMetaData) -> _SpectralOperator:
+        """Compose the steps of `_processSpectra` into a single matrix by passing each of the unit vectors of the input
+        space through them. Since every step is linear the outputs are the columns of the composite operator."""
+        n = len(metadata.wavelengths)
+        basis = pwsdt.PwsCube(np.eye(n)[None, :, :], metadata)  # Each "pixel" of this cube is one unit vector.
+        kCube, poly, reflectance = self._processSpectra(basis)
+        outputs = [kCube.data]
+        if not self.settings.skipAdvanced:
+            outputs.append(poly)
+        outputs.append(reflectance[:, :, None])
+        matrix = np.ascontiguousarray(np.concatenate(outputs, axis=2)[0], dtype=np.float32)  # Shape is (N_in, N_out), so `spectra @ matrix` applies the operator.
+        return _SpectralOperator(matrix=matrix, wavenumbers=kCube.wavenumbers, wavelengths=kCube.metadata.wavelengths,
+                                 includesPolynomial=not self.settings.skipAdvanced)
+
+    def _applySpectralOperator(self, cube: pwsdt.PwsCube) -> Tuple[pwsdt.KCube, Optional[np.ndarray], np.ndarray]:
+        """Equivalent to `_processSpectra` but uses a single matrix multiplication. The polynomial fit is only returned if it
+        will be needed by the analysis."""
+        op = self._getSpectralOperator(cube.metadata)
+        rows, cols, n = cube.data.shape
+        out = (cube.data.reshape((rows * cols, n)) @ op.matrix).reshape((rows, cols, op.matrix.shape[1]))
+        nk = len(op.wavenumbers)
+        md = copy.deepcopy(cube.metadata)  # Match the metadata that `selIndex` would have produced.
+        md.dict['wavelengths'] = op.wavelengths
+        kCube = pwsdt.KCube(out[:, :, :nk], op.wavenumbers, metadata=md)
+        cubePoly = out[:, :, nk:2*nk] if op.includesPolynomial else None
+        reflectance = out[:, :, -1].copy()
+        return kCube, cubePoly, reflectance
+
+    @staticmethod
+    def _normalizePwsCube(cube: pwsdt.PwsCube, ref: pwsdt.PwsCube, extraReflection: Optional[pwsdt.ExtraReflectionCube]) -> pwsdt.PwsCube:
+        if extraReflection is not None:
+            cube.subtractExtraReflection(extraReflection)
+        cube.normalizeByReference(ref)
         return cube
 
     def _filterSignal(self, data: np.ndarray, sampleFreq: float):
@@ -248,16 +345,61 @@ class PWSAnalysis(AbstractAnalysis):
         return ld
 
     def copySharedDataToSharedMemory(self):  # Inherit docstring
-        refdata = mp.RawArray('f', self.ref.data.size)  # Create an empty ctypes array of shared memory
-        refdata = np.frombuffer(refdata, dtype=np.float32).reshape(self.ref.data.shape)  # Wrap the shared memory array in a numpy array and reshape back to origianl shape
-        np.copyto(refdata, self.ref.data)  # Copy our PwsCubes data to the shared memory array.
-        self.ref.data = refdata # Reassign the shared memory array to our PwsCube object data attribute.
-
+        self.ref.data = toSharedMemory(self.ref.data)  # Move the reference data to shared memory, only the name of the memory block is sent to each process.
         if self.extraReflection is not None:
-            iedata = mp.RawArray('f', self.extraReflection.data.size)
-            iedata = np.frombuffer(iedata, dtype=np.float32).reshape(self.extraReflection.data.shape)
-            np.copyto(iedata, self.extraReflection.data)
-            self.extraReflection.data = iedata
+            self.extraReflection.data = toSharedMemory(self.extraReflection.data)
+
+
+@dataclasses.dataclass
+class _SpectralOperator:
+    """A matrix composing all of the linear spectral processing steps of `PWSAnalysis`.
+
+    Attributes:
+        matrix: An (N_in x N_out) array. The columns are the processed spectra followed by the polynomial fit (if included)
+            followed by a single column for the mean reflectance.
+        wavenumbers: The wavenumbers of the processed spectra.
+        wavelengths: The wavelengths that remain after cropping.
+        includesPolynomial: Whether the polynomial fit is included in the output of the matrix.
+    """
+    matrix: np.ndarray
+    wavenumbers: typing.Tuple[float, ...]
+    wavelengths: typing.Tuple[float, ...]
+    includesPolynomial: bool
+
+
+_spectralOperatorCache = LRUCache(maxBytes=64 * 1024**2, sizeOf=lambda op: op.matrix.nbytes)  # Keyed by the JSON of the analysis settings and the input wavelengths.
+
+
+class _MaskRegion:
+    """The pixels of an image selected by a `Roi` or a boolean mask. Used to gather the selected pixels of arrays into a single row
+    and to scatter the results back into full size arrays.
+
+    Args:
+        mask: The `Roi` or 2D boolean array selecting the pixels.
+        shape: The (y, x) shape of the image. The shape of `mask` (the `dataShape` of an `Roi`) must match.
+    """
+    def __init__(self, mask: typing.Union[pwsdt.Roi, np.ndarray], shape: Tuple[int, int]):
+        maskShape = mask.dataShape if isinstance(mask, pwsdt.Roi) else np.shape(mask)
+        if tuple(maskShape) != tuple(shape):
+            raise ValueError(f"The shape of the mask, {tuple(maskShape)}, doesn't match the shape of the image, {tuple(shape)}.")
+        if isinstance(mask, pwsdt.Roi):
+            self.box, self.mask = mask.boundingBox, mask.croppedMask
+        else:
+            if mask.dtype != bool:
+                raise ValueError(f"The mask must be a boolean array, not {mask.dtype}.")
+            rows, cols = np.nonzero(mask.any(axis=1))[0], np.nonzero(mask.any(axis=0))[0]
+            self.box = (slice(rows[0], rows[-1] + 1), slice(cols[0], cols[-1] + 1)) if len(rows) > 0 else (slice(0, 0), slice(0, 0))
+            self.mask = mask[self.box]
+
+    def gather(self, arr: np.ndarray) -> np.ndarray:
+        """Select the pixels from an array with the first two axes matching the image. Returns an array with a single row."""
+        return arr[self.box][self.mask][None]
+
+    def scatter(self, arr: np.ndarray, shape: Tuple[int, int]) -> np.ndarray:
+        """Put the values of an array returned by `gather` into a new array of the full image `shape`. Pixels outside of the mask are NaN."""
+        out = np.full(tuple(shape) + arr.shape[2:], np.nan, dtype=np.result_type(arr.dtype, np.float32))
+        out[self.box][self.mask] = arr[0]
+        return out
 
 
 class NCADCPWSAnalysis(AbstractAnalysis):
@@ -273,14 +415,14 @@ class NCADCPWSAnalysis(AbstractAnalysis):
         adcSpectra = self._getADCSpectra(self._pwsAnalysis.ref)
         self._pwsAnalysis.ref.data = self._pwsAnalysis.ref.data - adcSpectra
 
-    def run(self, cube: pwsdt.PwsCube) -> Tuple[PWSAnalysisResults, List[warnings.AnalysisWarning]]:
+    def run(self, cube: pwsdt.PwsCube, mask: Optional[typing.Union[pwsdt.Roi, np.ndarray]] = None) -> Tuple[PWSAnalysisResults, List[warnings.AnalysisWarning]]:  # See `PWSAnalysis.run`
         if not cube.processingStatus.cameraCorrected:
             cube.correctCameraEffects(self._pwsAnalysis.settings.cameraCorrection, binning=1) # Binning isn't stored in Nano data. assume binning is 1
         if not cube.processingStatus.normalizedByExposure:
             cube.normalizeByExposure()
         adcSpectra = self._getADCSpectra(cube)
         cube.data = cube.data - adcSpectra
-        return self._pwsAnalysis.run(cube)
+        return self._pwsAnalysis.run(cube, mask=mask)
 
     def copySharedDataToSharedMemory(self):
         self._pwsAnalysis.copySharedDataToSharedMemory()
@@ -311,7 +453,8 @@ class PWSAnalysisResults(AbstractHDFAnalysisResults):
     @classmethod
     def create(cls, settings: PWSAnalysisSettings, reflectance: pwsdt.KCube, meanReflectance: np.ndarray, rms: np.ndarray,
                polynomialRms: np.ndarray, autoCorrelationSlope: np.ndarray, rSquared: np.ndarray, ld: np.ndarray,
-               imCubeIdTag: str, referenceIdTag: str, extraReflectionTag: Optional[str]):  # Inherit docstring
+               imCubeIdTag: str, referenceIdTag: str, extraReflectionTag: Optional[str],
+               opd: Optional[Tuple[np.ndarray, np.ndarray]] = None):  # Inherit docstring. `opd` is an optional (opd, opdIndex) tuple to be saved with the results.
         d = {'time': datetime.now().strftime(dateTimeFormat),
             'reflectance': reflectance,
             'meanReflectance': meanReflectance,
@@ -324,6 +467,8 @@ class PWSAnalysisResults(AbstractHDFAnalysisResults):
             'referenceIdTag': referenceIdTag,
             'extraReflectionTag': extraReflectionTag,
             'settings': settings}
+        if opd is not None:
+            d['opd'] = opd
         return cls(None, d)
 
     @AbstractHDFAnalysisResults.FieldDecorator
@@ -394,13 +539,75 @@ class PWSAnalysisResults(AbstractHDFAnalysisResults):
     def opd(self) -> Tuple[np.ndarray, np.ndarray]:
         """
         A tuple containing: `opd`: The 3D array of values, `opdIndex`: The sequence of OPD values associated with each
-        2D slice along the 3rd axis of the `opd` data.
+        2D slice along the 3rd axis of the `opd` data. Calculated from `reflectance` unless the file contains a saved copy, see
+        `PWSAnalysisSettings.saveOpd` and `saveOpd`.
         """
+        if 'opd' in self.file:
+            return _readOpd(self.file['opd'])
         dset = self.file['reflectance']
         cube = pwsdt.KCube.fromHdfDataset(dset)
         opd, opdIndex = cube.getOpd(useHannWindow=False, indexOpdStop=100)
         return opd, opdIndex
 
+    def saveOpd(self):
+        """
+        Calculate `opd` and add it to the file of results that were saved without it, so that it is read from file rather than
+        calculated the next time these results are loaded. Does nothing if the file already contains `opd`. The file can't be
+        modified while other results objects have it open.
+        """
+        if self.file is None:
+            raise ValueError("Only results that were loaded from file can be updated.")
+        if 'opd' in self.file:
+            return
+        opd, opdIndex = self.opd
+        if self.file.file.mode == 'r+':  # The group of an `AnalysisStore`, which is already writable.
+            _writeOpd(self.file, opd, opdIndex)
+            self.file.file.flush()
+        else:
+            path = self.file.filename
+            self.file.close()
+            try:
+                with h5py.File(path, 'r+') as hf:
+                    _writeOpd(hf, opd, opdIndex)
+            except OSError as e:
+                raise OSError(f"Failed to open {path} for writing. Any other results loaded from this file must be deleted first.") from e
+            finally:
+                self.file = h5py.File(path, 'r')
+        del self.opd  # Remove the calculated value from the cache, it will be read from file from now on.
+        self._fileMtime = os.stat(self.file.file.filename).st_mtime_ns  # The file has changed so cached fields should be keyed by the new modification time.
+
+    @property
+    def reflectanceView(self) -> _CubeView:
+        """Index this with (y, x) slices to load only a region of `reflectance` from file. e.g. `results.reflectanceView[y0:y1, x0:x1]`"""
+        return _CubeView(self, 'reflectance')
+
+    @staticmethod
+    def _cubeFields() -> typing.Dict[str, typing.Type[pwsdt.ICBase]]:  # Inherit docstring
+        return {'reflectance': pwsdt.KCube}
+
+    def getField(self, name: str, roi: Optional[typing.Union[pwsdt.Roi, Tuple[slice, slice]]] = None) -> typing.Any:  # Inherit docstring
+        if name != 'opd' or roi is None:
+            return super().getField(name, roi)
+        if self.file is not None and 'opd' in self.file:  # Read only the region from the saved copy.
+            slc = roi if isinstance(roi, tuple) else roi.boundingBox
+            opd, opdIndex = _readOpd(self.file['opd'], slc)
+            if isinstance(roi, pwsdt.Roi):
+                opd[~roi.croppedMask] = np.nan
+            return opd, opdIndex
+        # Only calculate the FFT for the pixels of the ROI. Pixels of the bounding box outside of the ROI are NaN.
+        cube = self.getField('reflectance', roi)
+        mask = roi.croppedMask if isinstance(roi, pwsdt.Roi) else np.ones(cube.data.shape[:2], dtype=bool)
+        roiCube = pwsdt.KCube(cube.data[mask][None, :, :], cube.wavenumbers, metadata=cube.metadata)
+        roiOpd, opdIndex = roiCube.getOpd(useHannWindow=False, indexOpdStop=100)
+        opd = np.full(mask.shape + (roiOpd.shape[2],), np.nan, dtype=roiOpd.dtype)
+        opd[mask] = roiOpd[0]
+        return opd, opdIndex
+
+    def toHdfGroup(self, g: h5py.Group, compression: str = None):  # Inherit docstring
+        super().toHdfGroup(g, compression=compression)
+        if self.file is None and self.dict.get('opd') is not None:
+            _writeOpd(g, *self.dict['opd'])
+
     @AbstractHDFAnalysisResults.FieldDecorator
     def extraReflectionTag(self) -> str:
         """The `idtag` of the extra reflectance correction used."""
@@ -408,7 +615,7 @@ class PWSAnalysisResults(AbstractHDFAnalysisResults):
 
     def releaseMemory(self):
         """
-        The cached properties continue to stay in RAM until they are deleted, this method deletes all cached data to release the memory.
+        Loaded fields stay in the shared `fieldCache` until they are evicted, this method removes the fields of this object from the cache to release the memory.
         """
         for field in self.fields():
             try:
@@ -417,6 +624,37 @@ class PWSAnalysisResults(AbstractHDFAnalysisResults):
                 pass  # Fields that haven't yet been loaded won't be present for deletion
 
 
+def _writeOpd(g: h5py.Group, opd: np.ndarray, opdIndex: np.ndarray):
+    """Save `opd` to the group in 16-bit fixed-point, the same format used for `reflectance`. The dataset is chunked in tiles
+    of the image so that the region of an ROI can be read without reading the whole dataset."""
+    nans = np.isnan(opd)
+    hasNan = nans.any()  # Pixels that weren't analyzed are NaN. The largest integer is reserved to represent them.
+    m, M = (np.nanmin(opd), np.nanmax(opd)) if not nans.all() else (0, 0)
+    if M == m:  # Avoid dividing by zero for constant data.
+        M = m + 1
+    fpData = (opd - m) / (M - m) * ((2 ** 16 - 2) if hasNan else (2 ** 16 - 1))
+    if hasNan:
+        fpData[nans] = 2 ** 16 - 1
+    chunks = (min(64, opd.shape[0]), min(64, opd.shape[1]), opd.shape[2])
+    dset = g.create_dataset('opd', data=fpData.astype(np.uint16), chunks=chunks)
+    dset.attrs['opdIndex'] = opdIndex
+    dset.attrs['min'] = m
+    dset.attrs['max'] = M
+    if hasNan:
+        dset.attrs['nanValue'] = 2 ** 16 - 1
+
+
+def _readOpd(dset: h5py.Dataset, slc: Optional[Tuple[slice, slice]] = None) -> Tuple[np.ndarray, np.ndarray]:
+    """Load `opd` saved by `_writeOpd`, optionally only the (y, x) region `slc`."""
+    data = dset[slc] if slc is not None else dset[()]
+    m, M = dset.attrs['min'], dset.attrs['max']
+    hasNan = 'nanValue' in dset.attrs
+    opd = data.astype(np.float32) * np.float32((M - m) / ((2 ** 16 - 2) if hasNan else (2 ** 16 - 1))) + np.float32(m)
+    if hasNan:
+        opd[data == dset.attrs['nanValue']] = np.nan
+    return opd, np.array(dset.attrs['opdIndex'])
+
+
 class LegacyPWSAnalysisResults(AbstractAnalysisResults):
     """
     Allows loading of the .mat files that were used by the MATLAB analysis code to save analysis results.
@@ -534,6 +772,7 @@ class PWSAnalysisSettings(AbstractAnalysisSettings):
         cameraCorrection: An object describing the dark counts and non-linearity of the camera used. If the data supplied to the PWSAnalysis class has already been corrected then this
             setting will not be used. Setting this to `None` will result in the camera correcting being automatically determined based on the image files' metadata.
         waveNumberCutoff: A cutoff frequency for filtering the signal after converting from wavelength to wavenumber. In units of microns (opd). Note: To convert from depth to opd divide by 2 (because the light makes a round trip) and divide by the RI of the media (nucleus)
+        saveOpd: If `True` then the OPD is calculated during analysis and saved with the results so that it doesn't need to be calculated each time the results are loaded. Increases the file size.
     """
     filterOrder: int
     filterCutoff: typing.Optional[float]
@@ -549,6 +788,7 @@ class PWSAnalysisSettings(AbstractAnalysisSettings):
     relativeUnits: bool  # determines if reflectance (and therefore the other parameters) should be calculated in absolute units of reflectance or just relative to the reflectance of the reference image.
     cameraCorrection: typing.Optional[pwsdt.CameraCorrection]
     waveNumberCutoff: float
+    saveOpd: bool = False
 
     FileSuffix = 'analysis'  # This is used for saving and loading to json
 
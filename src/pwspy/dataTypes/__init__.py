@@ -58,9 +58,12 @@ Other Classes
 
     Roi
     RoiFile
+    RoiSet
+    RoiIndex
     CameraCorrection
     Acquisition
     FluorescenceImage
+    AnalysisStore
 
 Inheritance
 -------------
@@ -75,13 +78,15 @@ import os
 _jsonSchemasPath = os.path.join(os.path.split(__file__)[0], 'jsonSchemas')
 from ._metadata import (PwsMetaData, Acquisition, DynMetaData, ERMetaData, FluorMetaData, AnalysisManager, MetaDataBase,
                         MetaDataBase)
-from ._other import Roi, CameraCorrection, RoiFile
+from ._other import Roi, CameraCorrection, RoiFile, RoiSet, roiCache
+from ._analysisStore import AnalysisStore
+from ._roiIndex import RoiIndex
 from ._data import (FluorescenceImage, ExtraReflectanceCube, ExtraReflectionCube, PwsCube, KCube, DynCube, ICBase,
                     ICRawBase)
 
 __all__ = ['PwsMetaData', 'Acquisition', 'DynMetaData', 'ERMetaData', 'FluorMetaData', 'AnalysisManager', 'MetaDataBase',
            'MetaDataBase', 'Roi', 'CameraCorrection', 'FluorescenceImage', 'ExtraReflectionCube',
-           'ExtraReflectanceCube', 'PwsCube', 'KCube', 'DynCube', 'ICBase', 'ICRawBase', 'RoiFile']
+           'ExtraReflectanceCube', 'PwsCube', 'KCube', 'DynCube', 'ICBase', 'ICRawBase', 'RoiFile', 'RoiSet', 'RoiIndex', 'AnalysisStore', 'roiCache']
 
 
 
@@ -0,0 +1,245 @@
+# Copyright 2018-2020 Nick Anthony, Backman Biophotonics Lab, Northwestern University
+#
+# This file is part of PWSpy.
+#
+# PWSpy is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PWSpy is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with PWSpy.  If not, see <https://www.gnu.org/licenses/>.
+
+from __future__ import annotations
+import os
+import typing as t_
+
+import h5py
+
+if t_.TYPE_CHECKING:
+    from pwspy.analysis._abstract import AbstractHDFAnalysisResults
+
+
+class AnalysisStore:
+    """A single HDF5 file that holds the analysis results of every acquisition in an experiment. Opening one file for the whole
+    experiment avoids opening a separate file for each acquisition, which is slow for large experiments on network drives.
+
+    The file is saved in the root folder of the experiment. Each acquisition has a group named by the path of its metadata folder
+    relative to the root (e.g. `Cell1/PWS`) and each analysis is saved in a subgroup named by the file name it would
+    otherwise have been saved as (e.g. `analysisResults_p0.h5`).
+
+    While a store is open, the `AnalysisManager` methods (`getAnalyses`, `saveAnalysis`, `loadAnalysis`, `removeAnalysis`) of acquisitions
+    under its root folder use the store. Analyses in the `analyses` folders of the acquisitions are still listed and loaded, an analysis in
+    the store takes precedence over a file of the same name. HDF5 files can't be written by more than one process at a time so analyses
+    run in parallel should be saved to the acquisition folders and then added to the store with `importAnalyses`.
+
+    Args:
+        filePath: The path to the store file. It is created if it doesn't exist yet.
+        readOnly: If `True` the file is opened in read-only mode. This allows other processes to read the store at the same time.
+    """
+    defaultFileName = 'analysisStore.h5'
+    _openStores: t_.Dict[str, AnalysisStore] = {}  # The open stores keyed by the root folder.
+
+    def __init__(self, filePath: str, readOnly: bool = False):
+        self.filePath = os.path.abspath(filePath)
+        self.root = os.path.dirname(self.filePath)
+        self.readOnly = readOnly
+        self._file = h5py.File(self.filePath, 'r' if readOnly else 'a')
+        self._pid = os.getpid()  # A forked process must not use the file handle of its parent.
+        self._index = self._buildIndex()  # The analysis file names of each acquisition, keyed by the acquisition group name.
+        AnalysisStore._openStores[self.root] = self
+
+    @classmethod
+    def open(cls, root: str, readOnly: bool = False) -> AnalysisStore:
+        """Open the store in the `root` folder of an experiment using the default file name.
+
+        Args:
+            root: The root folder of the experiment.
+            readOnly: If `True` the file is opened in read-only mode.
+
+        Returns:
+            The opened store.
+        """
+        return cls(os.path.join(root, cls.defaultFileName), readOnly=readOnly)
+
+    @classmethod
+    def find(cls, path: str) -> t_.Optional[AnalysisStore]:
+        """Find the open store, if any, that `path` belongs to.
+
+        Args:
+            path: The path to a metadata folder of an acquisition.
+
+        Returns:
+            The store whose root folder contains `path`. `None` if there isn't one.
+        """
+        if len(cls._openStores) == 0:
+            return None
+        path = os.path.abspath(path)
+        for root, store in cls._openStores.items():
+            if store._pid == os.getpid() and path.startswith(root + os.sep):
+                return store
+        return None
+
+    def _buildIndex(self) -> t_.Dict[str, t_.Set[str]]:
+        index = {}
+
+        def visit(g: h5py.Group):
+            for k, v in g.items():
+                if isinstance(v, h5py.Group):
+                    if 'pwspy_version' in v:  # This is a saved analysis
+                        index.setdefault(g.name.lstrip('/'), set()).add(k)
+                    else:
+                        visit(v)
+        visit(self._file)
+        return index
+
+    def _groupName(self, directory: str) -> str:
+        """The name of the group for the acquisition metadata folder `directory`."""
+        rel = os.path.relpath(os.path.abspath(directory), self.root)
+        if rel.startswith('..') or rel == '.':
+            raise ValueError(f"{directory} is not within the store folder {self.root}.")
+        return '/'.join(rel.split(os.sep))
+
+    def hasAcquisition(self, directory: str) -> bool:
+        """
+
+        Args:
+            directory: The metadata folder of an acquisition, the folder that would contain the `analyses` folder.
+
+        Returns:
+            `True` if the store has any analyses for the acquisition.
+        """
+        return len(self._index.get(self._groupName(directory), ())) > 0
+
+    def getAnalyses(self, directory: str, resultsClass: t_.Type[AbstractHDFAnalysisResults]) -> t_.List[str]:
+        """
+
+        Args:
+            directory: The metadata folder of an acquisition.
+            resultsClass: The class of analysis results to look for.
+
+        Returns:
+            The names of the analyses of type `resultsClass` saved for the acquisition.
+        """
+        names = []
+        for fileName in sorted(self._index.get(self._groupName(directory), ())):
+            try:
+                name = resultsClass.fileName2Name(fileName)
+            except IndexError:
+                continue
+            if resultsClass.name2FileName(name) == fileName:
+                names.append(name)
+        return names
+
+    def hasAnalysis(self, directory: str, resultsClass: t_.Type[AbstractHDFAnalysisResults], name: str) -> bool:
+        """
+
+        Args:
+            directory: The metadata folder of an acquisition.
+            resultsClass: The class of the analysis results.
+            name: The name of the analysis.
+
+        Returns:
+            `True` if the analysis is saved in the store.
+        """
+        return resultsClass.name2FileName(name) in self._index.get(self._groupName(directory), ())
+
+    def loadAnalysis(self, directory: str, resultsClass: t_.Type[AbstractHDFAnalysisResults], name: str) -> AbstractHDFAnalysisResults:
+        """
+
+        Args:
+            directory: The metadata folder of an acquisition.
+            resultsClass: The class of the analysis results.
+            name: The name of the analysis.
+
+        Returns:
+            The analysis results. Fields are loaded from the store as they are accessed.
+        """
+        if not self.hasAnalysis(directory, resultsClass, name):
+            raise OSError(f"The {resultsClass.__name__} analysis {name} of {directory} is not in the store {self.filePath}.")
+        return resultsClass(self._file[self._groupName(directory)][resultsClass.name2FileName(name)], None, name)
+
+    def saveAnalysis(self, directory: str, analysis: AbstractHDFAnalysisResults, name: str, overwrite: bool = False):
+        """
+
+        Args:
+            directory: The metadata folder of an acquisition.
+            analysis: The analysis results to save.
+            name: The name to save the analysis as.
+            overwrite: If `True` then an existing analysis of the same name will be replaced. If `False` an exception will be raised.
+        """
+        groupName = self._groupName(directory)
+        fileName = analysis.name2FileName(name)
+        acqGroup = self._file.require_group(groupName)
+        if fileName in acqGroup:
+            if not overwrite:
+                raise OSError(f"{fileName} already exists in {groupName} of {self.filePath}.")
+            del acqGroup[fileName]
+        analysis.toHdfGroup(acqGroup.create_group(fileName))
+        self._file.flush()
+        self._index.setdefault(groupName, set()).add(fileName)
+
+    def removeAnalysis(self, directory: str, resultsClass: t_.Type[AbstractHDFAnalysisResults], name: str):
+        """
+
+        Args:
+            directory: The metadata folder of an acquisition.
+            resultsClass: The class of the analysis results.
+            name: The name of the analysis to be deleted.
+        """
+        groupName = self._groupName(directory)
+        fileName = resultsClass.name2FileName(name)
+        if fileName not in self._index.get(groupName, ()):
+            raise OSError(f"{fileName} is not in {groupName} of {self.filePath}.")
+        del self._file[groupName][fileName]
+        self._file.flush()
+        self._index[groupName].remove(fileName)
+
+    def importAnalyses(self, overwrite: bool = False, removeOriginals: bool = False) -> int:
+        """Copy the analysis files found in the `analyses` folders under the root folder into the store.
+
+        Args:
+            overwrite: If `True` then analyses that are already in the store are replaced. Otherwise they are skipped.
+            removeOriginals: If `True` then each file is deleted once it has been copied into the store.
+
+        Returns:
+            The number of analyses that were copied.
+        """
+        count = 0
+        for dirPath, dirNames, fileNames in os.walk(self.root):
+            if os.path.basename(dirPath) != 'analyses':
+                continue
+            groupName = self._groupName(os.path.dirname(dirPath))
+            for fileName in fileNames:
+                if not fileName.endswith('.h5'):
+                    continue
+                acqGroup = self._file.require_group(groupName)
+                if fileName in acqGroup:
+                    if not overwrite:
+                        continue
+                    del acqGroup[fileName]
+                with h5py.File(os.path.join(dirPath, fileName), 'r') as src:
+                    src.copy(src['/'], acqGroup, name=fileName)
+                self._index.setdefault(groupName, set()).add(fileName)
+                count += 1
+                if removeOriginals:
+                    os.remove(os.path.join(dirPath, fileName))
+        self._file.flush()
+        return count
+
+    def close(self):
+        """Close the file. Acquisitions will go back to using their own `analyses` folders."""
+        if AnalysisStore._openStores.get(self.root) is self:
+            del AnalysisStore._openStores[self.root]
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -101,11 +101,13 @@ class ICBase(ABC):
             The average spectra within the region, the standard deviation of the spectra within the region
         """
         if isinstance(mask, _other.Roi):
-            mask = mask.mask
-        if mask is None: #Make a mask that includes everything
-            mask = np.ones(self.data.shape[:-1], dtype=np.bool)
-        mean = self.data[mask].mean(axis=0)
-        std = self.data[mask].std(axis=0)
+            data = self.data[mask.boundingBox][mask.croppedMask]  # Only index the region of the data containing the ROI.
+        elif mask is None:  # Use every pixel
+            data = self.data.reshape((-1, self.data.shape[-1]))
+        else:
+            data = self.data[mask]
+        mean = data.mean(axis=0)
+        std = data.std(axis=0)
         return mean, std
 
     def selectLassoROI(self, displayIndex: t_.Optional[int] = None, clim: t_.Sequence = None) -> _other.Roi:
@@ -302,15 +304,23 @@ class ICBase(ABC):
             # when creating the dataset
             m = self.data.min()
             M = self.data.max()
+            hasNan = np.isnan(m)  # Data that only covers part of the image (e.g. analysis of an ROI) is NaN elsewhere.
+            if hasNan:  # The largest integer is reserved to represent NaN.
+                nans = np.isnan(self.data)
+                m, M = (np.nanmin(self.data), np.nanmax(self.data)) if not nans.all() else (0, 0)
             fpData = self.data - m
             fpData = fpData / (M - m)
-            fpData *= (2 ** 16 - 1)
+            fpData *= (2 ** 16 - 2) if hasNan else (2 ** 16 - 1)
+            if hasNan:
+                fpData[nans] = 2 ** 16 - 1
             fpData = fpData.astype(np.uint16)
             dset = g.create_dataset(name, data=fpData, compression=compression)  # , chunks=(64,64,self.data.shape[2]), compression=2)
             dset.attrs['index'] = np.array(self.index)
             dset.attrs['type'] = np.string_(f"{self._hdfTypeName}_fp")
             dset.attrs['min'] = m
             dset.attrs['max'] = M
+            if hasNan:
+                dset.attrs['nanValue'] = 2 ** 16 - 1
         else:
             dset = g.create_dataset(name, data=self.data, compression=compression)
             dset.attrs['index'] = np.array(self.index)
@@ -318,12 +328,13 @@ class ICBase(ABC):
         return g
 
     @classmethod
-    def decodeHdf(cls, d: h5py.Dataset) -> t_.Tuple[np.array, t_.Tuple[float, ...]]:
+    def decodeHdf(cls, d: h5py.Dataset, slc: t_.Optional[t_.Tuple[slice, slice]] = None) -> t_.Tuple[np.array, t_.Tuple[float, ...]]:
         """
         Load a new instance of ICBase from an `h5py.Dataset`
 
         Args:
             d: The dataset that the ICBase has been saved to
+            slc: An optional tuple of (y, x) slices. If provided then only this region of the data is read from file.
 
         Returns:
             A tuple containing: (data: The 3D array of `data`,  index: A tuple containing the `index`)
@@ -331,14 +342,17 @@ class ICBase(ABC):
         assert 'type' in d.attrs
         assert 'index' in d.attrs
         if d.attrs['type'].decode() == cls._hdfTypeName: #standard decoding
-            return np.array(d), tuple(d.attrs['index'])
+            return (np.array(d) if slc is None else d[slc]), tuple(d.attrs['index'])
         elif d.attrs['type'].decode() == f"{cls._hdfTypeName}_fp": #Fixed point decoding
             M = d.attrs['max']
             m = d.attrs['min']
-            arr = np.array(d)
-            arr = arr.astype(np.float32) / (2 ** 16 - 1)
+            raw = np.array(d) if slc is None else d[slc]
+            hasNan = 'nanValue' in d.attrs  # Only saved if the data contained NaN
+            arr = raw.astype(np.float32) / ((2 ** 16 - 2) if hasNan else (2 ** 16 - 1))
             arr *= (M - m)
             arr += m
+            if hasNan:
+                arr[raw == d.attrs['nanValue']] = np.nan
             return arr, tuple(d.attrs['index'])
         else:
             raise TypeError(f"Got {d.attrs['type'].decode()} instead of {cls._hdfTypeName}")
@@ -502,12 +516,13 @@ class ICRawBase(ICBase, ABC):
         return g
 
     @classmethod
-    def decodeHdf(cls, d: h5py.Dataset) -> t_.Tuple[np.array, t_.Tuple[float, ...], dict, ProcessingStatus]:
+    def decodeHdf(cls, d: h5py.Dataset, slc: t_.Optional[t_.Tuple[slice, slice]] = None) -> t_.Tuple[np.array, t_.Tuple[float, ...], dict, ProcessingStatus]:
         """
         Load a new instance of ICRawBase from an `h5py.Dataset`
 
         Args:
             d: The dataset that the ICBase has been saved to
+            slc: An optional tuple of (y, x) slices. If provided then only this region of the data is read from file.
 
         Returns:
             A tuple containing:
@@ -516,7 +531,7 @@ class ICRawBase(ICBase, ABC):
                 metadata: A dictionary containing metadata.
                 procStatus: The processing status of the object.
         """
-        arr, index = super().decodeHdf(d)
+        arr, index = super().decodeHdf(d, slc)
         mdDict = cls.getMetadataClass().decodeHdfMetadata(d)
         if 'processingStatus' in d.attrs:
             processingStatus = cls.ProcessingStatus.fromDict(json.loads(d.attrs['processingStatus']))
@@ -737,8 +752,8 @@ class DynCube(ICRawBase):
         super().filterDust(kernelRadius, pixelSize)
 
     @classmethod
-    def fromHdfDataset(cls, d: h5py.Dataset):  # Inherit docstring
-        data, index, mdDict, processingStatus = cls.decodeHdf(d)
+    def fromHdfDataset(cls, d: h5py.Dataset, slc: t_.Optional[t_.Tuple[slice, slice]] = None):  # Inherit docstring
+        data, index, mdDict, processingStatus = cls.decodeHdf(d, slc)
         md = pwsdtmd.DynMetaData(mdDict, fileFormat=pwsdtmd.DynMetaData.FileFormats.Hdf)
         return cls(data, md, processingStatus=processingStatus)
 
@@ -1110,9 +1125,9 @@ class PwsCube(ICRawBase):
         return pwsdtmd.PwsMetaData
 
     @classmethod
-    def fromHdfDataset(cls, d: h5py.Dataset):
-        """Load an PwsCube from an HDF5 dataset."""
-        data, index, mdDict, processingStatus = cls.decodeHdf(d)
+    def fromHdfDataset(cls, d: h5py.Dataset, slc: t_.Optional[t_.Tuple[slice, slice]] = None):
+        """Load an PwsCube from an HDF5 dataset. If `slc` is a tuple of (y, x) slices then only that region is loaded."""
+        data, index, mdDict, processingStatus = cls.decodeHdf(d, slc)
         md = pwsdtmd.PwsMetaData(mdDict, fileFormat=pwsdtmd.PwsMetaData.FileFormats.Hdf)
         return cls(data, md, processingStatus=processingStatus)
 
@@ -1383,15 +1398,16 @@ class KCube(ICBase):
         return cubeSlope, rSquared
 
     @classmethod
-    def fromHdfDataset(cls, dataset: h5py.Dataset):
+    def fromHdfDataset(cls, dataset: h5py.Dataset, slc: t_.Optional[t_.Tuple[slice, slice]] = None):
         """
         Load the KCube object from an `h5py.Dataset` in an HDF5 file
 
         Args:
             dataset: The `h5py.Dataset` that the KCube data is stored in.
+            slc: An optional tuple of (y, x) slices. If provided then only this region of the data is read from file.
         Returns:
             KCube: A new instance of this class."""
-        arr, index = cls.decodeHdf(dataset)
+        arr, index = cls.decodeHdf(dataset, slc)
         return cls(arr, index)
 
     def __add__(self, other):
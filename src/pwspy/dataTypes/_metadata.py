@@ -16,6 +16,7 @@
 # along with PWSpy.  If not, see <https://www.gnu.org/licenses/>.
 
 from __future__ import annotations
+import hashlib
 import json
 import logging
 import multiprocessing as mp
@@ -34,10 +35,12 @@ import numpy as np
 import tifffile as tf
 from scipy import io as spio
 from pwspy.dataTypes import _jsonSchemasPath
-from pwspy.dataTypes._other import CameraCorrection, Roi, RoiFile
+from pwspy.dataTypes._other import CameraCorrection, Roi, RoiFile, RoiSet
+from pwspy.dataTypes._analysisStore import AnalysisStore
+from pwspy.dataTypes._roiIndex import RoiIndex
 import pwspy.dataTypes._data as pwsdtd
 from pwspy import dateTimeFormat
-from pwspy.utility.misc import cached_property
+from pwspy.utility.misc import cached_property, _fileFingerprint, _writeJsonAtomic
 if t_.TYPE_CHECKING:
     from pwspy.analysis import AbstractHDFAnalysisResults
 
@@ -160,8 +163,31 @@ class MetaDataBase(abc.ABC):
         return d
 
 
+def _catalogEntry(g: h5py.Group) -> dict:
+    """Summarize saved analysis results for `AnalysisManager.getAnalysisCatalog`. Only the small string datasets are read, for the
+    data fields only the shape is recorded."""
+    entry = {'shapes': {}}
+    for k, dset in g.items():
+        if not isinstance(dset, h5py.Dataset):
+            continue
+        if dset.shape == () and dset.dtype.kind in ('S', 'O'):  # A string
+            value = bytes(np.array(dset)).decode()
+            if k == 'settings':
+                entry['settings'] = json.loads(value)
+                entry['settingsHash'] = hashlib.sha1(json.dumps(entry['settings'], sort_keys=True).encode()).hexdigest()
+            elif k == 'pwspy_version':
+                entry['pwspyVersion'] = value
+            else:
+                entry[k] = value
+        else:
+            entry['shapes'][k] = list(dset.shape)
+    return entry
+
+
 class AnalysisManager(abc.ABC):
-    """Handles the functionality to save, load, etc. analysis files.
+    """Handles the functionality to save, load, etc. analysis files. If an `AnalysisStore` containing the acquisition is open then
+    new analyses are saved to the store. Analyses already in the `analyses` folder are still listed and can be loaded, an analysis in the
+    store takes precedence over a file of the same name.
 
     Args:
         metadata: A dictionary containing the metadata
@@ -169,6 +195,8 @@ class AnalysisManager(abc.ABC):
         acquisitionDirectory: A reference to the `Acquisition` associated with this object.
 
     """
+    catalogFileName = 'analysisCatalog.json'  # The name of the file next to the `analyses` folder that holds the catalog of the analyses. Older versions expect every file in the `analyses` folder to be an analysis.
+
     def __init__(self, filePath: str):
         self.__filePath = filePath
 
@@ -201,12 +229,93 @@ class AnalysisManager(abc.ABC):
         Returns:
             A list of the names of analyses that were found.
         """
+        store = AnalysisStore.find(path)
+        names = store.getAnalyses(path, cls.getAnalysisResultsClass()) if store is not None else []
         anPath = os.path.join(path, 'analyses')
         if os.path.exists(anPath):
             files = os.listdir(os.path.join(path, 'analyses'))
-            return [cls.getAnalysisResultsClass().fileName2Name(f) for f in files]
+            names += [name for name in (cls._analysisNameOfFile(f) for f in files) if name is not None and name not in names]
+        return names
+
+    @classmethod
+    def _analysisNameOfFile(cls, fileName: str) -> t_.Optional[str]:
+        """The name of the analysis saved in `fileName`. `None` if this isn't an analysis file of this acquisition type."""
+        resultsClass = cls.getAnalysisResultsClass()
+        try:
+            name = resultsClass.fileName2Name(fileName)
+        except IndexError:
+            return None
+        return name if resultsClass.name2FileName(name) == fileName else None
+
+    def getAnalysisCatalog(self) -> t_.Dict[str, dict]:
+        """
+        Get a summary of each analysis without opening the analysis files. The summaries are kept in a small json file next to the
+        `analyses` folder. Summaries that are missing, or out of date because the analysis file has changed since, are created by
+        opening the analysis file and the catalog file is updated. If several processes save analyses of the same acquisition at the
+        same time some of their summaries may be lost, these are recreated here.
+
+        Returns:
+            A dictionary keyed by analysis name. Each entry is a dictionary with the `settings` (as a dictionary), `settingsHash`,
+            `time`, `imCubeIdTag`, `referenceIdTag`, `pwspyVersion`, and the `shapes` of the data fields of the analysis.
+        """
+        entries = self._getFolderCatalog()
+        store = AnalysisStore.find(self.__filePath)
+        if store is not None:  # The store file is already open so there is no need for a catalog of the analyses in the store.
+            resultsClass = self.getAnalysisResultsClass()
+            entries.update({name: _catalogEntry(store.loadAnalysis(self.__filePath, resultsClass, name).file) for name in store.getAnalyses(self.__filePath, resultsClass)})
+        return entries
+
+    def _getFolderCatalog(self) -> t_.Dict[str, dict]:
+        """The catalog entries of the analyses in the `analyses` folder, keyed by analysis name."""
+        anPath = os.path.join(self.__filePath, 'analyses')
+        if not os.path.exists(anPath):
+            return {}
+        catalog = self._readCatalog()
+        updated = {}  # The catalog entries keyed by file name.
+        with os.scandir(anPath) as it:
+            for dirEntry in it:
+                if self._analysisNameOfFile(dirEntry.name) is None:
+                    continue
+                entry = catalog.get(dirEntry.name)
+                if entry is None or entry.get('fingerprint') != _fileFingerprint(dirEntry.path):
+                    entry = self._fileCatalogEntry(dirEntry.path)
+                updated[dirEntry.name] = entry
+        if updated != catalog:
+            self._writeCatalog(updated)
+        return {self._analysisNameOfFile(fileName): entry for fileName, entry in updated.items()}
+
+    @staticmethod
+    def _fileCatalogEntry(path: str) -> dict:
+        with h5py.File(path, 'r') as hf:
+            entry = _catalogEntry(hf)
+        entry['fingerprint'] = _fileFingerprint(path)  # Used to detect analysis files that have changed since the entry was made.
+        return entry
+
+    def _updateCatalogEntry(self, fileName: str):
+        """Update the catalog entry of a single analysis file, or remove it if the file has been deleted. Other entries aren't checked."""
+        catalog = self._readCatalog()
+        path = os.path.join(self.__filePath, 'analyses', fileName)
+        if os.path.exists(path):
+            catalog[fileName] = self._fileCatalogEntry(path)
+        elif fileName in catalog:
+            del catalog[fileName]
         else:
-            return []
+            return
+        self._writeCatalog(catalog)
+
+    def _readCatalog(self) -> t_.Dict[str, dict]:
+        try:
+            with open(os.path.join(self.__filePath, self.catalogFileName), 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):  # The catalog doesn't exist yet or can't be read, it will be rebuilt.
+            return {}
+
+    def _writeCatalog(self, catalog: t_.Dict[str, dict]):
+        path = os.path.join(self.__filePath, self.catalogFileName)
+        try:
+            _writeJsonAtomic(path, catalog, indent=1)
+        except OSError as e:
+            logging.getLogger(__name__).warning(f"Failed to update the analysis catalog {path}: {e}")
 
     def saveAnalysis(self, analysis: AbstractHDFAnalysisResults, name: str, overwrite: bool = False):
         """
@@ -216,10 +325,17 @@ class AnalysisManager(abc.ABC):
             name: The name to save the analysis as
             overwrite: If `True` then any existing file of the same name will be replaced. If `False` an exception will be raised.
         """
+        store = AnalysisStore.find(self.__filePath)
+        if store is not None and not store.readOnly:
+            if not overwrite and os.path.exists(os.path.join(self.__filePath, 'analyses', analysis.name2FileName(name))):
+                raise OSError(f"The analysis {name} already exists in the `analyses` folder of {self.__filePath}.")
+            store.saveAnalysis(self.__filePath, analysis, name, overwrite=overwrite)
+            return
         path = os.path.join(self.__filePath, 'analyses')
         if not os.path.exists(path):
             os.mkdir(path)
         analysis.toHDF(path, name, overwrite=overwrite)
+        self._updateCatalogEntry(analysis.name2FileName(name))
 
     def loadAnalysis(self, name: str) -> AbstractHDFAnalysisResults:
         """
@@ -230,6 +346,9 @@ class AnalysisManager(abc.ABC):
         Returns:
             A new instance of an AnalysisResults object.
         """
+        store = AnalysisStore.find(self.__filePath)
+        if store is not None and store.hasAnalysis(self.__filePath, self.getAnalysisResultsClass(), name):
+            return store.loadAnalysis(self.__filePath, self.getAnalysisResultsClass(), name)
         return self.getAnalysisResultsClass().load(os.path.join(self.__filePath, 'analyses'), name)
 
     def removeAnalysis(self, name: str):
@@ -238,7 +357,13 @@ class AnalysisManager(abc.ABC):
         Args:
             name: The name of the analysis to be deleted
         """
-        os.remove(os.path.join(self.__filePath, 'analyses', self.getAnalysisResultsClass().name2FileName(name)))
+        store = AnalysisStore.find(self.__filePath)
+        if store is not None and store.hasAnalysis(self.__filePath, self.getAnalysisResultsClass(), name):
+            store.removeAnalysis(self.__filePath, self.getAnalysisResultsClass(), name)
+            return
+        fileName = self.getAnalysisResultsClass().name2FileName(name)
+        os.remove(os.path.join(self.__filePath, 'analyses', fileName))
+        self._updateCatalogEntry(fileName)
 
 
 class DynMetaData(MetaDataBase, AnalysisManager):
@@ -849,6 +974,43 @@ class Acquisition:
         assert self.filePath is not None
         return RoiFile.getValidRoisInPath(self.filePath)
 
+    def loadAllRois(self, names: t_.Optional[t_.Collection[str]] = None, useCache: bool = True) -> t_.List[RoiFile]:
+        """Load all of the Rois saved in the acquisition's file path, opening each file only once. Much faster than calling
+        `loadRoi` for each of the results of `getRois`. See documentation for RoiFile.loadAllFromPath()
+
+        Args:
+            names: If provided then only ROIs with one of these names are loaded.
+            useCache: If `True` then ROI files that haven't changed since they were last loaded are not read again.
+
+        Returns:
+            The loaded ROI files, sorted by name and number.
+        """
+        assert self.filePath is not None
+        return RoiFile.loadAllFromPath(self.filePath, names=names, useCache=useCache, acquisition=self)
+
+    def loadRoiSet(self, name: str) -> RoiSet:
+        """Load all of the Rois of the same name as a single `RoiSet`, labeled by their numbers. The Rois must not overlap.
+
+        Args:
+            name: The name of the Rois to load.
+
+        Returns:
+            A `RoiSet` containing the Rois.
+        """
+        roiFiles = self.loadAllRois(names=[name])
+        if len(roiFiles) == 0:
+            raise ValueError(f"No Rois named {name} were found in {self.filePath}.")
+        return RoiSet.fromRois([roiFile.getRoi() for roiFile in roiFiles], [roiFile.number for roiFile in roiFiles])
+
+    def getRoiIndex(self) -> RoiIndex:
+        """Load the spatial index of the Rois saved in the acquisition's file path. See documentation for RoiIndex.
+
+        Returns:
+            A `RoiIndex` that can be used to find the Rois at a position or overlapping a region.
+        """
+        assert self.filePath is not None
+        return RoiIndex.load(self.filePath)
+
     def loadRoi(self, name: str, num: int, fformat: RoiFile.FileFormats = None) -> RoiFile:
         """Load a Roi that has been saved to file in the acquisition's file path."""
 
@@ -856,7 +1018,7 @@ class Acquisition:
         assert isinstance(num, int), f"The ROI number must be an integer. Got a {type(num)}"
         if fformat == RoiFile.FileFormats.MAT:
             return RoiFile.fromMat(self.filePath, name, num, acquisition=self)
-        elif fformat == RoiFile.FileFormats.HDF3:
+        elif fformat in (RoiFile.FileFormats.HDF3, RoiFile.FileFormats.HDF4):
             return RoiFile.fromHDF(self.filePath, name, num, acquisition=self)
         elif fformat == RoiFile.FileFormats.HDF2:
             return RoiFile.fromHDF_legacy(self.filePath, name, num, acquisition=self)
@@ -885,6 +1047,24 @@ class Acquisition:
         """
         return RoiFile.toHDF(roi, roiName, roiNumber, self.filePath, overwrite=overwrite, acquisition=self)
 
+    def saveRois(self, roiName: str, rois: t_.Mapping[int, Roi], overwrite: bool = False) -> t_.List[RoiFile]:
+        """
+        Save many Rois of the same name to file in the acquisition's file path at once. See documentation for RoiFile.toHDFMany()
+
+        Args:
+            roiName: The name to identify the ROIs
+            rois: The ROI objects keyed by the numbers to identify them.
+            overwrite: If True then any existing ROIFiles matching these names and numbers will be overwritten. Otherwise an OSError is raised.
+
+        Returns:
+            A reference to the new ROIFile of each ROI.
+
+        Raises:
+            OSError: If `overwrite` is False and an ROI of the same name and number already exists then an OSError will be raised
+                and none of the ROIs are saved.
+        """
+        return RoiFile.toHDFMany(rois, roiName, self.filePath, overwrite=overwrite, acquisition=self)
+
     def deleteRoi(self, name: str, num: int, fformat: t_.Optional[RoiFile.FileFormats] = None):
         RoiFile.deleteRoi(self.filePath, name, num, fformat=fformat)
 
@@ -27,17 +27,20 @@ import logging
 import os
 import dataclasses
 from enum import Enum, auto
+from fnmatch import fnmatch
 from glob import glob
 import h5py
 import numpy as np
-from scipy import io as spio
+from scipy import io as spio, ndimage
 from shapely import geometry, wkb
 import cv2
 from rasterio import features
 import shapely
+from rasterio.transform import Affine
 import typing as t_
 import copy
 import pwspy.dataTypes._metadata as metadata
+from pwspy.utility.misc import LRUCache, _fileFingerprint
 
 
 @dataclasses.dataclass(frozen=True)
@@ -102,36 +105,112 @@ class Roi:
     mask, this is useful if you want to adjust the Roi later. Rather than calling the constructor directly you will
     generally create one of these objects through one of the `class methods` that construct one for you.
 
+    Internally only the region of the mask inside the `boundingBox` is stored (`croppedMask`), the full size `mask` is created
+    each time it is accessed and is read-only. Computations should use `croppedMask` with `boundingBox` where possible, e.g.
+    `data[roi.boundingBox][roi.croppedMask]` selects the same values as `data[roi.mask]` without creating a full size mask.
+
     Args:
-        mask: A 2D boolean array where the True values indicate pixels that are within the ROI.
-        verts: Can be a sequence of 2D (x, y) coordinates indicating the border of the ROI or a shapely `Polygon`.
-            If an array of coordinates is used then it will be converted to the shell of a shapely polygon internally.
+        mask: A 2D boolean array where the True values indicate pixels that are within the ROI. If `dataShape` is provided then
+            this is only a rectangular region of the full mask with its top left corner at `origin`.
+        verts: Can be a sequence of 2D (x, y) coordinates indicating the border of the ROI, a shapely `Polygon`, or the WKB bytes of a
+            polygon. If an array of coordinates is used then it will be converted to the shell of a shapely polygon internally.
             While this information is partially redundant with the mask it is useful for many applications and can be
-            complicated to calculate from `mask`.
+            complicated to calculate from `mask`. If `None` then the polygon is found from the outline of the mask. The `polygon`
+            is only created the first time it is accessed, ROIs that are only used for their mask never pay for it.
+        origin: The (y, x) position in the full mask of the first element of `mask`. Only used if `dataShape` is provided.
+        dataShape: The (y, x) shape of the full mask. If `None` then `mask` is the full mask.
     """
 
-    def __init__(self, mask: np.ndarray, verts: t_.Union[np.ndarray, geometry.Polygon]):
+    def __init__(self, mask: np.ndarray, verts: t_.Optional[t_.Union[np.ndarray, geometry.Polygon, bytes]], origin: t_.Tuple[int, int] = (0, 0),
+                 dataShape: t_.Optional[t_.Tuple[int, int]] = None):
         assert isinstance(mask, np.ndarray), f"Mask data is of type: {type(mask)}. Must be numpy array."
         assert len(mask.shape) == 2
         assert mask.dtype == np.bool
-        self.polygon: geometry.Polygon
-        if isinstance(verts, geometry.MultiPolygon):  # I'm not sure how but it is possible to get a multipolygon. In this case just select out the biggest polygon.
-            verts = verts[0]
-        if isinstance(verts, geometry.Polygon):
-            self.polygon = verts
-        else:
+        if isinstance(verts, np.ndarray):
             assert len(verts.shape) == 2
             assert verts.shape[1] == 2
-            self.polygon = geometry.Polygon(shell=verts)
-        self.polygon = self.polygon.buffer(0)  # This little trick `normalizes` the format of the polygon so that holes will plot properly. https://gis.stackexchange.com/questions/374001/plotting-shapely-polygon-with-holes-does-not-plot-all-holes
+        self._verts = verts  # The source of the polygon, converted to a polygon when `polygon` is first accessed.
+        self._polygon: t_.Optional[geometry.Polygon] = None
+        if dataShape is None:
+            origin, dataShape = (0, 0), mask.shape
+        self._setMask(mask, origin, tuple(int(i) for i in dataShape))
+
+    def _setMask(self, mask: np.ndarray, origin: t_.Tuple[int, int], dataShape: t_.Tuple[int, int]):
+        """Store only the smallest rectangle of `mask` that contains all of its `True` values."""
+        rows = np.nonzero(mask.any(axis=1))[0]
+        cols = np.nonzero(mask.any(axis=0))[0]
+        if len(rows) == 0:  # Empty mask
+            self._origin = (0, 0)
+            self._croppedMask = np.zeros((0, 0), dtype=bool)
+        else:
+            self._origin = (int(origin[0] + rows[0]), int(origin[1] + cols[0]))
+            self._croppedMask = np.ascontiguousarray(mask[rows[0]:rows[-1] + 1, cols[0]:cols[-1] + 1])
+        self._dataShape = dataShape
+
+    @property
+    def mask(self) -> np.ndarray:
+        """A full size boolean array where the True values indicate pixels that are within the ROI. A new array is created each
+        time this is accessed. The array is read-only since modifying it would not modify the ROI, a new mask can be assigned instead."""
+        mask = np.zeros(self._dataShape, dtype=bool)
+        mask[self.boundingBox] = self._croppedMask
+        mask.flags.writeable = False
+        return mask
 
-        self.mask = mask
+    @mask.setter
+    def mask(self, mask: np.ndarray):
+        self._setMask(mask, (0, 0), mask.shape)
+
+    @property
+    def croppedMask(self) -> np.ndarray:
+        """The region of `mask` selected by `boundingBox`. This is how the mask is stored."""
+        return self._croppedMask
+
+    @property
+    def dataShape(self) -> t_.Tuple[int, int]:
+        """The shape of the full `mask`, matching the shape of the image the ROI belongs to."""
+        return self._dataShape
+
+    @property
+    def polygon(self) -> geometry.Polygon:
+        """The shapely polygon enclosing the ROI. This is created the first time it is accessed."""
+        if self._polygon is None:
+            verts = self._verts
+            if verts is None:
+                verts = self._polygonFromMask()
+            elif isinstance(verts, bytes):
+                verts = wkb.loads(verts)
+            if isinstance(verts, geometry.MultiPolygon):  # I'm not sure how but it is possible to get a multipolygon. In this case just select out the biggest polygon.
+                verts = verts[0]
+            if not isinstance(verts, geometry.Polygon):
+                verts = geometry.Polygon(shell=verts)
+            self._polygon = verts.buffer(0)  # This little trick `normalizes` the format of the polygon so that holes will plot properly. https://gis.stackexchange.com/questions/374001/plotting-shapely-polygon-with-holes-does-not-plot-all-holes
+            self._verts = None  # No longer needed
+        return self._polygon
+
+    @polygon.setter
+    def polygon(self, polygon: geometry.Polygon):
+        self._polygon = polygon
+
+    def _polygonFromMask(self) -> geometry.Polygon:
+        """Use rasterio to find the outline of the mask. Only the cropped mask is traced, the result is shifted to the position of the bounding box."""
+        transform = Affine.translation(self._origin[1], self._origin[0])
+        all_polygons = []
+        for shape, value in features.shapes(self._croppedMask.astype(np.uint8), mask=self._croppedMask, transform=transform):
+            all_polygons.append(shapely.geometry.shape(shape))
+        return sorted(all_polygons, key=lambda ply: ply.area)[-1]  # Return the biggest found polygon
 
     @property
     def verts(self) -> np.ndarray:
         """An array of vertices for the outer ring of the polygon. For most ROIs they only have an outer ring anyway."""
         return np.array(self.polygon.exterior.coords)
 
+    @property
+    def boundingBox(self) -> t_.Tuple[slice, slice]:
+        """A tuple of (y, x) slices selecting the smallest rectangle of the image that contains the whole mask. `roi.mask[roi.boundingBox]`
+        gives the mask cropped to this region, which is also available as `croppedMask`."""
+        (y, x), (h, w) = self._origin, self._croppedMask.shape
+        return slice(y, y + h), slice(x, x + w)
+
     @classmethod
     def fromVerts(cls, verts: np.ndarray, dataShape: t_.Tuple[float, float]) -> Roi:
         """
@@ -153,11 +232,8 @@ class Roi:
         assert len(dataShape) == 2
         assert verts.shape[1] == 2
         assert len(verts.shape) == 2
-        iVerts = np.rint([verts]).astype(np.int32)  # The brackets here convert to a 3d array which is what cv2.fillpoly expects. We have to round to integers for cv2 to work.
-        mask = np.zeros(dataShape, dtype=np.int32)
-        cv2.fillPoly(mask, iVerts, 1)
-        mask = mask.astype(bool)
-        return cls(mask, verts)
+        mask, origin = _rasterize(verts, dataShape)
+        return cls(mask, verts, origin=origin, dataShape=dataShape)
 
     @classmethod
     def fromMask(cls, mask: np.ndarray) -> Roi:
@@ -172,13 +248,7 @@ class Roi:
         TODO:
             This function doesn't work properly if there is a `False` region of `mask` completely enclosed by a `True` region of `mask`.
         """
-
-        all_polygons = []
-        for shape, value in features.shapes(mask.astype(np.uint8), mask=mask):
-            all_polygons.append(shapely.geometry.shape(shape))
-
-        poly = sorted(all_polygons, key=lambda ply: ply.area)[-1]  # Return the biggest found polygon
-        return cls(mask=mask, verts=poly)
+        return cls(mask=mask, verts=None)  # The vertices are found when they are first needed.
 
     def transform(self, matrix: np.ndarray) -> Roi:
         """Return a copy of this Roi that has been transformed by an affine transform matrix like the one returned by
@@ -189,9 +259,305 @@ class Roi:
         Returns:
             A new instance of Roi representing this Roi after transformation.
         """
-        mask = cv2.warpAffine(self.mask.astype(np.uint8), matrix, self.mask.shape).astype(np.bool)
-        verts = cv2.transform(self.verts[None, :, :], matrix)[0, :, :]  # For some reason this needs to be 3d for opencv to work.
-        return Roi(mask=mask, verts=verts)
+        return Roi.transformMany([self], matrix)[0]
+
+    @staticmethod
+    def transformMany(rois: t_.Sequence[Roi], matrix: np.ndarray) -> t_.List[Roi]:
+        """Apply the same affine transform to many ROIs, e.g. to register all the ROIs of an acquisition to another image. The vertices
+        of all ROIs are transformed with a single call and each mask is only warped within its bounding box rather than the full image.
+
+        Args:
+            rois: The ROIs to transform.
+            matrix: A 2x3 numpy array representing an affine transformation.
+
+        Returns:
+            A new instance of Roi for each of `rois` after transformation.
+        """
+        matrix = np.asarray(matrix, dtype=np.float64)
+        needVerts = [roi._polygon is not None or roi._verts is not None for roi in rois]  # ROIs with no polygon yet are traced from the new mask if their polygon is needed.
+        verts = [roi.verts for roi, need in zip(rois, needVerts) if need]
+        if len(verts) > 0:
+            allVerts = cv2.transform(np.concatenate(verts)[None, :, :].astype(np.float64), matrix)[0, :, :]  # For some reason this needs to be 3d for opencv to work.
+            verts = np.split(allVerts, np.cumsum([len(v) for v in verts])[:-1])
+        verts = iter(verts)
+        transformed = []
+        for roi, need in zip(rois, needVerts):
+            mask, origin = _warpMask(roi, matrix)
+            transformed.append(Roi(mask, verts=next(verts) if need else None, origin=origin, dataShape=roi.dataShape))
+        return transformed
+
+
+class RoiSet:
+    """Many non-overlapping ROIs of the same image stored together as a single integer label image, e.g. the output of cell
+    segmentation. Statistics of every ROI are calculated together rather than with a separate full image masked reduction for each
+    ROI, and saving the label image takes much less space than saving a mask for each ROI.
+
+    Args:
+        labels: A 2D integer array. Pixels with a value of 0 are not part of any ROI, all other pixels belong to the ROI with the
+            number equal to their value.
+    """
+    def __init__(self, labels: np.ndarray):
+        assert isinstance(labels, np.ndarray), f"Label data is of type: {type(labels)}. Must be numpy array."
+        assert len(labels.shape) == 2
+        assert np.issubdtype(labels.dtype, np.integer)
+        self._labels = labels
+        self._numbers = np.unique(labels)
+        assert len(self._numbers) == 0 or self._numbers[0] >= 0, "Labels must not be negative."
+        self._numbers = self._numbers[self._numbers != 0]
+        self._index = None  # The flat indices of the labeled pixels, the index in `numbers` of each, and the pixel count of each ROI. Calculated when first needed.
+        self._boxes = None  # The bounding box of each ROI. Calculated when first needed.
+
+    @property
+    def labels(self) -> np.ndarray:
+        """The label image."""
+        return self._labels
+
+    @property
+    def numbers(self) -> np.ndarray:
+        """The sorted numbers of the ROIs. The statistics returned by this object are in this order."""
+        return self._numbers
+
+    def __len__(self):
+        return len(self._numbers)
+
+    @classmethod
+    def fromRois(cls, rois: t_.Sequence[Roi], numbers: t_.Optional[t_.Sequence[int]] = None) -> RoiSet:
+        """Combine ROIs into a label image.
+
+        Args:
+            rois: The ROIs. They must all have the same `dataShape` and must not overlap.
+            numbers: The number to label each ROI with. If `None` then the ROIs are numbered from 1.
+
+        Returns:
+            A new instance of `RoiSet`
+
+        Raises:
+            ValueError: If any of the ROIs overlap.
+        """
+        if numbers is None:
+            numbers = range(1, len(rois) + 1)
+        assert len(numbers) == len(rois)
+        assert len(rois) > 0
+        assert all(num > 0 for num in numbers), "ROI numbers must be positive, 0 is used for the background."
+        dataShape = rois[0].dataShape
+        assert all(roi.dataShape == dataShape for roi in rois), "All ROIs must be from images of the same shape."
+        dtype = np.min_scalar_type(max(numbers))
+        labels = np.zeros(dataShape, dtype=dtype)
+        for roi, num in zip(rois, numbers):
+            region = labels[roi.boundingBox]
+            if np.any(region[roi.croppedMask]):
+                raise ValueError(f"ROI number {num} overlaps another ROI. A `RoiSet` cannot contain overlapping ROIs.")
+            region[roi.croppedMask] = num
+        return cls(labels)
+
+    @classmethod
+    def fromVerts(cls, verts: t_.Sequence[np.ndarray], dataShape: t_.Tuple[int, int], numbers: t_.Optional[t_.Sequence[int]] = None) -> RoiSet:
+        """Rasterize many polygons into a single label image. Each polygon is only filled within its own bounding box, this is much
+        faster than creating each ROI with `Roi.fromVerts`.
+
+        Args:
+            verts: A sequence of arrays of 2D (x, y) coordinates, each indicating the border of an ROI.
+            dataShape: The shape of the label image.
+            numbers: The number to label each ROI with. If `None` then the ROIs are numbered from 1.
+
+        Returns:
+            A new instance of `RoiSet`
+
+        Raises:
+            ValueError: If any of the polygons overlap.
+        """
+        if numbers is None:
+            numbers = range(1, len(verts) + 1)
+        assert len(numbers) == len(verts)
+        assert all(num > 0 for num in numbers), "ROI numbers must be positive, 0 is used for the background."
+        labels = np.zeros(dataShape, dtype=np.min_scalar_type(max(numbers, default=0)))
+        for v, num in zip(verts, numbers):
+            mask, (y, x) = _rasterize(v, dataShape)
+            region = labels[y:y + mask.shape[0], x:x + mask.shape[1]]
+            if np.any(region[mask]):
+                raise ValueError(f"ROI number {num} overlaps another ROI. A `RoiSet` cannot contain overlapping ROIs.")
+            region[mask] = num
+        return cls(labels)
+
+    def toRois(self, tracePolygons: bool = False) -> t_.List[Roi]:
+        """Split the label image into separate ROIs, in the order of `numbers`.
+
+        Args:
+            tracePolygons: If `True` then the polygons of all ROIs are traced together with `getPolygons`. Otherwise the polygon of each
+                ROI is traced from its own mask when it is first accessed.
+
+        Returns:
+            The ROIs.
+        """
+        polygons = self.getPolygons() if tracePolygons else [None] * len(self)
+        return [Roi(self._labels[box] == num, verts=polygon, origin=(box[0].start, box[1].start), dataShape=self._labels.shape)
+                for num, box, polygon in zip(self._numbers, self._getBoxes(), polygons)]
+
+    def transform(self, matrix: np.ndarray) -> RoiSet:
+        """Return a copy of this RoiSet with the label image transformed by an affine transform matrix. All ROIs are transformed
+        with a single warp of the label image using nearest-neighbor interpolation.
+
+        Args:
+            matrix: A 2x3 numpy array representing an affine transformation.
+
+        Returns:
+            A new instance of RoiSet representing the ROIs after transformation.
+        """
+        labels = self._labels if self._labels.dtype in (np.uint8, np.uint16) else self._labels.astype(np.float32)  # The types supported by opencv. float32 is exact for labels below 2**24
+        warped = cv2.warpAffine(labels, np.asarray(matrix, dtype=np.float64), (labels.shape[1], labels.shape[0]), flags=cv2.INTER_NEAREST)
+        return RoiSet(warped.astype(self._labels.dtype))
+
+    def getPolygons(self) -> t_.List[geometry.Polygon]:
+        """Trace the outline of every ROI with a single pass over the label image.
+
+        Returns:
+            The polygon of each ROI in the order of `numbers`. If an ROI is made of more than one separate region then the largest is used.
+        """
+        labels = self._labels if self._labels.dtype in (np.uint8, np.uint16, np.int16, np.int32) else self._labels.astype(np.int32)  # The types supported by rasterio
+        polygons = {}
+        for shape, value in features.shapes(labels, mask=labels != 0):
+            poly = shapely.geometry.shape(shape)
+            if value not in polygons or poly.area > polygons[value].area:
+                polygons[value] = poly
+        return [polygons[num] for num in self._numbers]
+
+    def _getBoxes(self) -> t_.List[t_.Tuple[slice, slice]]:
+        """The bounding box of each ROI in the order of `numbers`, found in a single pass over the label image."""
+        if self._boxes is None:
+            boxes = ndimage.find_objects(self._labels)  # Indexed by label value - 1
+            self._boxes = [boxes[num - 1] for num in self._numbers]
+        return self._boxes
+
+    def _getIndex(self) -> t_.Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """The flat indices of the labeled pixels, the index in `numbers` of the ROI that each belongs to, and the number of pixels in each ROI."""
+        if self._index is None:
+            flat = self._labels.ravel()
+            pixels = np.flatnonzero(flat)
+            index = np.searchsorted(self._numbers, flat[pixels])
+            self._index = (pixels, index, np.bincount(index, minlength=len(self)))
+        return self._index
+
+    def count(self) -> np.ndarray:
+        """The number of pixels in each ROI."""
+        return self._getIndex()[2].copy()
+
+    def mean(self, arr: np.ndarray) -> np.ndarray:
+        """The average of a 2D array over each ROI.
+
+        Args:
+            arr: A 2D array of the same shape as `labels`.
+
+        Returns:
+            The average for each ROI in the order of `numbers`.
+        """
+        assert arr.shape == self._labels.shape
+        pixels, index, count = self._getIndex()
+        return np.bincount(index, weights=arr.ravel()[pixels], minlength=len(self)) / count
+
+    def std(self, arr: np.ndarray) -> np.ndarray:
+        """The standard deviation of a 2D array over each ROI.
+
+        Args:
+            arr: A 2D array of the same shape as `labels`.
+
+        Returns:
+            The standard deviation for each ROI in the order of `numbers`.
+        """
+        pixels, index, count = self._getIndex()
+        deviation = arr.ravel()[pixels] - self.mean(arr)[index]
+        return np.sqrt(np.bincount(index, weights=deviation**2, minlength=len(self)) / count)
+
+    def meanSpectra(self, data: np.ndarray) -> t_.Tuple[np.ndarray, np.ndarray]:
+        """The average and standard deviation of the spectra of a 3D array over each ROI. Only the bounding box of each ROI is read
+        from `data` so the total work is proportional to the area of the ROIs rather than the full image for each ROI.
+
+        Args:
+            data: A 3D array with the first two axes matching the shape of `labels`, e.g. the `data` of a `PwsCube`.
+
+        Returns:
+            The average spectra and the standard deviation of the spectra, each with shape (number of ROIs, length of the third axis of `data`).
+        """
+        assert data.shape[:2] == self._labels.shape
+        mean = np.zeros((len(self), data.shape[2]), dtype=data.dtype)
+        std = np.zeros_like(mean)
+        for i, (num, box) in enumerate(zip(self._numbers, self._getBoxes())):  # Gathering one ROI at a time keeps the gathered values small enough to stay in the CPU cache.
+            values = data[box][self._labels[box] == num]
+            mean[i] = values.mean(axis=0)
+            std[i] = values.std(axis=0)
+        return mean, std
+
+    def toHDF(self, filePath: str, overwrite: bool = False):
+        """Save the label image to an HDF file. This is much smaller than saving a mask for each ROI.
+
+        Args:
+            filePath: The path of the file to save to.
+            overwrite: If `True` then an existing file will be replaced. Otherwise an OSError is raised.
+        """
+        if os.path.exists(filePath) and not overwrite:
+            raise OSError(f"The file {filePath} already exists.")
+        dtype = np.min_scalar_type(self._numbers.max() if len(self) > 0 else 0)
+        with h5py.File(filePath, 'w') as hf:
+            hf.attrs['fileFormat'] = 'RoiSet'
+            hf.create_dataset('labels', data=self._labels.astype(dtype), compression=5)
+
+    @classmethod
+    def fromHDF(cls, filePath: str) -> RoiSet:
+        """Load a `RoiSet` that was saved with `toHDF`.
+
+        Args:
+            filePath: The path of the file.
+
+        Returns:
+            A new instance of `RoiSet`
+        """
+        with h5py.File(filePath, 'r') as hf:
+            assert hf.attrs.get('fileFormat') == 'RoiSet', f"{filePath} is not a RoiSet file."
+            return cls(np.array(hf['labels']))
+
+
+def _warpMask(roi: Roi, matrix: np.ndarray) -> t_.Tuple[np.ndarray, t_.Tuple[int, int]]:
+    """Warp the cropped mask of an ROI by an affine transform. Only the region of the image that the bounding box is transformed to is calculated.
+
+    Returns:
+        The warped mask and the (y, x) position of its top left corner.
+    """
+    (ys, xs), dataShape = roi.boundingBox, roi.dataShape
+    if roi.croppedMask.size == 0:
+        return np.zeros((0, 0), dtype=bool), (0, 0)
+    corners = np.array([[xs.start, ys.start], [xs.stop, ys.start], [xs.start, ys.stop], [xs.stop, ys.stop]], dtype=np.float64)
+    corners = corners @ matrix[:, :2].T + matrix[:, 2]
+    x0, y0 = np.clip(np.floor(corners.min(axis=0)).astype(int) - 1, 0, [dataShape[1], dataShape[0]])  # Leave a margin for interpolation.
+    x1, y1 = np.clip(np.ceil(corners.max(axis=0)).astype(int) + 1, 0, [dataShape[1], dataShape[0]])
+    if x1 <= x0 or y1 <= y0:  # Transformed out of the image
+        return np.zeros((0, 0), dtype=bool), (0, 0)
+    localMatrix = matrix.copy()  # The transform from the coordinates of the cropped mask to the coordinates of the output region.
+    localMatrix[:, 2] = matrix[:, :2] @ [xs.start, ys.start] + matrix[:, 2] - [x0, y0]
+    mask = cv2.warpAffine(roi.croppedMask.astype(np.uint8), localMatrix, (int(x1 - x0), int(y1 - y0))).astype(bool)
+    return mask, (int(y0), int(x0))
+
+
+def _rasterize(verts: np.ndarray, dataShape: t_.Tuple[int, int]) -> t_.Tuple[np.ndarray, t_.Tuple[int, int]]:
+    """Fill a polygon into a boolean mask covering only its bounding box (clipped to `dataShape`).
+
+    Returns:
+        The mask of the bounding box and the (y, x) position of the bounding box.
+    """
+    iVerts = np.rint(verts).astype(np.int32)  # We have to round to integers for cv2 to work.
+    y0, x0 = np.clip(iVerts[:, 1].min(), 0, dataShape[0]), np.clip(iVerts[:, 0].min(), 0, dataShape[1])
+    y1, x1 = np.clip(iVerts[:, 1].max() + 1, 0, dataShape[0]), np.clip(iVerts[:, 0].max() + 1, 0, dataShape[1])
+    mask = np.zeros((max(y1 - y0, 0), max(x1 - x0, 0)), dtype=np.uint8)
+    if mask.size > 0:
+        cv2.fillPoly(mask, [iVerts], 1, offset=(-int(x0), -int(y0)))  # Shift the polygon into the bounding box.
+    return mask.astype(bool), (int(y0), int(x0))
+
+
+def _roiCacheSize(rois: t_.List[t_.Tuple[int, Roi, RoiFile.FileFormats]]) -> int:
+    """Estimate the memory used by the ROIs of a file."""
+    return sum(roi.croppedMask.nbytes + 1000 for _, roi, _ in rois)
+
+
+roiCache = LRUCache(maxBytes=2**28, sizeOf=_roiCacheSize)
+"""The cache used by `RoiFile.loadAllFromPath`. Keyed by the path, modification time, and size of each ROI file."""
 
 
 class RoiFile:
@@ -214,6 +580,9 @@ class RoiFile:
         HDF = auto()  # This was originally the default file format of this Python software. Each ROI of the same name was saved as a dataset in an HDF file. The dataset contained the boolean mask.
         HDF2 = auto()  # For a long time this was the default. Each ROI of the same name is saved as an H5PY.Group in an HDF file. Each ROI group contains a dataset for the boolean mask as well as a dataset for the XY coordinates of the enclosing polygon. This saves us from having to constantly recalculate the outline of the ROI for processing purposes.
         HDF3 = auto()  # On 3/26/2021 We switched to this from HDF2. Rather than verts we now store 'wkb' of the underlying shapely file. Allow for ROIs with holes, and other more complex situations.
+        HDF4 = auto()  # The same as HDF3 except that only the bounding box region of the mask is saved, its position and the full size of the mask are saved as the `origin` and `dataShape` attributes. Smaller and faster to load, but can't be read by versions of PWSpy from before it was added.
+
+    writeFileFormat: FileFormats = FileFormats.HDF3  # The format used by `toHDF` and `toHDFMany` when none is specified. Set to `HDF4` to opt in to saving only the bounding box of the masks.
 
     def __init__(self, name: str, number: int, roi: Roi, filePath: str, fileFormat: RoiFile.FileFormats, acquisition: metadata.Acquisition):
         self._roi = roi
@@ -236,12 +605,14 @@ class RoiFile:
         return f"RoiFile({self.name}, {self.number})"
 
     @staticmethod
-    def getValidRoisInPath(path: str) -> t_.List[t_.Tuple[str, int, RoiFile.FileFormats]]:
+    def getValidRoisInPath(path: str, fileNames: t_.Optional[t_.Sequence[str]] = None) -> t_.List[t_.Tuple[str, int, RoiFile.FileFormats]]:
         """Search the `path` for valid roiFile files and return the detected rois as a list of tuple where each tuple
         contains the `name`, `number`, and file format for the Roi.
 
         Args:
             path: The path to the folder containing the Roi files.
+            fileNames: The names of the files in `path`. If these are already known (e.g. from `os.walk`) then providing them
+                avoids listing the folder again.
 
         Returns:
             A list of tuples containing:
@@ -250,39 +621,17 @@ class RoiFile:
                 fformat: The file format of the file that the Roi is stored in
         """
         patterns = [('BW*_*.mat', RoiFile.FileFormats.MAT), ('ROI_*.h5', RoiFile.FileFormats.HDF)]
-        files = {fformat: glob(os.path.join(path, p)) for p, fformat in patterns}  # Lists of the found files keyed by file format
+        if fileNames is None:
+            files = {fformat: glob(os.path.join(path, p)) for p, fformat in patterns}  # Lists of the found files keyed by file format
+        else:
+            files = {fformat: [os.path.join(path, f) for f in fileNames if fnmatch(f, p)] for p, fformat in patterns}
         ret = []
         for fformat, fileNames in files.items():
-            if fformat == RoiFile.FileFormats.HDF:  # Could still technically be HDF2 or HDF3
+            if fformat == RoiFile.FileFormats.HDF:  # Could still technically be HDF2, HDF3, or HDF4
                 for i in fileNames:
+                    name = os.path.basename(i)[4:-3]  # Strip the `ROI_` prefix and `.h5` suffix.
                     with h5py.File(i, 'r') as hf:  # making sure to open this file in read mode makes the function way faster!
-                        for g in hf.keys():
-                            if isinstance(hf[g], h5py.Group):  # HDF3 or HDF2 file format
-                                if 'fileFormat' in hf[g].attrs:  # HDF3 format
-                                    assert 'wkb' in hf[g]
-                                    assert 'ROI_' in i
-                                    name = i.split("ROI_")[-1][:-3]
-                                    try:
-                                        ret.append((name, int(g), RoiFile.FileFormats.HDF3))
-                                    except ValueError:
-                                        logging.getLogger(__name__).warning(f"File {i} contains uninterpretable dataset named {g}")
-                                else:  # HDF2 did not have this fileformat attribute
-                                    if 'mask' in hf[g] and 'verts' in hf[g]:
-                                        assert 'ROI_' in i
-                                        name = i.split("ROI_")[-1][:-3]
-                                        try:
-                                            ret.append((name, int(g), RoiFile.FileFormats.HDF2))
-                                        except ValueError:
-                                            logging.getLogger(__name__).warning(f"File {i} contains uninterpretable dataset named {g}")
-                                    else:
-                                        raise ValueError("File is missing datasets")
-                            elif isinstance(hf[g], h5py.Dataset):  # Legacy format
-                                assert 'roi_' in i
-                                name = i.split('roi_')[-1][:-3]  # Old files used lower case rather than "ROI_"
-                                try:
-                                    ret.append((name, int(g), RoiFile.FileFormats.HDF))
-                                except ValueError:
-                                    logging.getLogger(__name__).warning(f"File {i} contains uninterpretable dataset named {g}")
+                        ret.extend((name, number, roiFormat) for number, roiFormat in RoiFile._getHDFManifest(hf))
 
             elif fformat == RoiFile.FileFormats.MAT:
                 for i in fileNames:  # list in files
@@ -294,6 +643,91 @@ class RoiFile:
                     ret.append((name, num, RoiFile.FileFormats.MAT))
         return ret
 
+    @classmethod
+    def loadAllFromPath(cls, path: str, names: t_.Optional[t_.Collection[str]] = None, fileNames: t_.Optional[t_.Sequence[str]] = None,
+                        useCache: bool = True, acquisition: metadata.Acquisition = None) -> t_.List[RoiFile]:
+        """Load every ROI in `path`. Unlike calling `getValidRoisInPath` followed by a load method for each ROI, each file is only opened
+        once.
+
+        Args:
+            path: The path to the folder containing the Roi files.
+            names: If provided then only ROIs with one of these names are loaded. Files of other ROIs are not opened.
+            fileNames: The names of the files in `path`. If these are already known (e.g. from `os.walk`) then providing them
+                avoids listing the folder again.
+            useCache: If `True` then the ROIs of each file are kept in `roiCache`, keyed by the modification time and size of the file,
+                and files that haven't changed since they were last loaded are not read again.
+            acquisition: The acquisition that the ROIs belong to.
+
+        Returns:
+            The loaded ROI files, sorted by name and number.
+        """
+        if fileNames is None:
+            fileNames = os.listdir(path)
+        roiFiles = []
+        for fileName in fileNames:
+            if fnmatch(fileName, 'ROI_*.h5'):
+                name, reader = fileName[4:-3], RoiFile._readHDFRois
+            elif fnmatch(fileName, 'BW*_*.mat') and len(fileName.split('_')) == 2:  # Some old data has files that are not ROIs but are named almost identically.
+                name, reader = fileName.split('_')[1][:-4], RoiFile._readMatRois
+            else:
+                continue
+            if names is not None and name not in names:
+                continue
+            filePath = os.path.join(path, fileName)
+            if useCache:
+                st = os.stat(filePath)
+                key = (filePath, st.st_mtime_ns, st.st_size)
+                rois = roiCache.get(key)
+                if rois is None:
+                    rois = reader(filePath)
+                    roiCache.put(key, rois)
+            else:
+                rois = reader(filePath)
+            roiFiles += [cls(name, number, roi, filePath=filePath, fileFormat=fformat, acquisition=acquisition) for number, roi, fformat in rois]
+        return sorted(roiFiles, key=lambda roiFile: (roiFile.name, roiFile.number))
+
+    @staticmethod
+    def _readHDFRois(filePath: str) -> t_.List[t_.Tuple[int, Roi, RoiFile.FileFormats]]:
+        """Read the number, ROI, and file format of each ROI in an HDF file of any of the HDF formats."""
+        rois = []
+        with h5py.File(filePath, 'r') as hf:
+            for g, item in hf.items():
+                try:
+                    number = int(g)
+                except ValueError:
+                    logging.getLogger(__name__).warning(f"File {filePath} contains uninterpretable dataset named {g}")
+                    continue
+                rois.append((number,) + RoiFile._roiFromHDF(item))
+        return rois
+
+    @staticmethod
+    def _readMatRois(filePath: str) -> t_.List[t_.Tuple[int, Roi, RoiFile.FileFormats]]:
+        """Read the ROI of a .mat file. These files only contain one ROI."""
+        directory, fileName = os.path.split(filePath)
+        number, name = int(fileName.split('_')[0][2:]), fileName.split('_')[1][:-4]
+        return [(number, RoiFile.fromMat(directory, name, number).getRoi(), RoiFile.FileFormats.MAT)]
+
+    @staticmethod
+    def _roiFromHDF(item: t_.Union[h5py.Group, h5py.Dataset]) -> t_.Tuple[Roi, RoiFile.FileFormats]:
+        """Create an ROI from the group (or dataset for the oldest format) that it was saved to in an HDF file."""
+        if isinstance(item, h5py.Dataset):  # The oldest HDF format, only the mask was saved.
+            return Roi(np.array(item).astype(np.bool), verts=None), RoiFile.FileFormats.HDF
+        elif 'fileFormat' not in item.attrs:  # HDF2
+            verts = item['verts']
+            if verts.shape is None:
+                roi = Roi(np.array(item['mask']).astype(np.bool), verts=None)  # Some old files could be saved without verts. allow loading them.
+            else:
+                roi = Roi(np.array(item['mask']).astype(np.bool), verts=np.array(verts))
+            return roi, RoiFile.FileFormats.HDF2
+        fformat = RoiFile.FileFormats[item.attrs['fileFormat']]
+        polygon = bytes(item['wkb'][()])  # Parsed by the Roi when it is first needed.
+        mask = np.array(item['mask']).astype(np.bool)
+        if fformat == RoiFile.FileFormats.HDF4:
+            roi = Roi(mask, verts=polygon, origin=tuple(item.attrs['origin']), dataShape=tuple(item.attrs['dataShape']))
+        else:
+            roi = Roi(mask, verts=polygon)
+        return roi, fformat
+
     @staticmethod
     def deleteRoi(directory: str, name: str, number: int, fformat: t_.Optional[RoiFile.FileFormats] = None):
         """Delete the dataset associated with the Roi object specified by `name` and `num`.
@@ -310,7 +744,7 @@ class RoiFile:
         assert os.path.isdir(directory)
         if fformat is RoiFile.FileFormats.MAT:
             path = os.path.join(directory, f"BW{number}_{name}.mat")
-        elif fformat in [RoiFile.FileFormats.HDF, RoiFile.FileFormats.HDF2, RoiFile.FileFormats.HDF3]:
+        elif fformat in [RoiFile.FileFormats.HDF, RoiFile.FileFormats.HDF2, RoiFile.FileFormats.HDF3, RoiFile.FileFormats.HDF4]:
             path = os.path.join(directory, f"ROI_{name}.h5")
         elif fformat is None:  # AutoDetect the file format
             try:
@@ -327,19 +761,24 @@ class RoiFile:
 
         if not os.path.exists(path):
             raise FileNotFoundError(f"The ROI file {name},{number} and format {fformat} was not found in {directory}.")
+        previousFingerprint = _fileFingerprint(path)
 
-        if fformat in [RoiFile.FileFormats.HDF, RoiFile.FileFormats.HDF2, RoiFile.FileFormats.HDF3]:
+        if fformat in [RoiFile.FileFormats.HDF, RoiFile.FileFormats.HDF2, RoiFile.FileFormats.HDF3, RoiFile.FileFormats.HDF4]:
             with h5py.File(path, 'a') as hf:
                 if np.string_(str(number)) not in hf.keys():
                     raise ValueError(f"The file {path} does not contain ROI number {number}.")
+                manifest = [m for m in RoiFile._getHDFManifest(hf) if m[0] != number]
                 del hf[np.string_(str(number))]
                 remaining = len(list(hf.keys()))
+                if remaining > 0:
+                    RoiFile._setHDFManifest(hf, manifest)
             if remaining == 0:  # If the file is empty then remove it.
                 os.remove(path)
         elif fformat is RoiFile.FileFormats.MAT:
             os.remove(path)
         else:
             raise Exception("Programming error.")
+        RoiFile._refreshIndex(path, [number], previousFingerprint)
 
     @classmethod
     def fromHDF_legacy_legacy(cls, directory: str, name: str, number: int, acquisition: metadata.Acquisition = None) -> RoiFile:
@@ -408,12 +847,10 @@ class RoiFile:
         with h5py.File(path, 'r') as hf:
             group = hf[str(number)]
             assert 'fileFormat' in group.attrs, "No fileFormat attribute found for the ROI file. Try using one of the legacy ROI loading methods."
-            assert group.attrs['fileFormat'] == RoiFile.FileFormats.HDF3.name, f'Only HDF3 format is supported by this loading method, not {group.attrs["fileFormat"]}'
-            wkbBytes = bytes(group['wkb'][()])
-            polygon = wkb.loads(wkbBytes)
-            mask = np.array(group['mask']).astype(np.bool)
-            roi = Roi(mask, verts=polygon)
-            return cls(name, number, roi, filePath=path, fileFormat=RoiFile.FileFormats.HDF3, acquisition=acquisition)
+            fformat = group.attrs['fileFormat']
+            assert fformat in (RoiFile.FileFormats.HDF3.name, RoiFile.FileFormats.HDF4.name), f'Only HDF3 and HDF4 formats are supported by this loading method, not {fformat}'
+            roi, fformat = RoiFile._roiFromHDF(group)
+            return cls(name, number, roi, filePath=path, fileFormat=fformat, acquisition=acquisition)
 
     @classmethod
     def fromMat(cls, directory: str, name: str, number: int, acquisition: metadata.Acquisition = None) -> RoiFile:
@@ -461,7 +898,8 @@ class RoiFile:
                     return RoiFile.fromMat(directory, name, number, acquisition=acquisition)
 
     @classmethod
-    def toHDF(cls, roi: Roi, name: str, number: int, directory: str, overwrite: t_.Optional[bool] = False, acquisition: metadata.Acquisition = None) -> RoiFile:
+    def toHDF(cls, roi: Roi, name: str, number: int, directory: str, overwrite: t_.Optional[bool] = False, acquisition: metadata.Acquisition = None,
+              fileFormat: t_.Optional[RoiFile.FileFormats] = None) -> RoiFile:
         """
         Save the Roi to an HDF file in the specified directory. The filename is automatically chosen based on the
         `name` parameter of the Roi. Multiple Roi's with the same `name` will be saved into the same file if they have
@@ -475,21 +913,136 @@ class RoiFile:
             directory: The path of the folder to save the new HDF file to. The file will be named automatically based
                 on the `name` attribute of the Roi
             overwrite: If True then if an Roi with the same `number` as this Roi is found it will be overwritten.
+            fileFormat: `HDF3` or `HDF4`. If `None` then the class attribute `writeFileFormat` is used.
         """
+        fileFormat = RoiFile._checkWriteFormat(fileFormat)
         savePath = os.path.join(directory, f'ROI_{name}.h5')
+        previousFingerprint = _fileFingerprint(savePath)
         numStr = np.string_(str(number))
-        mask = roi.mask.astype(np.uint8)
         with h5py.File(savePath, 'a') as hf:
+            manifest = [m for m in RoiFile._getHDFManifest(hf) if m[0] != number]
             if numStr in hf.keys():
                 if overwrite:
                     del hf[numStr]
                 else:
                     raise OSError(f"The Roi file {savePath} already contains a dataset {number}")
-            g = hf.create_group(numStr)
-            g.attrs['fileFormat'] = RoiFile.FileFormats.HDF3.name
-            g.create_dataset(np.string_("wkb"), data=np.void(roi.polygon.wkb))  # np.void is required here so we can save a byte array with `null` in it.
-            g.create_dataset(np.string_("mask"), data=mask, compression=5)
-        return cls(name, number, roi, filePath=savePath, fileFormat=RoiFile.FileFormats.HDF2, acquisition=acquisition)
+            RoiFile._writeHDFGroup(hf, number, roi, fileFormat)
+            RoiFile._setHDFManifest(hf, manifest + [(number, fileFormat)])
+        RoiFile._refreshIndex(savePath, [number], previousFingerprint)
+        return cls(name, number, roi, filePath=savePath, fileFormat=fileFormat, acquisition=acquisition)
+
+    @classmethod
+    def toHDFMany(cls, rois: t_.Mapping[int, Roi], name: str, directory: str, overwrite: bool = False, acquisition: metadata.Acquisition = None,
+                  fileFormat: t_.Optional[RoiFile.FileFormats] = None) -> t_.List[RoiFile]:
+        """
+        Save many ROIs of the same `name` at once. Much faster than calling `toHDF` for each ROI since the file is only opened once.
+        A complete new file is written next to the existing one, containing the ROIs already in the file plus the new ROIs, and then
+        moved into place. This means that the file is never left partially written and that space left by deleted ROIs is recovered.
+
+        Args:
+            rois: The ROIs to save keyed by their numbers.
+            name: The name to save as. This will be part of the file name
+            directory: The path of the folder to save the HDF file to.
+            overwrite: If True then any existing ROIs with the same numbers will be overwritten. Otherwise an OSError is raised and nothing is saved.
+            fileFormat: `HDF3` or `HDF4`. If `None` then the class attribute `writeFileFormat` is used.
+
+        Returns:
+            A reference to the new ROIFile of each ROI.
+        """
+        fileFormat = RoiFile._checkWriteFormat(fileFormat)
+        savePath = os.path.join(directory, f'ROI_{name}.h5')
+        previousFingerprint = _fileFingerprint(savePath)
+        tempPath = savePath + '.part'
+        newKeys = {str(number) for number in rois}
+        manifest = []
+        try:
+            with h5py.File(tempPath, 'w') as hf:
+                if os.path.exists(savePath):
+                    with h5py.File(savePath, 'r') as oldFile:
+                        oldManifest = dict(RoiFile._getHDFManifest(oldFile))
+                        for key in oldFile.keys():
+                            if key in newKeys:
+                                if not overwrite:
+                                    raise OSError(f"The Roi file {savePath} already contains a dataset {key}")
+                                continue
+                            oldFile.copy(oldFile[key], hf, name=key)  # Copying into a new file leaves no unused space behind.
+                            try:
+                                number = int(key)
+                            except ValueError:  # Not an ROI, e.g. written by another program. Keep it but leave it out of the manifest.
+                                continue
+                            if number in oldManifest:
+                                manifest.append((number, oldManifest[number]))
+                for number, roi in rois.items():
+                    RoiFile._writeHDFGroup(hf, number, roi, fileFormat)
+                    manifest.append((number, fileFormat))
+                RoiFile._setHDFManifest(hf, manifest)
+            os.replace(tempPath, savePath)
+        finally:
+            if os.path.exists(tempPath):
+                os.remove(tempPath)
+        RoiFile._refreshIndex(savePath, rois.keys(), previousFingerprint)
+        return [cls(name, number, roi, filePath=savePath, fileFormat=fileFormat, acquisition=acquisition) for number, roi in rois.items()]
+
+    @staticmethod
+    def _getHDFManifest(hf: h5py.File) -> t_.List[t_.Tuple[int, RoiFile.FileFormats]]:
+        """Return the number and format of each ROI in an HDF ROI file. The `roiManifest` attribute of the file is used if it is
+        present and up to date, otherwise every group of the file is inspected."""
+        if 'roiManifest' in hf.attrs:
+            manifest = [(int(number), RoiFile.FileFormats[roiFormat.decode()]) for number, roiFormat in hf.attrs['roiManifest']]
+            if {str(number) for number, roiFormat in manifest} == {k for k in hf.keys() if k.isdigit()}:  # Older versions of PWSpy modify files without updating the manifest.
+                return manifest
+        ret = []
+        for g, item in hf.items():
+            try:
+                number = int(g)
+            except ValueError:
+                logging.getLogger(__name__).warning(f"File {hf.filename} contains uninterpretable dataset named {g}")
+                continue
+            if isinstance(item, h5py.Group):
+                if 'fileFormat' in item.attrs:  # HDF3 or HDF4 format
+                    roiFormat = RoiFile.FileFormats[item.attrs['fileFormat']]
+                elif 'mask' in item and 'verts' in item:  # HDF2 did not have this fileformat attribute
+                    roiFormat = RoiFile.FileFormats.HDF2
+                else:
+                    raise ValueError("File is missing datasets")
+            else:  # Legacy format
+                roiFormat = RoiFile.FileFormats.HDF
+            ret.append((number, roiFormat))
+        return ret
+
+    @staticmethod
+    def _setHDFManifest(hf: h5py.File, manifest: t_.Iterable[t_.Tuple[int, RoiFile.FileFormats]]):
+        """Save the number and format of each ROI in an HDF ROI file to the `roiManifest` attribute so that `getValidRoisInPath` doesn't
+        need to inspect every group of the file."""
+        hf.attrs['roiManifest'] = np.array([(number, roiFormat.name) for number, roiFormat in sorted(manifest, key=lambda m: m[0])],
+                                           dtype=[('number', np.int64), ('fileFormat', 'S8')])
+
+    @staticmethod
+    def _refreshIndex(filePath: str, numbers: t_.Iterable[int], previousFingerprint: t_.Optional[str]):
+        """Update the `RoiIndex` of the folder, if it has one, after the ROIs `numbers` of an ROI file have been saved or deleted.
+        `previousFingerprint` is the `_fileFingerprint` of the file from before it was modified."""
+        from pwspy.dataTypes._roiIndex import RoiIndex  # Imported here to avoid a circular import.
+        RoiIndex.refreshFile(os.path.dirname(filePath), os.path.basename(filePath), numbers=numbers, previousFingerprint=previousFingerprint)
+
+    @classmethod
+    def _checkWriteFormat(cls, fileFormat: t_.Optional[RoiFile.FileFormats]) -> RoiFile.FileFormats:
+        fileFormat = fileFormat if fileFormat is not None else cls.writeFileFormat
+        if fileFormat not in (RoiFile.FileFormats.HDF3, RoiFile.FileFormats.HDF4):
+            raise ValueError(f"ROIs can only be saved in the HDF3 or HDF4 format, not {fileFormat}.")
+        return fileFormat
+
+    @staticmethod
+    def _writeHDFGroup(hf: h5py.File, number: int, roi: Roi, fileFormat: RoiFile.FileFormats):
+        """Write an ROI to a new group in an HDF file using the HDF3 or HDF4 file format."""
+        g = hf.create_group(np.string_(str(number)))
+        g.attrs['fileFormat'] = fileFormat.name
+        g.create_dataset(np.string_("wkb"), data=np.void(roi.polygon.wkb))  # np.void is required here so we can save a byte array with `null` in it.
+        if fileFormat is RoiFile.FileFormats.HDF4:
+            g.attrs['origin'] = np.array([roi.boundingBox[0].start, roi.boundingBox[1].start])
+            g.attrs['dataShape'] = np.array(roi.dataShape)
+            g.create_dataset(np.string_("mask"), data=roi.croppedMask.astype(np.uint8), compression=5)
+        else:
+            g.create_dataset(np.string_("mask"), data=roi.mask.astype(np.uint8), compression=5)
 
     def delete(self):
         """
@@ -506,7 +1059,7 @@ class RoiFile:
             roi: The updated ROI to save
         """
         assert not self.isDeleted
-        if self.fformat not in [RoiFile.FileFormats.HDF2, RoiFile.FileFormats.HDF3]:
+        if self.fformat not in [RoiFile.FileFormats.HDF2, RoiFile.FileFormats.HDF3, RoiFile.FileFormats.HDF4]:
             raise NotImplementedError(f"RoiFile of format: {self.fformat} cannot be updated.")
         self.toHDF(roi, self.name, self.number, os.path.split(self.filePath)[0], overwrite=True)
         self._roi = copy.deepcopy(roi)  # We don't wont to use the same object that might still have external mutable references
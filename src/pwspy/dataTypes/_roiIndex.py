@@ -0,0 +1,211 @@
+# Copyright 2018-2020 Nick Anthony, Backman Biophotonics Lab, Northwestern University
+#
+# This file is part of PWSpy.
+#
+# PWSpy is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PWSpy is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with PWSpy.  If not, see <https://www.gnu.org/licenses/>.
+
+from __future__ import annotations
+import json
+import logging
+import os
+import typing as t_
+import warnings
+from fnmatch import fnmatch
+
+import h5py
+from shapely import geometry, wkb
+from shapely.strtree import STRtree
+
+from pwspy.dataTypes._other import Roi, RoiFile
+from pwspy.utility.misc import _fileFingerprint, _writeJsonAtomic
+
+
+def _isRoiFile(fileName: str) -> bool:
+    """`True` if the file name matches one of the naming patterns of ROI files."""
+    return fnmatch(fileName, 'ROI_*.h5') or (fnmatch(fileName, 'BW*_*.mat') and len(fileName.split('_')) == 2)
+
+
+class RoiIndex:
+    """A spatial index of the ROIs saved in a folder, used to find the ROIs at a position or overlapping a region without loading
+    every ROI. The bounds and polygon of each ROI are saved to `roiIndex.json` in the same folder as the ROI files so they don't
+    need to be read from the ROI files again. Candidates are found with an STRtree of the bounds of the ROIs and then tested
+    against their polygons, which are only decoded when needed.
+
+    Entries of ROI files that have been modified since the index was saved (detected by their modification time and size) are
+    updated when the index is loaded. Saving or deleting ROIs with `RoiFile` updates an existing index file automatically, only the
+    ROIs that were saved are read.
+
+    Args:
+        directory: The folder containing the ROI files.
+        entries: The entry of each ROI file keyed by the file name. Each entry contains the `fingerprint` of the file and a list of `rois`.
+    """
+    fileName = 'roiIndex.json'
+
+    def __init__(self, directory: str, entries: t_.Dict[str, dict]):
+        self.directory = directory
+        self._entries = entries
+        self._rois = [roi for entry in entries.values() for roi in entry['rois']]  # A flat list of the ROI entries.
+        self._polygons: t_.Dict[int, geometry.Polygon] = {}  # Decoded polygons keyed by index in `_rois`.
+        with warnings.catch_warnings():
+            warnings.filterwarnings('ignore', message='STRtree will be changed')  # Shapely 1.8 warns about an API change that doesn't affect us.
+            self._tree = STRtree([geometry.box(*roi['bounds']) for roi in self._rois]) if len(self._rois) > 0 else None
+
+    @classmethod
+    def load(cls, directory: str) -> RoiIndex:
+        """Load the index of the ROIs in `directory`. The index is created or updated if needed and saved for next time.
+
+        Args:
+            directory: The folder containing the ROI files.
+
+        Returns:
+            The index.
+        """
+        entries = cls._readIndex(directory)
+        updated = {}
+        with os.scandir(directory) as it:
+            for dirEntry in it:
+                if not _isRoiFile(dirEntry.name):
+                    continue
+                fingerprint = _fileFingerprint(dirEntry.path)
+                entry = entries.get(dirEntry.name)
+                if entry is None or entry['fingerprint'] != fingerprint:
+                    entry = cls._fileEntry(directory, dirEntry.name, fingerprint)
+                updated[dirEntry.name] = entry
+        if updated != entries:
+            cls._writeIndex(directory, updated)
+        return cls(directory, updated)
+
+    @classmethod
+    def refreshFile(cls, directory: str, fileName: str, numbers: t_.Optional[t_.Iterable[int]] = None, previousFingerprint: t_.Optional[str] = None):
+        """Update the entry of a single ROI file in the saved index of `directory`. Nothing is done if the folder has no index file.
+
+        Args:
+            directory: The folder containing the ROI files.
+            fileName: The name of the ROI file that has been modified, added, or deleted.
+            numbers: The numbers of the ROIs of an HDF file that were saved or deleted. If the entry of the file was up to date before
+                the file was modified, i.e. its fingerprint matches `previousFingerprint`, then only these ROIs are read from the file.
+                Otherwise every ROI of the file is read.
+            previousFingerprint: The fingerprint of the file from before it was modified.
+        """
+        if not os.path.exists(os.path.join(directory, cls.fileName)):
+            return
+        entries = cls._readIndex(directory)
+        fingerprint = _fileFingerprint(os.path.join(directory, fileName))
+        entry = entries.get(fileName)
+        if fingerprint is None:
+            entries.pop(fileName, None)
+        elif numbers is not None and entry is not None and entry['fingerprint'] == previousFingerprint and fileName.endswith('.h5'):
+            entries[fileName] = cls._updateEntry(directory, fileName, entry, numbers, fingerprint)
+        else:
+            entries[fileName] = cls._fileEntry(directory, fileName, fingerprint)
+        cls._writeIndex(directory, entries)
+
+    @staticmethod
+    def _roiEntry(name: str, number: int, fformat: RoiFile.FileFormats, roi: Roi) -> dict:
+        polygon = roi.polygon
+        return {'name': name, 'number': number, 'fformat': fformat.name, 'bounds': list(polygon.bounds), 'wkb': polygon.wkb_hex}
+
+    @classmethod
+    def _fileEntry(cls, directory: str, fileName: str, fingerprint: str) -> dict:
+        """Read the bounds and polygons of the ROIs in a file."""
+        rois = []
+        for roiFile in RoiFile.loadAllFromPath(directory, fileNames=[fileName]):
+            rois.append(cls._roiEntry(roiFile.name, roiFile.number, roiFile.fformat, roiFile.getRoi()))
+        return {'fingerprint': fingerprint, 'rois': rois}
+
+    @classmethod
+    def _updateEntry(cls, directory: str, fileName: str, entry: dict, numbers: t_.Iterable[int], fingerprint: str) -> dict:
+        """Replace the ROIs `numbers` in the entry of an HDF ROI file. ROIs that are no longer in the file are removed, the other ROIs of
+        the file are not read."""
+        numbers = set(numbers)
+        rois = [roi for roi in entry['rois'] if roi['number'] not in numbers]
+        name = fileName[4:-3]  # Strip the `ROI_` prefix and `.h5` suffix.
+        with h5py.File(os.path.join(directory, fileName), 'r') as hf:
+            for number in sorted(numbers):
+                if str(number) in hf:
+                    roi, fformat = RoiFile._roiFromHDF(hf[str(number)])
+                    rois.append(cls._roiEntry(name, number, fformat, roi))
+        return {'fingerprint': fingerprint, 'rois': rois}
+
+    @classmethod
+    def _readIndex(cls, directory: str) -> t_.Dict[str, dict]:
+        try:
+            with open(os.path.join(directory, cls.fileName), 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):  # The index doesn't exist yet or can't be read, it will be rebuilt.
+            return {}
+
+    @classmethod
+    def _writeIndex(cls, directory: str, entries: t_.Dict[str, dict]):
+        path = os.path.join(directory, cls.fileName)
+        try:
+            _writeJsonAtomic(path, entries)
+        except OSError as e:
+            logging.getLogger(__name__).warning(f"Failed to update the ROI index {path}: {e}")
+
+    def __len__(self):
+        return len(self._rois)
+
+    def _getPolygon(self, i: int) -> geometry.Polygon:
+        if i not in self._polygons:
+            self._polygons[i] = wkb.loads(self._rois[i]['wkb'], hex=True)
+        return self._polygons[i]
+
+    def query(self, geom: geometry.base.BaseGeometry) -> t_.List[t_.Tuple[str, int, RoiFile.FileFormats]]:
+        """Find the ROIs whose polygons intersect a shapely geometry, e.g. the `polygon` of another `Roi`.
+
+        Args:
+            geom: The geometry to test against.
+
+        Returns:
+            The name, number, and file format of each ROI found, in the same form as `RoiFile.getValidRoisInPath`, sorted by name and
+            number. These can be loaded with `Acquisition.loadRoi`.
+        """
+        if self._tree is None:
+            return []
+        try:
+            candidates = self._tree.query_items(geom)  # Shapely 1.8
+        except AttributeError:
+            candidates = self._tree.query(geom)  # Shapely 2.0 returns the indices directly.
+        ret = []
+        for i in candidates:
+            i = int(i)
+            if self._getPolygon(i).intersects(geom):
+                roi = self._rois[i]
+                ret.append((roi['name'], roi['number'], RoiFile.FileFormats[roi['fformat']]))
+        return sorted(ret, key=lambda r: (r[0], r[1]))
+
+    def queryPoint(self, x: float, y: float) -> t_.List[t_.Tuple[str, int, RoiFile.FileFormats]]:
+        """Find the ROIs that contain a position, e.g. to select the ROI under the mouse cursor.
+
+        Args:
+            x: The x coordinate (column) of the position in pixels.
+            y: The y coordinate (row) of the position in pixels.
+
+        Returns:
+            The name, number, and file format of each ROI containing the position.
+        """
+        return self.query(geometry.Point(x, y))
+
+    def queryBox(self, boundingBox: t_.Tuple[slice, slice]) -> t_.List[t_.Tuple[str, int, RoiFile.FileFormats]]:
+        """Find the ROIs that overlap a rectangular region of the image.
+
+        Args:
+            boundingBox: A tuple of (y, x) slices, the same form as `Roi.boundingBox`.
+
+        Returns:
+            The name, number, and file format of each ROI overlapping the region.
+        """
+        ys, xs = boundingBox
+        return self.query(geometry.box(xs.start, ys.start, xs.stop, ys.stop))
@@ -25,6 +25,7 @@ Modules
 
    acquisition
    DConversion
+   executors
    fileIO
    fluorescence
    machineVision
@@ -40,5 +41,5 @@ import os
 
 thinFilmPath = os.path.join(os.path.split(__file__)[0], 'thinFilmInterferenceFiles')
 
-__all__ = ['acquisition', 'DConversion', 'fileIO', 'fluorescence', 'machineVision', 'misc',
+__all__ = ['acquisition', 'DConversion', 'executors', 'fileIO', 'fluorescence', 'machineVision', 'misc',
            'micromanager', 'plotting', 'reflection']
@@ -0,0 +1,337 @@
+# Copyright 2018-2020 Nick Anthony, Backman Biophotonics Lab, Northwestern University
+#
+# This file is part of PWSpy.
+#
+# PWSpy is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PWSpy is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with PWSpy.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Backends used by `pwspy.utility.fileIO.processParallel` and `pwspy.analysis.ParallelRunner` to run tasks in parallel. By default
+tasks are run on a pool of processes on the local machine. The `SocketExecutor` instead sends tasks to worker processes that
+connect to it over the network, allowing a batch to be spread across several machines. Workers are started on each machine with::
+
+    python -m pwspy.utility.executors host port --authkey key
+
+where `key` is the `authkey` of the executor. Since workers run whatever tasks they are sent, and the executor unpickles whatever
+the workers send back, the key must be kept secret. All machines must have access to the data at the same file paths.
+
+Classes
+----------
+.. autosummary::
+   :toctree: generated/
+
+   Executor
+   LocalExecutor
+   SocketExecutor
+
+Functions
+----------
+.. autosummary::
+   :toctree: generated/
+
+   runWorker
+
+"""
+from __future__ import annotations
+import abc
+import argparse
+import logging
+import multiprocessing as mp
+import pickle
+import queue
+import secrets
+import threading as th
+import time
+import traceback
+import typing as t_
+from multiprocessing.connection import Listener, Client, Connection
+
+import psutil
+
+__all__ = ['Executor', 'LocalExecutor', 'SocketExecutor', 'runWorker']
+
+
+class Executor(abc.ABC):
+    """The interface of a backend that runs tasks in parallel. Each worker runs `initializer` once before running any tasks."""
+
+    @property
+    @abc.abstractmethod
+    def sharesMemory(self) -> bool:
+        """`True` if the workers run on this machine, in which case data can be sent to them through shared memory."""
+        pass
+
+    @abc.abstractmethod
+    def start(self, initializer: t_.Optional[t_.Callable] = None, initArgs: t_.Tuple = ()):
+        """Prepare the workers to receive tasks.
+
+        Args:
+            initializer: A function that is run once by each worker before it runs any tasks. Can be used to send data that is
+                shared by all tasks.
+            initArgs: The arguments for `initializer`.
+        """
+        pass
+
+    @abc.abstractmethod
+    def submit(self, func: t_.Callable, args: t_.Tuple, callback: t_.Callable[[t_.Any], None], errorCallback: t_.Callable[[BaseException], None]):
+        """Submit a task to be run by one of the workers. Returns immediately.
+
+        Args:
+            func: The function to run. Must be picklable.
+            args: The arguments for `func`.
+            callback: Called with the value returned by `func` once the task is complete.
+            errorCallback: Called with the exception if the task fails.
+        """
+        pass
+
+    @abc.abstractmethod
+    def close(self):
+        """Wait for all submitted tasks to finish and then shut down the workers."""
+        pass
+
+
+class LocalExecutor(Executor):
+    """Runs tasks on a `multiprocessing` pool of processes on this machine.
+
+    Args:
+        numProcesses: The number of worker processes to use. By default one less than the number of physical cores is used.
+        mpContext: The name of the `multiprocessing` start method to use ('fork', 'spawn', or 'forkserver'). If `None` then
+            the default of the platform is used.
+    """
+    def __init__(self, numProcesses: t_.Optional[int] = None, mpContext: t_.Optional[str] = None):
+        if numProcesses is None:
+            numProcesses = max(1, psutil.cpu_count(logical=False) - 1)  # Use one less than number of available cores. If we use all cores then things can get locked up.
+        self._numProcesses = numProcesses
+        self._context = mp.get_context(mpContext)
+        self._pool = None
+
+    @property
+    def sharesMemory(self) -> bool:
+        return True
+
+    def start(self, initializer: t_.Optional[t_.Callable] = None, initArgs: t_.Tuple = ()):
+        if self._pool is None:
+            self._pool = self._context.Pool(processes=self._numProcesses, initializer=initializer, initargs=initArgs)
+
+    def submit(self, func: t_.Callable, args: t_.Tuple, callback: t_.Callable[[t_.Any], None], errorCallback: t_.Callable[[BaseException], None]):
+        self._pool.apply_async(func, args, callback=callback, error_callback=errorCallback)
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+
+class SocketExecutor(Executor):
+    """Sends tasks to worker processes that connect over a socket using `runWorker`. Each worker is sent the initializer once, before
+    its first task, and then takes tasks one at a time from a shared queue, so faster machines process more of the tasks. Workers
+    may connect at any time after `start` is called. If a task raises an exception, or the worker running it disconnects, the task
+    is put back in the queue to be tried again. `start` may be called again (e.g. by `ParallelRunner`) to change the initializer,
+    workers that are already connected run the new initializer before their next task.
+
+    Args:
+        address: The (host, port) to listen for workers on. A port of 0 will use any free port, see the `address` attribute.
+        authkey: A key shared with the workers. Connections that don't use the same key are rejected. If `None` then a random key is
+            generated, see the `authkey` attribute.
+        maxRetries: The number of times a failed task is tried again before the failure is reported.
+        workerTimeout: If tasks are waiting and no workers have been connected for this many seconds then the waiting tasks fail with a
+            `ConnectionError`. If `None` then tasks wait for a worker indefinitely.
+    """
+    def __init__(self, address: t_.Tuple[str, int] = ('localhost', 0), authkey: t_.Optional[bytes] = None, maxRetries: int = 2,
+                 workerTimeout: t_.Optional[float] = 120):
+        self._requestedAddress = address
+        self._authkey = authkey if authkey is not None else secrets.token_hex(16).encode()  # Hex so that it can be typed on the command line of the workers.
+        self.maxRetries = maxRetries
+        self.workerTimeout = workerTimeout
+        self._listener: t_.Optional[Listener] = None
+        self._tasks = queue.Queue()
+        self._unfinished = 0  # The number of tasks that have been submitted but are not yet complete.
+        self._numWorkers = 0  # The number of connected workers.
+        self._condition = th.Condition()
+        self._stop = th.Event()
+        self._threads: t_.List[th.Thread] = []
+        self._init = (None, ())
+        self._initVersion = 0  # Incremented each time the initializer changes so that connected workers know to run it again.
+        self._logger = logging.getLogger(__name__)
+
+    @property
+    def address(self) -> t_.Tuple[str, int]:
+        """The address that workers should connect to."""
+        return self._listener.address if self._listener is not None else self._requestedAddress
+
+    @property
+    def authkey(self) -> bytes:
+        """The key that workers must connect with."""
+        return self._authkey
+
+    @property
+    def sharesMemory(self) -> bool:
+        return False
+
+    def start(self, initializer: t_.Optional[t_.Callable] = None, initArgs: t_.Tuple = ()):
+        with self._condition:
+            self._init = (initializer, initArgs)
+            self._initVersion += 1
+        if self._listener is not None:  # Already listening, the workers will pick up the new initializer.
+            return
+        self._stop.clear()
+        self._listener = Listener(self._requestedAddress, authkey=self._authkey)
+        self._threads = [th.Thread(target=self._acceptWorkers, daemon=True), th.Thread(target=self._watchWorkers, daemon=True)]
+        [thread.start() for thread in self._threads]
+
+    def submit(self, func: t_.Callable, args: t_.Tuple, callback: t_.Callable[[t_.Any], None], errorCallback: t_.Callable[[BaseException], None]):
+        with self._condition:
+            self._unfinished += 1
+        self._tasks.put((func, args, callback, errorCallback, 0))
+
+    def close(self):
+        if self._listener is None:
+            return
+        with self._condition:
+            self._condition.wait_for(lambda: self._unfinished == 0)
+        self._stop.set()
+        try:
+            Client(self._listener.address, authkey=self._authkey).close()  # Wake up the thread that is waiting for new connections.
+        except OSError:
+            pass
+        for thread in self._threads:
+            thread.join()
+        self._listener.close()
+        self._listener = None
+
+    def _acceptWorkers(self):
+        while True:  # Only stops once `close` has connected to wake it up, otherwise `close` could wait for a connection that is never accepted.
+            try:
+                conn = self._listener.accept()
+            except (OSError, mp.AuthenticationError) as e:
+                self._logger.warning(f"Failed to accept a worker connection: {e}")
+                continue
+            if self._stop.is_set():
+                conn.close()
+                break
+            thread = th.Thread(target=self._serveWorker, args=(conn,), daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def _serveWorker(self, conn: Connection):
+        """Run in a thread for each connected worker. Sends tasks to the worker until the executor is closed."""
+        with self._condition:
+            self._numWorkers += 1
+        try:
+            with conn:
+                sentInitVersion = None
+                while not self._stop.is_set():
+                    try:
+                        task = self._tasks.get(timeout=0.5)
+                    except queue.Empty:
+                        continue
+                    func, args, callback, errorCallback, attempts = task
+                    try:
+                        with self._condition:
+                            init, initVersion = self._init, self._initVersion
+                        if sentInitVersion != initVersion:
+                            conn.send(('init',) + init)
+                            sentInitVersion = initVersion
+                        conn.send(('task', func, args))
+                        status, value = conn.recv()
+                    except (OSError, EOFError) as e:  # The worker has been lost. Give the task to someone else.
+                        self._logger.warning(f"Lost connection to a worker: {e}")
+                        self._retry(task, e)
+                        return
+                    if status == 'ok':
+                        self._finish(callback, value)
+                    else:
+                        self._retry(task, value)
+                try:
+                    conn.send(('stop',))
+                except (OSError, EOFError):
+                    pass
+        finally:
+            with self._condition:
+                self._numWorkers -= 1
+
+    def _watchWorkers(self):
+        """Run in a thread while the executor is started. Fails the queued tasks if there have been no workers to run them for `workerTimeout` seconds."""
+        waitingSince = None
+        while not self._stop.wait(0.5):
+            with self._condition:
+                waiting = self._numWorkers == 0 and self._unfinished > 0
+            if not waiting or self.workerTimeout is None:
+                waitingSince = None
+            elif waitingSince is None:
+                waitingSince = time.time()
+            elif time.time() - waitingSince > self.workerTimeout:
+                self._logger.error(f"No workers have connected to {self.address} for {self.workerTimeout} seconds. Failing the waiting tasks.")
+                while True:
+                    try:
+                        func, args, callback, errorCallback, attempts = self._tasks.get_nowait()
+                    except queue.Empty:
+                        break
+                    self._finish(errorCallback, ConnectionError(f"No workers were connected to {self.address} to run the task."))
+                waitingSince = None
+
+    def _retry(self, task: t_.Tuple, error: BaseException):
+        func, args, callback, errorCallback, attempts = task
+        if attempts < self.maxRetries:
+            self._logger.info(f"Retrying a failed task: {error}")
+            self._tasks.put((func, args, callback, errorCallback, attempts + 1))
+        else:
+            self._finish(errorCallback, error)
+
+    def _finish(self, callback: t_.Callable, value: t_.Any):
+        try:
+            callback(value)
+        finally:
+            with self._condition:
+                self._unfinished -= 1
+                self._condition.notify_all()
+
+
+def runWorker(address: t_.Tuple[str, int], authkey: bytes):
+    """Connect to a `SocketExecutor` and run the tasks that it sends until it is closed.
+
+    Args:
+        address: The (host, port) that the executor is listening on.
+        authkey: The `authkey` of the executor.
+    """
+    with Client(address, authkey=authkey) as conn:
+        while True:
+            try:
+                message = conn.recv()
+            except EOFError:
+                return
+            if message[0] == 'init':
+                initializer, initArgs = message[1:]
+                if initializer is not None:
+                    initializer(*initArgs)
+            elif message[0] == 'task':
+                func, args = message[1:]
+                try:
+                    reply = ('ok', func(*args))
+                except Exception as e:
+                    reply = ('error', e)
+                try:
+                    conn.send(reply)
+                except (pickle.PicklingError, TypeError, AttributeError):  # The return value or exception couldn't be sent.
+                    conn.send(('error', RuntimeError(traceback.format_exc())))
+            elif message[0] == 'stop':
+                return
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Run a worker process for a `pwspy.utility.executors.SocketExecutor`.")
+    parser.add_argument('host', help="The host name of the machine running the executor.")
+    parser.add_argument('port', type=int, help="The port that the executor is listening on.")
+    parser.add_argument('--authkey', required=True, help="The `authkey` of the executor.")
+    cliArgs = parser.parse_args()
+    runWorker((cliArgs.host, cliArgs.port), cliArgs.authkey.encode())
@@ -37,9 +37,11 @@ import threading as th
 from time import time
 import typing
 from typing import Union, Optional, List, Tuple
+import numpy as np
 import pandas as pd
 import psutil
-from pwspy.dataTypes import Acquisition, MetaDataBase
+from pwspy.dataTypes import Acquisition, MetaDataBase, ICBase
+from pwspy.utility.executors import Executor, LocalExecutor
 
 '''Local Functions'''
 def _load(loadHandle: Union[str, MetaDataBase], lock: mp.Lock):
@@ -101,6 +103,79 @@ def _loadThenProcess(procFunc, procFuncArgs, lock: mp.Lock, row):
     return row
 
 
+def _estimateTaskBytes(item: Union[str, MetaDataBase, ICBase, typing.Any]) -> int:
+    """Estimate the number of bytes of memory that will be needed to process an item. The estimate is based on the size of
+    the data as 32-bit floats (image dimensions x number of wavelengths or times) multiplied by the number of working copies
+    that processing typically requires. This is also used as an estimate of the relative time it will take to process the item.
+    Items that can't be estimated return 0."""
+    workingCopies = 4  # The raw cube, the normalized float cube, the processed KCube, and temporary arrays.
+    try:
+        if isinstance(item, ICBase):
+            return item.data.size * np.dtype(np.float32).itemsize * workingCopies
+        if isinstance(item, str):
+            item = Acquisition(item).pws
+        if isinstance(item, MetaDataBase):
+            y, x = item.getThumbnail().shape[:2]  # Thumbnails are small and are saved at the same dimensions as the data.
+            if hasattr(item, 'wavelengths'):
+                n = len(item.wavelengths)
+            elif hasattr(item, 'times'):
+                n = len(item.times)
+            else:
+                n = 1
+            return y * x * n * np.dtype(np.float32).itemsize * workingCopies
+    except Exception as e:
+        logging.getLogger(__name__).debug(f"Failed to estimate the memory requirement of {item}: {e}")
+    return 0
+
+
+def _scheduleParallel(executor: Executor, func: typing.Callable, tasks: typing.Sequence, costs: typing.Sequence[int],
+                      memoryFraction: Optional[float] = 0.8, prepare: typing.Callable[[typing.Any], Tuple] = lambda task: (task,)) -> typing.Iterator[Tuple[int, typing.Any]]:
+    """Submit tasks to `executor` one at a time, most expensive first, while keeping the estimated memory of the tasks in progress within
+    a fraction of the RAM that is available when scheduling begins. Since each task is submitted individually, idle workers take the
+    next task from the executor's shared queue rather than waiting on a pre-assigned chunk, so the end of a batch isn't left to one process.
+
+    Args:
+        executor: The executor to run the tasks on.
+        func: The function to run for each task.
+        tasks: The tasks to run.
+        costs: The estimated memory requirement of each task in bytes. See `_estimateTaskBytes`.
+        memoryFraction: The fraction of available memory that the tasks in progress may use. At least one task is always in
+            progress, even if it is estimated to exceed the budget. If `None` then tasks are not limited by memory, this is used for
+            executors that run tasks on other machines.
+        prepare: A function converting a task to the tuple of arguments for `func`. Only called once the task is submitted.
+
+    Returns:
+        An iterator of the index of each task and the value returned by `func`, in the order that they are completed. If a task fails
+        then no more tasks are submitted, the tasks already in progress are waited for and their results are discarded, and then the
+        error is raised.
+    """
+    budget = psutil.virtual_memory().available * memoryFraction if memoryFraction is not None else float('inf')
+    order = sorted(range(len(tasks)), key=lambda i: costs[i], reverse=True)  # Largest first. `sorted` is stable so input order is kept for equal costs.
+    done = queue.Queue()
+    inProgress = {}  # The memory estimate of each submitted task, keyed by task index.
+    pos = 0
+    try:
+        while pos < len(order) or len(inProgress) > 0:
+            while pos < len(order) and (len(inProgress) == 0 or sum(inProgress.values()) + costs[order[pos]] <= budget):
+                i = order[pos]
+                pos += 1
+                inProgress[i] = costs[i]
+                executor.submit(func, prepare(tasks[i]),
+                                callback=lambda ret, i=i: done.put((i, ret, None)),
+                                errorCallback=lambda e, i=i: done.put((i, None, e)))
+            i, ret, e = done.get()
+            del inProgress[i]
+            if e is not None:
+                raise e
+            yield i, ret
+    finally:
+        # If we stopped early (due to an error or the caller closing the iterator) the workers of a persistent executor are still running
+        # the submitted tasks. Wait for them so that their results, which may hold shared memory, are received and released here.
+        while len(inProgress) > 0:
+            i, ret, e = done.get()
+            del inProgress[i]
+
+
 '''User Functions'''
 
 
@@ -194,8 +269,11 @@ def loadAndProcess(fileFrame: Union[pd.DataFrame, List, Tuple], processorFunc: O
         return origClass(ret['cube'])
 
 
-def processParallel(fileFrame: pd.DataFrame, processorFunc: typing.Callable[[], typing.Any], initializer: typing.Callable=None, initArgs: Tuple=None, procArgs: Tuple=None, numProcesses: int = None) -> List:
-    """A convenience function to process the rows of a pandas DataFrame in parallel
+def processParallel(fileFrame: pd.DataFrame, processorFunc: typing.Callable[[], typing.Any], initializer: typing.Callable=None, initArgs: Tuple=None, procArgs: Tuple=None, numProcesses: int = None,
+                    memoryFraction: float = 0.8, executor: Optional[Executor] = None) -> List:
+    """A convenience function to process the rows of a pandas DataFrame in parallel. If the frame has a `cube` column (containing
+    file paths, metadata, or data objects) then the memory required by each row is estimated from the data dimensions. The largest
+    rows are started first and new rows are only started while the estimated memory of the rows in progress fits in the available RAM.
 
     Parameters
     ----------
@@ -204,25 +282,39 @@ def processParallel(fileFrame: pd.DataFrame, processorFunc: typing.Callable[[],
     processorFunc
         A function that each row number and row of the `fileFrame` should be passed to as the first and second argument respectively. Additional arguments can
         be passed to processorFunc using the procArgs variable. The function should return the value which you want included
-        in the return of `processParrallel`.
+        in the return of `processParrallel`. Large arrays can be returned without being copied through the pipe by wrapping them
+        with `pwspy.utility.misc.toSharedMemory(array, transferOwnership=True)`.
     procArgs
         Optional arguments to pass to processorFunc
     initializer:
         A function that is run once at the beginning of each spawned process. Can be used for copying shared memory.
     initArgs:
         A tuple of arguments to pass to the `initializer` function.
+    numProcesses:
+        The maximum number of processes to use. By default one less than the number of physical cores.
+    memoryFraction:
+        The fraction of the available RAM that the rows being processed at the same time may use.
+    executor:
+        The backend used to run `processorFunc`. By default a `LocalExecutor` with `numProcesses` processes is used. If another
+        executor is provided then `numProcesses` is ignored and the executor is left running, it is up to the caller to close it.
 
     Returns
     -------
-        List containing the results of each execution of `processorFunc`.
+        List containing the results of each execution of `processorFunc`, in the same order as `fileFrame`.
     """
-    if numProcesses is None:
-        numProcesses = psutil.cpu_count(logical=False) - 1  # Use one less than number of available cores. If we use all cores then things can get locked up.
-    po = mp.Pool(processes=numProcesses, initializer=initializer, initargs=initArgs)
+    ownsExecutor = executor is None
+    if ownsExecutor:
+        executor = LocalExecutor(numProcesses)
+    rows = list(fileFrame.iterrows())
+    costs = [_estimateTaskBytes(row['cube']) if 'cube' in row else 0 for _, row in rows]
+    procArgs = tuple(procArgs) if procArgs is not None else ()
+    executor.start(initializer, initArgs if initArgs is not None else ())
     try:
-        vars = fileFrame.iterrows() if procArgs is None else zip(*zip(*fileFrame.iterrows()), *zip(*[procArgs] * len(fileFrame)))
-        cubes = po.starmap(processorFunc, vars)
+        results = [None] * len(rows)
+        for i, ret in _scheduleParallel(executor, processorFunc, rows, costs, memoryFraction if executor.sharesMemory else None,
+                                        prepare=lambda row: (*row, *procArgs)):
+            results[i] = ret
     finally:
-        po.close()
-        po.join()
-    return cubes
\ No newline at end of file
+        if ownsExecutor:
+            executor.close()
+    return results
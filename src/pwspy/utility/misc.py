@@ -25,7 +25,30 @@ Decorators
 
    cached_property
    profileDec
+
+Classes
+-------------
+.. autosummary::
+   :toctree: generated/
+
+   LRUCache
+
+Functions
+-------------
+.. autosummary::
+   :toctree: generated/
+
+   toSharedMemory
 """
+import json
+import os
+import threading
+import typing as t_
+import weakref
+from collections import OrderedDict
+from multiprocessing import shared_memory
+import numpy as np
+
 
 class cached_property(object):
     """
@@ -50,6 +73,118 @@ class cached_property(object):
         return value
 
 
+class LRUCache:
+    """
+    A thread-safe cache that is limited by the total size of the values that it holds rather than by the number of items. When the
+    limit is exceeded the least recently used items are discarded.
+
+    Args:
+        maxBytes: The maximum total size of the cached values.
+        sizeOf: A function returning the size in bytes of a value.
+
+    Attributes:
+        hits: The number of calls to `get` that found the requested item.
+        misses: The number of calls to `get` that did not find the requested item.
+    """
+    def __init__(self, maxBytes: int, sizeOf: t_.Callable[[t_.Any], int]):
+        self._maxBytes = maxBytes
+        self._sizeOf = sizeOf
+        self._items: OrderedDict = OrderedDict()  # Values are tuples of (value, size). Most recently used items are at the end.
+        self._currentBytes = 0
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def maxBytes(self) -> int:
+        """The maximum total size of the cached values. Reducing this will immediately discard items as needed."""
+        return self._maxBytes
+
+    @maxBytes.setter
+    def maxBytes(self, maxBytes: int):
+        with self._lock:
+            self._maxBytes = maxBytes
+            self._evict()
+
+    @property
+    def currentBytes(self) -> int:
+        """The total size of the values currently in the cache."""
+        return self._currentBytes
+
+    def get(self, key: t_.Hashable, default: t_.Any = None) -> t_.Any:
+        """Return the value for `key`, or `default` if it is not in the cache."""
+        with self._lock:
+            try:
+                value, size = self._items[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self._items.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key: t_.Hashable, value: t_.Any):
+        """Add a value to the cache. Values larger than `maxBytes` are not stored."""
+        size = self._sizeOf(value)
+        with self._lock:
+            self.pop(key)
+            if size > self._maxBytes:
+                return
+            self._items[key] = (value, size)
+            self._currentBytes += size
+            self._evict()
+
+    def pop(self, key: t_.Hashable):
+        """Remove `key` from the cache if it is present."""
+        with self._lock:
+            if key in self._items:
+                value, size = self._items.pop(key)
+                self._currentBytes -= size
+
+    def clear(self):
+        """Remove all items from the cache and reset the hit and miss counters."""
+        with self._lock:
+            self._items.clear()
+            self._currentBytes = 0
+            self.hits = 0
+            self.misses = 0
+
+    def _evict(self):
+        while self._currentBytes > self._maxBytes:
+            key, (value, size) = self._items.popitem(last=False)
+            self._currentBytes -= size
+
+    def __contains__(self, key: t_.Hashable) -> bool:
+        return key in self._items
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+
+def _fileFingerprint(path: str) -> t_.Optional[str]:
+    """A string that changes whenever the file at `path` is modified, based on its modification time and size. This is much faster
+    than hashing the contents of the file. `None` if the file doesn't exist."""
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return f"{st.st_mtime_ns}-{st.st_size}"
+
+
+def _writeJsonAtomic(path: str, obj: t_.Any, **kwargs):
+    """Save `obj` to the json file at `path`. The file is written to a temporary file named by the process id and then moved into
+    place so readers never see a partially written file and processes writing at the same time don't write to the same file.
+    Keyword arguments are passed to `json.dump`."""
+    partPath = f"{path}.{os.getpid()}.part"
+    try:
+        with open(partPath, 'w') as f:
+            json.dump(obj, f, **kwargs)
+        os.replace(partPath, path)
+    finally:
+        if os.path.exists(partPath):
+            os.remove(partPath)
+
+
 def profileDec(filePath: str):
     """
     A decorator to profile a function call using cProfile
@@ -69,4 +204,83 @@ def profileDec(filePath: str):
             # pr.print_stats(sort=sort)
             return ret
         return newFunc
-    return innerDec
\ No newline at end of file
+    return innerDec
+
+
+class _SharedMemory(shared_memory.SharedMemory):
+    """`SharedMemory.__del__` tries to close the block, which fails while numpy arrays still reference its buffer. The arrays
+    created by `toSharedMemory` keep a reference to this object so it is only collected along with them, at that point the
+    memory map is released by the arrays themselves. The file descriptor isn't needed once the memory is mapped so it is closed
+    right away."""
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        if getattr(self, '_fd', -1) >= 0:  # Only exists on posix systems.
+            os.close(self._fd)
+            self._fd = -1
+
+    def __del__(self):
+        pass
+
+
+def _unlinkSharedMemory(shm: _SharedMemory):
+    try:
+        shm.unlink()
+    except FileNotFoundError:  # Already unlinked by someone else.
+        pass
+
+
+class _SharedMemoryArray(np.ndarray):
+    """A numpy array that lives in a block of shared memory. When pickled only the name of the block is sent and the receiving
+    process attaches to the same memory rather than receiving a copy of the data. Arrays derived from this one (views, results
+    of arithmetic) are pickled as ordinary arrays."""
+    _shm: _SharedMemory = None
+    _transferOwnership: bool = False
+
+    def __array_finalize__(self, obj):
+        self._shm = None  # Only the array that was created to wrap the block is sent by reference.
+        self._transferOwnership = False
+
+    def __array_wrap__(self, arr, context=None):
+        return arr.view(np.ndarray)  # The results of calculations are ordinary arrays.
+
+    def __reduce__(self):
+        if self._shm is None:
+            return np.ndarray.__reduce__(self.view(np.ndarray))
+        return _attachSharedMemoryArray, (self._shm.name, self.shape, self.dtype.str, self._transferOwnership)
+
+
+def _wrapSharedMemory(shm: _SharedMemory, shape: tuple, dtype: np.dtype, owner: bool) -> _SharedMemoryArray:
+    arr = np.ndarray(shape, dtype=dtype, buffer=shm.buf).view(_SharedMemoryArray)
+    arr._shm = shm
+    if owner:  # The owning process removes the block from the system once the array is no longer used.
+        weakref.finalize(arr, _unlinkSharedMemory, shm)
+    return arr
+
+
+def _attachSharedMemoryArray(name: str, shape: tuple, dtype: str, transferOwnership: bool) -> _SharedMemoryArray:
+    """Used to unpickle a `_SharedMemoryArray`."""
+    return _wrapSharedMemory(_SharedMemory(name=name), shape, np.dtype(dtype), owner=transferOwnership)
+
+
+def toSharedMemory(arr: np.ndarray, transferOwnership: bool = False) -> np.ndarray:
+    """
+    Copy an array into a new block of shared memory. When the returned array is pickled (e.g. when sent to or from a process of
+    a `multiprocessing.Pool`) only the name of the memory block is transferred and the receiving process accesses the same
+    memory rather than a copy. Unlike `multiprocessing.RawArray` this does not rely on the memory being inherited through `fork`
+    so it works with any multiprocessing start method.
+
+    Args:
+        arr: The array to copy.
+        transferOwnership: If `False` then the memory block is released when the returned array is garbage collected in this
+            process, other processes must only use it while this process holds on to the array. If `True` then this process never
+            releases the block, instead the process that unpickles the array becomes responsible for it. This is used to return
+            results from a worker process without copying them.
+
+    Returns:
+        An array with the same contents as `arr` which is stored in shared memory.
+    """
+    shm = _SharedMemory(create=True, size=max(arr.nbytes, 1))  # A size of 0 is not allowed.
+    shared = _wrapSharedMemory(shm, arr.shape, arr.dtype, owner=not transferOwnership)
+    shared._transferOwnership = transferOwnership
+    np.copyto(shared, arr)
+    return shared
@@ -1,6 +1,10 @@
+import json
 import pathlib as pl
+import typing as t_
+import numpy as np
 import pwspy.dataTypes as pwsdt
 import pytest
+import tifffile as tf
 
 
 testDataPath = pl.Path(__file__).parent / 'resources' / 'test_data'  # The path to find the test data in.
@@ -54,3 +58,43 @@ def dynamicsData() -> Dataset:
     )
     yield ds
     ds.clean()
+
+
+def _writeSyntheticPws(path: pl.Path, seed: int, shape=(64, 80), reference: bool = False):
+    """Write a small PWS acquisition of random data with a sinusoidal spectrum to `path`."""
+    rng = np.random.default_rng(seed)
+    (path / 'PWS').mkdir(parents=True)
+    wavelengths = np.arange(500, 702, 2, dtype=float)
+    spectrum = 2000 + 500 * np.sin(wavelengths / 20)
+    if reference:
+        data = spectrum * (1 + 0.01 * rng.standard_normal(shape + (len(wavelengths),)))
+    else:
+        data = spectrum * (1 + 0.05 * np.sin(wavelengths / (3 + rng.random(shape + (1,)))) + 0.01 * rng.standard_normal(shape + (len(wavelengths),)))
+    data = data.astype(np.uint16)
+    md = {'system': 'synthetic', 'time': f'01-01-2020 01:01:0{seed % 10}', 'exposure': 50.0, 'pixelSizeUm': 0.2, 'binning': 1,
+          'wavelengths': list(wavelengths), 'darkCounts': 100, 'linearityPoly': [1.0]}
+    tf.imwrite(path / 'PWS' / 'pws.tif', np.rollaxis(data, -1, 0))
+    with open(path / 'PWS' / 'pwsmetadata.json', 'w') as f:
+        json.dump(md, f)
+    tf.imwrite(path / 'PWS' / 'image_bd.tif', data[:, :, 0].astype(np.uint8))
+
+
+def makeRoi(x: int, y: int, shape: t_.Tuple[int, int] = (64, 80)) -> pwsdt.Roi:
+    """A small quadrilateral ROI with its top left corner at `x`, `y`."""
+    return pwsdt.Roi.fromVerts(np.array([[x, y], [x + 10, y], [x + 10, y + 15], [x, y + 12]]), shape)
+
+
+@pytest.fixture
+def rois() -> t_.List[pwsdt.Roi]:
+    """Three non-overlapping ROIs of a (64, 80) image, the same shape as the images of `syntheticData`."""
+    return [makeRoi(x, y) for x, y in [(2, 3), (30, 5), (50, 40)]]
+
+
+@pytest.fixture
+def syntheticData(tmp_path) -> Dataset:
+    """A small dataset of synthetic PWS data that doesn't depend on the files in `testDataPath`. Contains `Cell1` and `Cell2` and
+    the reference `Cell999`."""
+    for i in (1, 2):
+        _writeSyntheticPws(tmp_path / f'Cell{i}', seed=i)
+    _writeSyntheticPws(tmp_path / 'Cell999', seed=9, reference=True)
+    return Dataset(tmp_path, tmp_path / 'Cell999')
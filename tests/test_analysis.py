@@ -4,10 +4,26 @@ from pwspy.utility.reflection import Material
 import pytest
 from conftest import testDataPath
 import numpy as np
+import json
+import os
 
 _analysisName = 'testAnalysis'
 
-erMeta = pwsdt.ERMetaData.fromHdfFile(testDataPath / 'extraReflection', 'LCPWS2_100xpfs-8_4_2021')
+
+def _syntheticResults(seed: int = 0, shape=(64, 80), opd: bool = False) -> analysis.pws.PWSAnalysisResults:
+    """Create PWS analysis results of random data without running an analysis."""
+    rng = np.random.default_rng(seed)
+    im = lambda: rng.random(shape, dtype=np.float32)
+    settings = analysis.pws.PWSAnalysisSettings.loadDefaultSettings("Recommended")
+    reflectance = pwsdt.KCube(rng.random(shape + (20,), dtype=np.float32), tuple(np.linspace(8.9, 12.6, 20)))
+    return analysis.pws.PWSAnalysisResults.create(settings, reflectance, im(), im(), im(), im(), im(), im(), 'imCubeIdTag', 'referenceIdTag', None,
+                                                  opd=(rng.random(shape + (10,), dtype=np.float32), np.arange(10.)) if opd else None)
+
+
+@pytest.fixture(params=[False, True], ids=['noExtraReflection', 'extraReflection'])
+def extraReflection(request):
+    """The extra reflection metadata to run the analyses with. Loaded by the fixture so that collecting this module doesn't require the test data."""
+    return pwsdt.ERMetaData.fromHdfFile(testDataPath / 'extraReflection', 'LCPWS2_100xpfs-8_4_2021') if request.param else None
 
 
 class TestAnalysis:
@@ -15,7 +31,6 @@ class TestAnalysis:
     Test the code under pwspy.analysis
     """
 
-    @pytest.mark.parametrize('extraReflection', [None, erMeta])
     def test_pws_analysis(self, dynamicsData, extraReflection):
         """Test that PWS data can be analyzed. Results can be loaded. TODO check that values of analysis results don't change."""
         settings = analysis.pws.PWSAnalysisSettings.loadDefaultSettings("Recommended")
@@ -38,7 +53,43 @@ class TestAnalysis:
         assert isinstance(result.meanReflectance, np.ndarray)
         assert isinstance(result.reflectance, pwsdt.KCube)
 
-    @pytest.mark.parametrize('extraReflection', [None, erMeta])
+    @pytest.mark.parametrize('skipAdvanced', [True, False])
+    def test_compiled_pws_analysis_synthetic(self, syntheticData, skipAdvanced):
+        """Test that the `compiled` mode of the PWS analysis matches the standard mode on synthetic data."""
+        settings = analysis.pws.PWSAnalysisSettings.loadDefaultSettings("Recommended")
+        settings.skipAdvanced = skipAdvanced
+        settings.polynomialOrder = 2  # With order 0 the polynomial fit is a constant and `polynomialRms` is just rounding error.
+        refAcq = pwsdt.Acquisition(syntheticData.referenceCellPath)
+        acq = pwsdt.Acquisition(syntheticData.datasetPath / "Cell1")
+
+        results, _ = analysis.pws.PWSAnalysis(settings, None, refAcq.pws.toDataClass()).run(acq.pws.toDataClass())
+        compiledResults, _ = analysis.pws.PWSAnalysis(settings, None, refAcq.pws.toDataClass(), compiled=True).run(acq.pws.toDataClass())
+
+        assert compiledResults.reflectance.wavenumbers == results.reflectance.wavenumbers
+        assert np.allclose(compiledResults.reflectance.data, results.reflectance.data, rtol=1e-4, atol=1e-5)
+        for field in ('rms', 'meanReflectance', 'polynomialRms'):
+            if getattr(results, field) is None:
+                assert getattr(compiledResults, field) is None
+            else:
+                assert np.allclose(getattr(compiledResults, field), getattr(results, field), rtol=1e-4, atol=1e-5)
+
+    def test_masked_pws_analysis_synthetic(self, syntheticData):
+        """Test that analyzing only the pixels of a mask matches the analysis of the full image and that masks of the wrong shape are rejected."""
+        settings = analysis.pws.PWSAnalysisSettings.loadDefaultSettings("Recommended")
+        refAcq = pwsdt.Acquisition(syntheticData.referenceCellPath)
+        acq = pwsdt.Acquisition(syntheticData.datasetPath / "Cell1")
+        anls = analysis.pws.PWSAnalysis(settings, None, refAcq.pws.toDataClass())
+        results, _ = anls.run(acq.pws.toDataClass())
+        roi = pwsdt.Roi.fromVerts(np.array([[20, 10], [45, 10], [45, 30], [20, 25]]), (64, 80))
+        for mask in (roi, roi.mask.copy()):
+            masked, _ = anls.run(acq.pws.toDataClass(), mask=mask)
+            assert np.allclose(masked.rms[roi.mask], results.rms[roi.mask], rtol=1e-5)
+            assert np.allclose(masked.reflectance.data[roi.mask], results.reflectance.data[roi.mask], rtol=1e-5, atol=1e-6)
+            assert np.isnan(masked.rms[~roi.mask]).all()
+        for badMask in (np.ones((64, 81), dtype=bool), pwsdt.Roi.fromVerts(np.array([[20, 10], [45, 10], [45, 30]]), (80, 64)), roi.mask.astype(np.uint8)):
+            with pytest.raises(ValueError):
+                anls.run(acq.pws.toDataClass(), mask=badMask)
+
     def test_dynamics_analysis(self, dynamicsData, extraReflection):
         """Test that dynamics data can be analyzed, results can be loaded"""
         settings = analysis.dynamics.DynamicsAnalysisSettings(
@@ -90,3 +141,275 @@ class TestAnalysis:
             print(f"Successfully Compiled {len(results)} ROIs for general, PWS, and dynamics analysis.")
 
 
+
+
+class TestParallelRunner:
+    """Test running analyses in parallel with `pwspy.analysis.ParallelRunner` on synthetic data."""
+
+    @staticmethod
+    def _makeAnalysis(dataset) -> analysis.pws.PWSAnalysis:
+        settings = analysis.pws.PWSAnalysisSettings.loadDefaultSettings("Recommended")
+        return analysis.pws.PWSAnalysis(settings, None, pwsdt.Acquisition(dataset.referenceCellPath).pws.toDataClass())
+
+    def test_pool_reuse(self, syntheticData):
+        """The worker pool is started once and reused by later calls. `run` and `runAsCompleted` return the same results as a serial analysis."""
+        acqs = [pwsdt.Acquisition(syntheticData.datasetPath / f"Cell{i}") for i in (1, 2)]
+        serial = {acq.pws.filePath: self._makeAnalysis(syntheticData).run(acq.pws.toDataClass())[0] for acq in acqs}
+        with analysis.ParallelRunner(self._makeAnalysis(syntheticData), numProcesses=2) as runner:
+            ordered = runner.run([acq.pws for acq in acqs])
+            pool = runner._executor._pool
+            completed = list(runner.runAsCompleted([acq.pws.toDataClass() for acq in acqs]))
+            assert runner._executor._pool is pool
+        assert runner._executor._pool is None  # Closed by the context manager.
+        assert [md.filePath for warns, results, md in ordered] == [acq.pws.filePath for acq in acqs]
+        assert sorted(md.filePath for warns, results, md in completed) == sorted(serial)
+        for warns, results, md in ordered + completed:
+            assert np.allclose(results.rms, serial[md.filePath].rms)
+            assert np.allclose(results.reflectance.data, serial[md.filePath].reflectance.data)
+
+
+    def test_writeBehind(self, syntheticData):
+        """Results are saved by the background writer and results that can't be saved are reported in `writeErrors`."""
+        acqs = [pwsdt.Acquisition(syntheticData.datasetPath / f"Cell{i}") for i in (1, 2)]
+        (syntheticData.datasetPath / 'Cell1' / 'PWS' / 'analyses').touch()  # A file in place of the folder, saving will fail.
+        with analysis.ParallelRunner(self._makeAnalysis(syntheticData), numProcesses=2, writeBehind=True) as runner:
+            ret = runner.run([acq.pws for acq in acqs], saveName=_analysisName)
+            assert [md.filePath for md, e in runner.writeErrors] == [acqs[0].pws.filePath]
+            assert isinstance(runner.writeErrors[0][1], OSError)
+        assert all(results is not None for warns, results, md in ret)
+        assert acqs[1].pws.getAnalyses() == [_analysisName]
+        assert np.array_equal(acqs[1].pws.loadAnalysis(_analysisName).rms, ret[1][1].rms)
+
+
+class TestResultsFile:
+    """Test saving and loading analysis results without running an analysis."""
+
+    def test_fieldCache(self, tmp_path):
+        """Fields loaded from file are cached, and cached values aren't used once the file has been overwritten."""
+        first, second = _syntheticResults(0), _syntheticResults(1)
+        first.toHDF(str(tmp_path), 'cache')
+        loaded = analysis.pws.PWSAnalysisResults.load(str(tmp_path), 'cache')
+        hits = analysis.fieldCache.hits
+        assert np.array_equal(loaded.rms, first.rms)
+        assert np.array_equal(loaded.rms, first.rms)
+        assert analysis.fieldCache.hits == hits + 1
+        second.toHDF(str(tmp_path), 'cache', overwrite=True)
+        reloaded = analysis.pws.PWSAnalysisResults.load(str(tmp_path), 'cache')
+        assert np.array_equal(reloaded.rms, second.rms)
+        key = analysis.pws.PWSAnalysisResults.rms._key(reloaded)
+        assert key in analysis.fieldCache
+        del reloaded.rms  # Removes the value from the cache.
+        assert key not in analysis.fieldCache
+
+    def test_fieldCacheReadOnly(self, tmp_path):
+        """Cached fields are shared by every reader of a file so modifying a returned field must not change what the next reader gets."""
+        results = _syntheticResults(0)
+        results.toHDF(str(tmp_path), 'readOnly')
+        loaded = analysis.pws.PWSAnalysisResults.load(str(tmp_path), 'readOnly')
+        for arr in (loaded.rms, loaded.reflectance.data, loaded.getField('rms', (slice(0, 10), slice(0, 10)))):
+            with pytest.raises(ValueError):
+                arr[0, 0] = np.nan
+        rms = loaded.rms.copy()
+        rms[:10] = np.nan
+        reloaded = analysis.pws.PWSAnalysisResults.load(str(tmp_path), 'readOnly')
+        assert np.array_equal(reloaded.rms, results.rms)
+        assert np.array_equal(reloaded.reflectance.data, loaded.reflectance.data)
+
+    def test_writeStrategy(self, tmp_path):
+        """Files are written through a file object unless `LocalTemp` is requested, both strategies save the same results."""
+        results = _syntheticResults(0)
+        assert analysis.pws.PWSAnalysisResults.writeStrategy is analysis.pws.PWSAnalysisResults.WriteStrategy.FileObject
+        loaded = []
+        for strategy in analysis.pws.PWSAnalysisResults.WriteStrategy:
+            results.toHDF(str(tmp_path), strategy.name, writeStrategy=strategy)
+            loaded.append(analysis.pws.PWSAnalysisResults.load(str(tmp_path), strategy.name))
+        assert list(tmp_path.glob('*.part')) == []
+        for other in loaded[1:]:
+            assert np.array_equal(other.rms, loaded[0].rms)
+            assert np.array_equal(other.reflectance.data, loaded[0].reflectance.data)
+
+
+    def test_opdNan(self, tmp_path):
+        """NaN values of the saved OPD survive the fixed-point round trip, including the region read for an ROI."""
+        results = _syntheticResults(0, opd=True)
+        opd, opdIndex = results.dict['opd']
+        opd[:10, :, :] = np.nan  # E.g. pixels that weren't analyzed.
+        results.toHDF(str(tmp_path), 'opd')
+        loaded = analysis.pws.PWSAnalysisResults.load(str(tmp_path), 'opd')
+        loadedOpd, loadedIndex = loaded.opd
+        assert np.array_equal(np.isnan(loadedOpd), np.isnan(opd))
+        step = (np.nanmax(opd) - np.nanmin(opd)) / (2 ** 16 - 2)  # One fixed-point step
+        assert np.nanmax(np.abs(loadedOpd - opd)) <= step
+        assert np.array_equal(loadedIndex, opdIndex)
+        roiOpd, _ = loaded.getField('opd', np.s_[5:15, 20:30])
+        assert np.array_equal(roiOpd, loadedOpd[5:15, 20:30], equal_nan=True)
+        allNan = _syntheticResults(1, opd=True)
+        allNan.dict['opd'][0][:] = np.nan
+        allNan.toHDF(str(tmp_path), 'allNan')
+        assert np.isnan(analysis.pws.PWSAnalysisResults.load(str(tmp_path), 'allNan').opd[0]).all()
+
+
+class TestAnalysisCatalog:
+    """Test the catalog of saved analyses kept by `AnalysisManager.getAnalysisCatalog`."""
+
+    def test_catalog(self, syntheticData):
+        """The catalog is kept next to the `analyses` folder so that every file in the folder is an analysis file, and saving or
+        removing an analysis only changes the entry of that analysis."""
+        acq = pwsdt.Acquisition(syntheticData.datasetPath / 'Cell1')
+        catalogPath = syntheticData.datasetPath / 'Cell1' / 'PWS' / acq.pws.catalogFileName
+        acq.pws.saveAnalysis(_syntheticResults(0), 'first')
+        for fileName in os.listdir(syntheticData.datasetPath / 'Cell1' / 'PWS' / 'analyses'):
+            analysis.pws.PWSAnalysisResults.fileName2Name(fileName)  # Older versions of PWSpy do this for every file in the folder.
+        with open(catalogPath) as f:
+            catalog = json.load(f)
+        catalog['analysisResults_stale.h5'] = {'fingerprint': 'stale'}
+        with open(catalogPath, 'w') as f:
+            json.dump(catalog, f)
+        acq.pws.saveAnalysis(_syntheticResults(1), 'second')
+        with open(catalogPath) as f:
+            catalog = json.load(f)
+        assert sorted(catalog) == ['analysisResults_first.h5', 'analysisResults_second.h5', 'analysisResults_stale.h5']  # Other entries aren't checked.
+        acq.pws.removeAnalysis('first')
+        entries = acq.pws.getAnalysisCatalog()
+        assert sorted(entries) == ['second']
+        assert entries['second']['shapes']['rms'] == [64, 80]
+        assert entries['second']['imCubeIdTag'] == 'imCubeIdTag'
+        with open(catalogPath) as f:
+            assert sorted(json.load(f)) == ['analysisResults_second.h5']
+
+
+class TestAnalysisStore:
+    """Test saving analyses of several acquisitions to a single file with `pwspy.dataTypes.AnalysisStore`."""
+
+    def test_saveLoadRemove(self, syntheticData):
+        """While the store is open the `AnalysisManager` methods of the acquisitions use the store instead of the `analyses` folder."""
+        acq = pwsdt.Acquisition(syntheticData.datasetPath / 'Cell1')
+        results = _syntheticResults(1)
+        with pwsdt.AnalysisStore.open(str(syntheticData.datasetPath)) as store:
+            acq.pws.saveAnalysis(results, _analysisName)
+            assert store.hasAnalysis(acq.pws.filePath, analysis.pws.PWSAnalysisResults, _analysisName)
+            assert not (syntheticData.datasetPath / 'Cell1' / 'PWS' / 'analyses').exists()
+            assert acq.pws.getAnalyses() == [_analysisName]
+            assert np.array_equal(acq.pws.loadAnalysis(_analysisName).rms, results.rms)
+            with pytest.raises(OSError):
+                acq.pws.saveAnalysis(results, _analysisName)
+            acq.pws.saveAnalysis(_syntheticResults(2), _analysisName, overwrite=True)
+        assert acq.pws.getAnalyses() == []  # The store is closed.
+        with pwsdt.AnalysisStore.open(str(syntheticData.datasetPath), readOnly=True):
+            assert np.array_equal(acq.pws.loadAnalysis(_analysisName).rms, _syntheticResults(2).rms)
+        with pwsdt.AnalysisStore.open(str(syntheticData.datasetPath)):
+            acq.pws.removeAnalysis(_analysisName)
+            assert acq.pws.getAnalyses() == []
+            with pytest.raises(OSError):
+                acq.pws.loadAnalysis(_analysisName)
+
+    def test_storeAndFolder(self, syntheticData):
+        """Analyses saved in the `analyses` folder before the store was opened are still listed alongside those in the store."""
+        acq = pwsdt.Acquisition(syntheticData.datasetPath / 'Cell1')
+        acq.pws.saveAnalysis(_syntheticResults(1), 'inFolder')
+        with pwsdt.AnalysisStore.open(str(syntheticData.datasetPath)) as store:
+            acq.pws.saveAnalysis(_syntheticResults(2), 'inStore')
+            assert store.hasAcquisition(acq.pws.filePath)
+            assert sorted(acq.pws.getAnalyses()) == ['inFolder', 'inStore']
+            assert sorted(acq.pws.getAnalysisCatalog()) == ['inFolder', 'inStore']
+            assert np.array_equal(acq.pws.loadAnalysis('inFolder').rms, _syntheticResults(1).rms)
+            assert np.array_equal(acq.pws.loadAnalysis('inStore').rms, _syntheticResults(2).rms)
+            with pytest.raises(OSError):
+                acq.pws.saveAnalysis(_syntheticResults(3), 'inFolder')  # The name is already used by the file in the `analyses` folder.
+            acq.pws.saveAnalysis(_syntheticResults(3), 'inFolder', overwrite=True)
+            assert sorted(acq.pws.getAnalyses()) == ['inFolder', 'inStore']
+            assert np.array_equal(acq.pws.loadAnalysis('inFolder').rms, _syntheticResults(3).rms)  # The store takes precedence.
+        assert acq.pws.getAnalyses() == ['inFolder']
+
+    def test_importAnalyses(self, syntheticData):
+        """Analyses saved to the `analyses` folders are copied into the store."""
+        acqs = [pwsdt.Acquisition(syntheticData.datasetPath / f'Cell{i}') for i in (1, 2)]
+        for i, acq in enumerate(acqs):
+            acq.pws.saveAnalysis(_syntheticResults(i), _analysisName)
+        with pwsdt.AnalysisStore.open(str(syntheticData.datasetPath)) as store:
+            assert store.importAnalyses() == 2
+            assert store.importAnalyses() == 0  # Already in the store.
+            assert store.importAnalyses(overwrite=True, removeOriginals=True) == 2
+            for i, acq in enumerate(acqs):
+                assert acq.pws.getAnalyses() == [_analysisName]
+                assert np.array_equal(acq.pws.loadAnalysis(_analysisName).rms, _syntheticResults(i).rms)
+        for acq in acqs:
+            assert acq.pws.getAnalyses() == []  # The original files were removed.
+
+
+class TestRoiCompiler:
+    """Test compiling the values of analysis results within ROIs."""
+
+    def test_runManySavedOpd(self, tmp_path, rois):
+        """`runMany` uses the saved OPD, like `run`, rather than calculating it from the reflectance."""
+        _syntheticResults(0, opd=True).toHDF(str(tmp_path), 'opd')
+        results = analysis.pws.PWSAnalysisResults.load(str(tmp_path), 'opd')
+        compiler = analysis.compilation.PWSRoiCompiler(analysis.compilation.PWSCompilerSettings(rms=True, opd=True))
+        columns, _ = compiler.runMany(results, rois)
+        for i, roi in enumerate(rois):
+            single, _ = compiler.run(results, roi)
+            assert np.allclose(columns['opd'][i], single.opd, rtol=1e-5)
+            assert np.array_equal(columns['opdIndex'][i], single.opdIndex)
+            assert np.isclose(columns['rms'][i], single.rms, rtol=1e-5)
+
+
+class TestCompileExperiment:
+    """Test compiling every acquisition of an experiment with `pwspy.analysis.compilation.compileExperiment` on synthetic data."""
+    settings = analysis.compilation.PWSCompilerSettings(reflectance=True, rms=True)
+
+    @pytest.fixture
+    def experiment(self, syntheticData):
+        """Save an analysis and two ROIs for each of the acquisitions of `syntheticData`."""
+        for i in (1, 2):
+            acq = pwsdt.Acquisition(syntheticData.datasetPath / f"Cell{i}")
+            acq.pws.saveAnalysis(_syntheticResults(i), _analysisName)
+            for number, box in ((1, np.s_[10:30, 20:40]), (2, np.s_[40:50, 20:70])):
+                mask = np.zeros((64, 80), dtype=bool)
+                mask[box] = True
+                pwsdt.RoiFile.toHDF(pwsdt.Roi.fromMask(mask), 'nucleus', number, acq.filePath)
+        return syntheticData
+
+    def _compile(self, experiment, **kwargs):
+        return analysis.compilation.compileExperiment(str(experiment.datasetPath), _analysisName, None, self.settings, numProcesses=2, **kwargs)
+
+    def test_analysisStore(self, experiment):
+        """Analyses in an `AnalysisStore` are compiled whether or not the store is open, giving the same rows as the analysis files."""
+        fromFiles = self._compile(experiment)
+        assert len(fromFiles) == 4
+        with pwsdt.AnalysisStore.open(str(experiment.datasetPath)) as store:
+            assert store.importAnalyses(removeOriginals=True) == 2
+            fromOpenStore = self._compile(experiment)
+        fromStore = self._compile(experiment)
+        for df in (fromOpenStore, fromStore):
+            assert list(df['acquisitionPath']) == list(fromFiles['acquisitionPath'])
+            assert np.allclose(df['rms'].astype(float), fromFiles['rms'].astype(float))
+
+    def test_failureKeepsPrevious(self, experiment):
+        """If an acquisition can't be compiled its previously compiled rows are kept."""
+        outputPath = str(experiment.datasetPath / 'compiled.h5')
+        previous = self._compile(experiment, outputPath=outputPath)
+        with open(experiment.datasetPath / 'Cell1' / 'PWS' / 'analyses' / analysis.pws.PWSAnalysisResults.name2FileName(_analysisName), 'wb') as f:
+            f.write(b'corrupt')
+        df = self._compile(experiment, outputPath=outputPath)
+        assert list(df['acquisitionPath']) == list(previous['acquisitionPath'])
+        assert np.allclose(df['rms'].astype(float), previous['rms'].astype(float))
+
+    @pytest.mark.parametrize('ext', ['.h5', '.csv'])
+    def test_incremental(self, experiment, ext):
+        """Rows reused from the saved table are the same as newly compiled rows, including the `None` values of metrics that weren't compiled."""
+        outputPath = str(experiment.datasetPath / f'compiled{ext}')
+        fresh = self._compile(experiment, outputPath=outputPath)
+        assert fresh['polynomialRms'].isnull().all() and (fresh['warnings'] == '').all()
+        reused = self._compile(experiment, outputPath=outputPath)
+        assert list(reused.columns) == list(fresh.columns)
+        for freshRow, reusedRow in zip(fresh.to_dict('records'), reused.to_dict('records')):
+            for k, v in freshRow.items():
+                assert reusedRow[k] == v or (v is None and reusedRow[k] is None), k
+        # Changing an ROI only compiles that ROI again.
+        mask = np.zeros((64, 80), dtype=bool)
+        mask[5:15, 5:15] = True
+        pwsdt.RoiFile.toHDF(pwsdt.Roi.fromMask(mask), 'nucleus', 1, str(experiment.datasetPath / 'Cell1'), overwrite=True)
+        updated = self._compile(experiment, outputPath=outputPath)
+        changed = (updated['rms'] != fresh['rms']).to_list()
+        assert changed == [True, False, False, False]
+        assert updated['polynomialRms'].isnull().all() and (updated['warnings'] == '').all()
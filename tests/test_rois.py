@@ -1,7 +1,9 @@
+import h5py
 import pytest
 import shapely.geometry
 import numpy as np
 import pwspy.dataTypes as pwsdt
+from conftest import makeRoi
 
 
 def test_roi(sequenceData):
@@ -17,3 +19,234 @@ def test_roi(sequenceData):
             assert isinstance(roi.verts, np.ndarray)
             assert len(roi.verts.shape) == 2
             assert roi.verts.shape[1] == 2
+
+
+def test_roiSet(tmp_path, rois):
+    """Test that the statistics of a `RoiSet` match those calculated separately for each ROI and that it can be saved and loaded."""
+    rng = np.random.default_rng(0)
+    shape = rois[0].dataShape
+    roiSet = pwsdt.RoiSet.fromRois(rois, numbers=[1, 4, 7])
+    assert list(roiSet.numbers) == [1, 4, 7]
+    image = rng.random(shape)
+    cube = rng.random(shape + (5,))
+    mean, std = roiSet.meanSpectra(cube)
+    for i, roi in enumerate(rois):
+        assert roiSet.count()[i] == roi.mask.sum()
+        assert np.isclose(roiSet.mean(image)[i], image[roi.mask].mean())
+        assert np.isclose(roiSet.std(image)[i], image[roi.mask].std())
+        assert np.allclose(mean[i], cube[roi.mask].mean(axis=0))
+        assert np.allclose(std[i], cube[roi.mask].std(axis=0))
+        assert np.array_equal(roiSet.toRois()[i].mask, roi.mask)
+    roiSet.toHDF(str(tmp_path / 'roiSet.h5'))
+    assert np.array_equal(pwsdt.RoiSet.fromHDF(str(tmp_path / 'roiSet.h5')).labels, roiSet.labels)
+    with pytest.raises(ValueError):
+        pwsdt.RoiSet.fromRois(rois + [rois[0]])
+
+
+def test_roiSetFromVerts():
+    """Test that rasterizing and tracing many polygons at once matches doing it for each ROI separately."""
+    shape = (64, 80)
+    verts = [np.array([[x, y], [x + 10, y], [x + 10, y + 15], [x, y + 12]]) for x, y in [(-3, 3), (30, 5), (50, 40), (75, 60)]]
+    roiSet = pwsdt.RoiSet.fromVerts(verts, shape)
+    expected = pwsdt.RoiSet.fromRois([pwsdt.Roi.fromVerts(v, shape) for v in verts])
+    assert np.array_equal(roiSet.labels, expected.labels)
+    for roi, polygon in zip(roiSet.toRois(), roiSet.getPolygons()):
+        assert polygon.buffer(0).equals(roi.polygon)
+
+
+def test_roiIndex(tmp_path, rois):
+    """Test that the spatial index finds the expected ROIs and is kept up to date as ROIs are saved and deleted."""
+    rois = dict(enumerate(rois))
+    pwsdt.RoiFile.toHDFMany(rois, 'cell', str(tmp_path))
+    index = pwsdt.RoiIndex.load(str(tmp_path))
+    assert [(name, num) for name, num, fformat in index.queryPoint(35, 10)] == [('cell', 1)]
+    assert [num for name, num, fformat in index.queryBox((slice(0, 20), slice(0, 40)))] == [0, 1]
+    assert index.queryPoint(70, 5) == []
+    pwsdt.RoiFile.toHDF(rois[0], 'other', 1, str(tmp_path))
+    pwsdt.RoiFile.deleteRoi(str(tmp_path), 'cell', 1)
+    index = pwsdt.RoiIndex.load(str(tmp_path))
+    assert len(index) == 3
+    assert [(name, num) for name, num, fformat in index.queryPoint(5, 5)] == [('cell', 0), ('other', 1)]
+    assert index.queryPoint(35, 10) == []
+
+
+def test_roiIndexIncremental(tmp_path, monkeypatch, rois):
+    """Test that saving or deleting single ROIs only updates their own entries in the index and that files modified without
+    updating the index are read again."""
+    rois = dict(enumerate(rois))
+    pwsdt.RoiFile.toHDFMany(rois, 'cell', str(tmp_path))
+    pwsdt.RoiIndex.load(str(tmp_path))
+    fileEntries = []
+    fileEntry = pwsdt.RoiIndex._fileEntry
+    monkeypatch.setattr(pwsdt.RoiIndex, '_fileEntry', lambda *args: fileEntries.append(args[1]) or fileEntry(*args))
+    pwsdt.RoiFile.toHDF(rois[2], 'cell', 5, str(tmp_path))
+    pwsdt.RoiFile.deleteRoi(str(tmp_path), 'cell', 1)
+    pwsdt.RoiFile.toHDF(rois[0], 'cell', 1, str(tmp_path), overwrite=True)
+    assert fileEntries == []
+    index = pwsdt.RoiIndex(str(tmp_path), pwsdt.RoiIndex._readIndex(str(tmp_path)))
+    assert [num for name, num, fformat in index.queryPoint(5, 5)] == [0, 1]
+    assert [num for name, num, fformat in index.queryPoint(55, 45)] == [2, 5]
+    assert index.queryPoint(35, 10) == []
+    assert pwsdt.RoiIndex.load(str(tmp_path))._entries == index._entries  # The saved index was already up to date.
+    assert fileEntries == []
+    with h5py.File(tmp_path / 'ROI_cell.h5', 'a') as hf:  # Modify the file without updating the index.
+        del hf['0']
+    pwsdt.RoiFile.toHDF(rois[1], 'cell', 6, str(tmp_path))
+    assert fileEntries == ['ROI_cell.h5']
+    index = pwsdt.RoiIndex.load(str(tmp_path))
+    assert [num for name, num, fformat in index.queryPoint(5, 5)] == [1]
+    assert [num for name, num, fformat in index.queryPoint(35, 10)] == [6]
+
+
+def test_roiManifest(tmp_path):
+    """Test that ROI files list their contents in a manifest and that files modified without updating the manifest are still read correctly."""
+    roi = pwsdt.Roi.fromVerts(np.array([[2, 3], [12, 3], [12, 15], [2, 12]]), (64, 80))
+    pwsdt.RoiFile.toHDFMany({1: roi, 2: roi, 3: roi}, 'cell', str(tmp_path))
+    pwsdt.RoiFile.toHDF(roi, 'cell', 5, str(tmp_path))
+    pwsdt.RoiFile.deleteRoi(str(tmp_path), 'cell', 2)
+    with h5py.File(tmp_path / 'ROI_cell.h5', 'r') as hf:
+        assert list(hf.attrs['roiManifest']['number']) == [1, 3, 5]
+    assert sorted(num for name, num, fformat in pwsdt.RoiFile.getValidRoisInPath(str(tmp_path))) == [1, 3, 5]
+    with h5py.File(tmp_path / 'ROI_cell.h5', 'a') as hf:  # Simulate a modification by an older version.
+        del hf['3']
+    assert sorted(num for name, num, fformat in pwsdt.RoiFile.getValidRoisInPath(str(tmp_path))) == [1, 5]
+
+
+def test_roiMask():
+    """Test that the full mask, cropped mask, and bounding box of an ROI agree and that the full mask can't be modified in place."""
+    shape = (64, 80)
+    roi = pwsdt.Roi.fromVerts(np.array([[20, 10], [45, 10], [45, 30], [20, 25]]), shape)
+    mask = roi.mask
+    assert mask.shape == shape == roi.dataShape
+    ys, xs = np.nonzero(mask)
+    assert roi.boundingBox == (slice(ys.min(), ys.max() + 1), slice(xs.min(), xs.max() + 1))
+    assert np.array_equal(roi.croppedMask, mask[roi.boundingBox])
+    with pytest.raises(ValueError):  # Modifying the copy would silently do nothing.
+        roi.mask[0, 0] = True
+    newMask = np.zeros(shape, dtype=bool)
+    newMask[50:60, 5:8] = True
+    roi.mask = newMask
+    assert np.array_equal(roi.mask, newMask)
+    assert roi.boundingBox == (slice(50, 60), slice(5, 8))
+    assert roi.croppedMask.shape == (10, 3)
+
+
+@pytest.mark.parametrize('fileFormat', [None, pwsdt.RoiFile.FileFormats.HDF3, pwsdt.RoiFile.FileFormats.HDF4])
+def test_roiFileFormats(tmp_path, fileFormat, rois):
+    """Test that ROIs are saved as HDF3, which older versions can read, unless HDF4 is requested, and that both formats load the same ROI."""
+    shape = rois[0].dataShape
+    rois = dict(enumerate(rois[:2]))
+    pwsdt.RoiFile.toHDF(rois[0], 'single', 0, str(tmp_path), fileFormat=fileFormat)
+    pwsdt.RoiFile.toHDFMany(rois, 'many', str(tmp_path), fileFormat=fileFormat)
+    expected = fileFormat if fileFormat is not None else pwsdt.RoiFile.FileFormats.HDF3
+    with h5py.File(tmp_path / 'ROI_many.h5', 'r') as hf:
+        for number, roi in rois.items():
+            assert hf[str(number)].attrs['fileFormat'] == expected.name
+            assert hf[str(number)]['mask'].shape == (shape if expected is pwsdt.RoiFile.FileFormats.HDF3 else roi.croppedMask.shape)
+    for name, number in [('single', 0), ('many', 0), ('many', 1)]:
+        roiFile = pwsdt.RoiFile.fromHDF(str(tmp_path), name, number)
+        assert roiFile.fformat is expected
+        loaded = roiFile.getRoi()
+        assert loaded.dataShape == shape
+        assert loaded.boundingBox == rois[number].boundingBox
+        assert np.array_equal(loaded.mask, rois[number].mask)
+        assert loaded.polygon.equals(rois[number].polygon)
+    with pytest.raises(ValueError):
+        pwsdt.RoiFile.toHDF(rois[0], 'bad', 0, str(tmp_path), fileFormat=pwsdt.RoiFile.FileFormats.HDF2)
+
+
+def test_getMeanSpectra():
+    """Test that the mean spectra of an ROI, calculated from its bounding box, match those of its full mask."""
+    rng = np.random.default_rng(0)
+    shape = (64, 80)
+    cube = pwsdt.KCube(rng.random(shape + (20,), dtype=np.float32), tuple(np.linspace(8.9, 12.6, 20)))
+    roi = pwsdt.Roi.fromVerts(np.array([[20, 10], [45, 10], [45, 30], [20, 25]]), shape)
+    mean, std = cube.getMeanSpectra(roi)
+    fullMean, fullStd = cube.getMeanSpectra(roi.mask)
+    assert np.allclose(mean, fullMean)
+    assert np.allclose(std, fullStd)
+    assert np.allclose(mean, cube.data[roi.mask].mean(axis=0))
+
+
+def test_loadAllFromPath(tmp_path, rois):
+    """Test that loading every ROI of a folder at once matches loading them one at a time and that unchanged files are loaded from the cache."""
+    import scipy.io as spio
+    shape = rois[0].dataShape
+    pwsdt.RoiFile.toHDFMany({0: rois[0], 1: rois[1]}, 'cell', str(tmp_path))
+    pwsdt.RoiFile.toHDF(rois[2], 'nucleus', 4, str(tmp_path))
+    spio.savemat(str(tmp_path / 'BW2_old.mat'), {'BW': rois[2].mask.astype(np.uint8)})
+    pwsdt.roiCache.clear()
+    loaded = pwsdt.RoiFile.loadAllFromPath(str(tmp_path))
+    assert [(r.name, r.number) for r in loaded] == [('cell', 0), ('cell', 1), ('nucleus', 4), ('old', 2)]
+    for roiFile in loaded:
+        single = pwsdt.RoiFile.loadAny(str(tmp_path), roiFile.name, roiFile.number)
+        assert roiFile.fformat == single.fformat
+        assert np.array_equal(roiFile.getRoi().mask, single.getRoi().mask)
+    assert [(r.name, r.number) for r in pwsdt.RoiFile.loadAllFromPath(str(tmp_path), names=['nucleus'])] == [('nucleus', 4)]
+
+    hits, misses = pwsdt.roiCache.hits, pwsdt.roiCache.misses
+    again = pwsdt.RoiFile.loadAllFromPath(str(tmp_path))
+    assert (pwsdt.roiCache.hits - hits, pwsdt.roiCache.misses - misses) == (3, 0)  # One for each file.
+    again[0].getRoi().mask = np.zeros(shape, dtype=bool)  # ROIs from the cache are copies.
+    assert np.array_equal(pwsdt.RoiFile.loadAllFromPath(str(tmp_path))[0].getRoi().mask, rois[0].mask)
+
+    pwsdt.RoiFile.toHDF(rois[2], 'cell', 2, str(tmp_path))  # The modified file is loaded again.
+    misses = pwsdt.roiCache.misses
+    assert [r.number for r in pwsdt.RoiFile.loadAllFromPath(str(tmp_path), names=['cell'])] == [0, 1, 2]
+    assert pwsdt.roiCache.misses == misses + 1
+    hits, misses = pwsdt.roiCache.hits, pwsdt.roiCache.misses
+    pwsdt.RoiFile.loadAllFromPath(str(tmp_path), useCache=False)
+    assert (pwsdt.roiCache.hits, pwsdt.roiCache.misses) == (hits, misses)
+
+
+def test_transformMany(rois):
+    """Test that transforming many ROIs at once matches transforming each ROI's full mask and vertices separately."""
+    import cv2
+    shape = rois[0].dataShape
+    rois = rois + [makeRoi(68, 50)]  # Partly outside of the image.
+    rois.append(pwsdt.Roi.fromMask(rois[1].mask))  # No polygon yet
+    angle = np.deg2rad(7)
+    matrix = np.array([[np.cos(angle), -np.sin(angle), 6.3], [np.sin(angle), np.cos(angle), -2.7]])
+    transformed = pwsdt.Roi.transformMany(rois, matrix)
+    for roi, new in zip(rois, transformed):
+        expectedMask = cv2.warpAffine(roi.mask.astype(np.uint8), matrix, (shape[1], shape[0])).astype(bool)
+        assert new.dataShape == shape
+        assert np.array_equal(new.mask, expectedMask)
+        assert np.array_equal(roi.transform(matrix).mask, expectedMask)
+    for roi, new in zip(rois[:4], transformed[:4]):
+        expectedVerts = cv2.transform(roi.verts[None, :, :].astype(np.float64), matrix)[0]
+        assert new.polygon.equals(pwsdt.Roi(new.mask, verts=expectedVerts).polygon)
+    offImage = pwsdt.Roi.transformMany(rois[:1], np.array([[1, 0, 500], [0, 1, 0]], dtype=float))[0]
+    assert not offImage.mask.any()
+
+
+def test_toHDFManyOverwrite(tmp_path, rois):
+    """Test that a conflicting save leaves the existing file untouched, that overwriting replaces only the given ROIs, and that no
+    partially written file is left behind."""
+    pwsdt.RoiFile.toHDFMany({1: rois[0], 2: rois[1]}, 'cell', str(tmp_path))
+    with open(tmp_path / 'ROI_cell.h5', 'rb') as f:
+        original = f.read()
+    with pytest.raises(OSError):
+        pwsdt.RoiFile.toHDFMany({2: rois[2], 3: rois[2]}, 'cell', str(tmp_path))
+    with open(tmp_path / 'ROI_cell.h5', 'rb') as f:
+        assert f.read() == original
+    assert not (tmp_path / 'ROI_cell.h5.part').exists()
+
+    (tmp_path / 'ROI_cell.h5.part').write_bytes(b'left by an interrupted save')
+    pwsdt.RoiFile.toHDFMany({2: rois[2], 3: rois[2]}, 'cell', str(tmp_path), overwrite=True)
+    assert not (tmp_path / 'ROI_cell.h5.part').exists()
+    loaded = {r.number: r.getRoi() for r in pwsdt.RoiFile.loadAllFromPath(str(tmp_path), useCache=False)}
+    assert sorted(loaded) == [1, 2, 3]
+    for number, roi in [(1, rois[0]), (2, rois[2]), (3, rois[2])]:
+        assert np.array_equal(loaded[number].mask, roi.mask)
+    with h5py.File(tmp_path / 'ROI_cell.h5', 'r') as hf:
+        assert list(hf.attrs['roiManifest']['number']) == [1, 2, 3]
+
+    with h5py.File(tmp_path / 'ROI_cell.h5', 'a') as hf:  # Groups that aren't ROIs, e.g. from another program, are kept but not listed.
+        hf.create_group('notes').attrs['author'] = 'someone'
+    pwsdt.RoiFile.toHDFMany({4: rois[1]}, 'cell', str(tmp_path))
+    with h5py.File(tmp_path / 'ROI_cell.h5', 'r') as hf:
+        assert hf['notes'].attrs['author'] == 'someone'
+        assert list(hf.attrs['roiManifest']['number']) == [1, 2, 3, 4]
+    assert [number for name, number, fformat in pwsdt.RoiFile.getValidRoisInPath(str(tmp_path))] == [1, 2, 3, 4]
+    assert [r.number for r in pwsdt.RoiFile.loadAllFromPath(str(tmp_path), useCache=False)] == [1, 2, 3, 4]
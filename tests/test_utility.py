@@ -1,5 +1,85 @@
+import gc
+import multiprocessing as mp
+import os
+import pickle
+import threading as th
+import time
+import numpy as np
+import pandas as pd
+import psutil
+import pytest
+from pwspy.analysis import ParallelRunner
+from pwspy.analysis.pws import PWSAnalysis, PWSAnalysisSettings
+from pwspy.dataTypes import Acquisition
 from pwspy.utility.acquisition import loadDirectory, PositionsStep
+from pwspy.utility.executors import Executor, SocketExecutor, runWorker
+from pwspy.utility.fileIO import processParallel, _scheduleParallel
 from pwspy.utility.micromanager import PositionList
+from pwspy.utility.misc import toSharedMemory, LRUCache
+
+
+def _square(index, row):
+    return row['value'] ** 2
+
+
+def _fail(index, row):
+    raise ValueError("Failed on purpose.")
+
+
+def _sharedRange(index, row):
+    return toSharedMemory(np.arange(row['value'], dtype=float), transferOwnership=True)
+
+
+def _sharedMemoryExists(name: str) -> bool:
+    return os.path.exists(os.path.join('/dev/shm', name))
+
+
+class _ThreadExecutor(Executor):
+    """Runs each task on its own thread. Records the order that tasks are submitted in and the total of the tasks (which are numbers)
+    running at each submission."""
+    sharesMemory = True
+
+    def __init__(self):
+        self.submitted = []
+        self.runningCosts = []
+        self.finished = 0
+        self._running = {}
+        self._lock = th.Lock()
+
+    def start(self, initializer=None, initArgs=()):
+        pass
+
+    def submit(self, func, args, callback, errorCallback):
+        with self._lock:
+            self.submitted.append(args[0])
+            self._running[id(args)] = args[0]
+            self.runningCosts.append(sum(self._running.values()))
+        th.Thread(target=self._run, args=(func, args, callback, errorCallback)).start()
+
+    def _run(self, func, args, callback, errorCallback):
+        try:
+            ret = func(*args)
+        except Exception as e:
+            ret, callback = e, errorCallback
+        with self._lock:
+            del self._running[id(args)]
+            self.finished += 1
+        callback(ret)
+
+    def close(self):
+        pass
+
+
+def _sleepTask(cost):
+    time.sleep(0.05)
+    return cost
+
+
+def _failSmallTask(cost):
+    if cost < 2:
+        raise ValueError("Failed on purpose.")
+    time.sleep(0.2)
+    return cost
 
 
 class TestSequence:
@@ -24,3 +104,158 @@ class TestSequence:
         for acq in acqs:
             iterationNum = acq.sequencerCoordinate.getStepIteration(multiplePosStep)
             print(posList[iterationNum])
+
+
+class TestExecutors:
+    def test_socket_executor(self):
+        """Run tasks on several worker processes connected to a `SocketExecutor` over localhost."""
+        executor = SocketExecutor(('localhost', 0), authkey=b'test', maxRetries=1)
+        executor.start()
+        workers = [mp.Process(target=runWorker, args=(executor.address, b'test')) for i in range(3)]
+        [w.start() for w in workers]
+        frame = pd.DataFrame({'value': range(20)})
+        assert processParallel(frame, _square, executor=executor) == [i ** 2 for i in range(20)]
+        assert processParallel(frame, _square, executor=executor) == [i ** 2 for i in range(20)]  # The executor is left running for the caller to reuse.
+        executor.close()
+        [w.join(timeout=10) for w in workers]
+        assert not any(w.is_alive() for w in workers)
+
+    def test_socket_executor_failure(self):
+        """A task that keeps failing is retried and then the error is raised."""
+        executor = SocketExecutor(('localhost', 0), authkey=b'test', maxRetries=1)
+        executor.start()
+        worker = mp.Process(target=runWorker, args=(executor.address, b'test'))
+        worker.start()
+        with pytest.raises(ValueError):
+            processParallel(pd.DataFrame({'value': [1]}), _fail, executor=executor)
+        executor.close()
+        worker.join(timeout=10)
+
+    def test_socket_executor_no_workers(self):
+        """Tasks fail rather than waiting forever when no workers connect."""
+        executor = SocketExecutor(('localhost', 0), workerTimeout=1)
+        with pytest.raises(ConnectionError):
+            processParallel(pd.DataFrame({'value': [1, 2]}), _square, executor=executor)
+        executor.close()
+
+    def test_socket_executor_authkey(self):
+        """A random key is generated by default and workers with the wrong key are rejected."""
+        assert SocketExecutor().authkey != SocketExecutor().authkey
+        executor = SocketExecutor(('localhost', 0))
+        executor.start()
+        with pytest.raises(mp.AuthenticationError):
+            runWorker(executor.address, b'wrong')
+        executor.close()
+
+    def test_parallel_runner(self, syntheticData):
+        """Run a PWS analysis through `ParallelRunner` on workers that connected before the runner sent its initializer."""
+        settings = PWSAnalysisSettings.loadDefaultSettings("Recommended")
+        refAcq = Acquisition(syntheticData.referenceCellPath)
+        acqs = [Acquisition(syntheticData.datasetPath / f"Cell{i}") for i in (1, 2)]
+        executor = SocketExecutor(('localhost', 0))
+        executor.start()  # Needed to learn the port for the workers.
+        workers = [mp.Process(target=runWorker, args=(executor.address, executor.authkey)) for i in range(2)]
+        [w.start() for w in workers]
+        with ParallelRunner(PWSAnalysis(settings, None, refAcq.pws.toDataClass()), executor=executor) as runner:
+            results = runner.run([acq.pws for acq in acqs])
+        [w.join(timeout=10) for w in workers]
+        assert not any(w.is_alive() for w in workers)
+        for acq, (warns, result, md) in zip(acqs, results):
+            expected, _ = PWSAnalysis(settings, None, refAcq.pws.toDataClass()).run(acq.pws.toDataClass())
+            assert md.filePath == acq.pws.filePath
+            assert np.allclose(result.rms, expected.rms)
+
+
+@pytest.mark.skipif(not os.path.isdir('/dev/shm'), reason="Checking for the memory blocks relies on the posix shared memory folder.")
+class TestSharedMemory:
+    def test_owned(self):
+        """An array that keeps ownership is shared with unpickled copies and unlinked once the original is released."""
+        arr = toSharedMemory(np.arange(10.))
+        name = arr._shm.name
+        copy = pickle.loads(pickle.dumps(arr))
+        copy[0] = 5
+        assert arr[0] == 5  # Both arrays use the same memory.
+        del copy
+        gc.collect()
+        assert _sharedMemoryExists(name)
+        del arr
+        gc.collect()
+        assert not _sharedMemoryExists(name)
+
+    def test_transferOwnership(self):
+        """With `transferOwnership` the block outlives the original array and is unlinked once the unpickled array, and any views of it, are released."""
+        arr = toSharedMemory(np.arange(10.), transferOwnership=True)
+        name = arr._shm.name
+        received = pickle.loads(pickle.dumps(arr))
+        del arr
+        gc.collect()
+        assert _sharedMemoryExists(name)
+        view = received[2:]
+        del received
+        gc.collect()
+        assert _sharedMemoryExists(name)
+        assert np.array_equal(view, np.arange(2, 10.))
+        del view
+        gc.collect()
+        assert not _sharedMemoryExists(name)
+
+    def test_workerResults(self):
+        """Arrays returned from worker processes through shared memory are owned, and eventually unlinked, by the parent process."""
+        results = processParallel(pd.DataFrame({'value': [3, 5]}), _sharedRange, numProcesses=2)
+        names = [r._shm.name for r in results]
+        assert [list(r) for r in results] == [[0, 1, 2], [0, 1, 2, 3, 4]]
+        assert all(_sharedMemoryExists(name) for name in names)
+        del results
+        gc.collect()
+        assert not any(_sharedMemoryExists(name) for name in names)
+
+
+class TestScheduler:
+    def test_memoryBudget(self):
+        """Tasks are submitted largest first and the tasks running at once stay within the memory budget, except that a task larger than
+        the whole budget still runs on its own."""
+        unit = psutil.virtual_memory().available * 0.5 / 10  # The budget is about 10 units.
+        costs = [3, 8, 1, 20, 6, 3, 1]
+        executor = _ThreadExecutor()
+        results = dict(_scheduleParallel(executor, _sleepTask, costs, [c * unit for c in costs], memoryFraction=0.5))
+        assert executor.submitted == sorted(costs, reverse=True)
+        assert results == dict(enumerate(costs))
+        assert executor.runningCosts[0] == 20
+        assert all(c <= 10 for c in executor.runningCosts[1:])
+        assert max(executor.runningCosts[1:]) > 8  # Smaller tasks do run together.
+
+    def test_noBudget(self):
+        """Without a memory fraction every task is submitted at once."""
+        executor = _ThreadExecutor()
+        list(_scheduleParallel(executor, _sleepTask, [1, 2, 3], [1, 2, 3], memoryFraction=None))
+        assert executor.runningCosts[-1] == 6
+
+    def test_errorDrainsTasks(self):
+        """When a task fails the tasks already in progress are waited for before the error is raised, and no more tasks are submitted."""
+        unit = psutil.virtual_memory().available * 0.5 / 10  # The budget is about 10 units.
+        costs = [4, 4, 1, 1, 1, 1]  # Only the first four fit in the budget at once.
+        executor = _ThreadExecutor()
+        with pytest.raises(ValueError):
+            list(_scheduleParallel(executor, _failSmallTask, costs, [c * unit for c in costs], memoryFraction=0.5))
+        assert len(executor.submitted) < len(costs)
+        assert executor.finished == len(executor.submitted)
+
+
+class TestLRUCache:
+    def test_eviction(self):
+        """The least recently used items are discarded to keep the total size within `maxBytes`."""
+        cache = LRUCache(maxBytes=100, sizeOf=len)
+        cache.put('a', 'x' * 40)
+        cache.put('b', 'x' * 40)
+        assert cache.get('a') is not None  # 'b' is now the least recently used.
+        cache.put('c', 'x' * 40)
+        assert 'b' not in cache and 'a' in cache and 'c' in cache
+        assert cache.currentBytes == 80
+        cache.put('d', 'x' * 200)  # Larger than the whole cache, not stored.
+        assert 'd' not in cache and len(cache) == 2
+        cache.maxBytes = 50
+        assert list(cache._items) == ['c']
+        assert cache.get('b', 'missing') == 'missing'
+        assert (cache.hits, cache.misses) == (1, 1)
+        cache.pop('c')
+        assert cache.currentBytes == 0 and len(cache) == 0